@@ -34,8 +34,24 @@ several functions to help manage it and its containers.
 
 # Import python libs
 from __future__ import absolute_import, print_function, unicode_literals
+import collections
+import copy
+import fcntl
+import fnmatch
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import multiprocessing.util
 import os
+import re
+import tarfile
+import tempfile
+import threading
+import time
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 # Import salt libs
 try:
@@ -53,10 +69,13 @@ from salt.exceptions import SaltInvocationError
 import salt.ext.six as six
 from salt.ext.six.moves import map
 from salt.ext.six.moves import zip
+from salt.ext.six.moves import shlex_quote
+from salt.ext.six.moves.urllib.parse import urlparse as _urlparse
 
 # Import 3rd-party libs
 try:
     import pylxd
+    import requests
     PYLXD_AVAILABLE = True
 
     import urllib3
@@ -64,6 +83,14 @@ try:
 except ImportError:
     PYLXD_AVAILABLE = False
 
+try:
+    from ws4py.client import WebSocketBaseClient
+    from ws4py.manager import WebSocketManager
+    WS4PY_AVAILABLE = True
+except ImportError:
+    WebSocketBaseClient = object
+    WS4PY_AVAILABLE = False
+
 # Set up logging
 import logging
 log = logging.getLogger(__name__)
@@ -88,10 +115,51 @@ _architectures = {
 # Keep in sync with: https://github.com/lxc/lxd/blob/master/shared/api/status_code.go  # noqa
 CONTAINER_STATUS_RUNNING = 103
 
+# Config keys on the containers of a warm pool
+POOL_CONFIG_KEY = 'user.salt.pool'
+POOL_SPEC_CONFIG_KEY = 'user.salt.pool_spec'
+
+# Config key with the spec_fingerprint of the last applied spec
+FINGERPRINT_CONFIG_KEY = 'user.salt.fingerprint'
+
+# Name of the snapshot incremental migrations use as common base
+_precopy_snapshot_name = 'salt-migrate-precopy'
+
+# Operation metadata like "rootfs: 45% (12.30MB/s)" or "1.23GB (120.00MB/s)"
+_progress_regex = re.compile(
+    r'(?:(?P<percent>\d+)%|(?P<size>[\d.]+\s*[kKMGTPE]?i?B))'
+    r'(?:\s*\((?P<rate>[\d.]+\s*[kKMGTPE]?i?B)/s\))?'
+)
+
+# The kinds of objects in the inventory of a remote
+_inventory_kinds = ('containers', 'profiles', 'images')
+
+# Only states of the same remote get folded by state_aggregate
+_aggregate_remote_args = ('remote_addr', 'cert', 'key', 'verify_cert')
+
+# A state gets folded only when the aggregating one has its requisites
+_aggregate_requisites = ('require', 'require_any', 'use')
+
+# States which run on conditions or get watched don't get folded
+_aggregate_conditional_requisites = (
+    'watch', 'watch_any', 'prereq', 'onchanges', 'onchanges_any',
+    'onfail', 'onfail_any', 'onfail_all', 'listen'
+)
+
+# Uploads get streamed in chunks of this size
+_upload_chunk_size = 1024 ** 2
+
+_byte_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4, 'P': 1024 ** 5, 'E': 1024 ** 6}
+
 __virtualname__ = 'lxd'
 
 _connection_pool = {}
 
+# Guards the per-run caches in __context__, the states fill
+# them from thread pools.
+_context_lock = threading.RLock()
+
 
 def __virtual__():
     if PYLXD_AVAILABLE:
@@ -338,10 +406,7 @@ def pylxd_client_get(remote_addr=None, cert=None, key=None, verify_cert=True):
     # noqa
     '''
 
-    pool_key = '|'.join((six.text_type(remote_addr),
-                         six.text_type(cert),
-                         six.text_type(key),
-                         six.text_type(verify_cert),))
+    pool_key = _pool_key(remote_addr, cert, key, verify_cert)
 
     if pool_key in _connection_pool:
         log.debug((
@@ -411,23 +476,107 @@ def pylxd_client_get(remote_addr=None, cert=None, key=None, verify_cert=True):
     return client
 
 
-def pylxd_save_object(obj):
+def pylxd_save_object(obj, base=None):
     ''' Saves an object (profile/image/container) and
         translate its execpetion on failure
 
     obj :
         The object to save
 
+    base :
+        The pylxd_object_state of obj before it got changed, with it
+        only the changed keys get sent (PATCH) with the ETag of base
+        as If-Match. When keys got removed or the object changed on
+        the server since, the changes get applied to the current
+        object on the server, which gets PUT back with its ETag as
+        If-Match. Without base the whole object gets PUT.
+
     This is an internal method, no CLI Example.
     '''
     try:
-        obj.save()
+        if base is None:
+            obj.save()
+            return True
+
+        patch, removed = _pylxd_object_delta(base, obj.marshall())
+        if not patch and not removed:
+            return True
+
+        extensions = obj.client.host_info.get('api_extensions', [])
+        etag = getattr(base, 'etag', None)
+        if removed or 'patch' not in extensions or not etag:
+            _pylxd_put_rebased(obj, patch, removed)
+            return True
+
+        api = obj.api
+        response = api.session.patch(
+            api._api_endpoint, json=patch, headers={'If-Match': etag},
+            timeout=api._timeout
+        )
+        if response.status_code == 412:
+            # Somebody changed it since base.
+            _pylxd_put_rebased(obj, patch, removed)
+            return True
+        api._assert_response(response, allowed_status_codes=(200, 202))
+        _pylxd_wait_response(obj, response)
     except pylxd.exceptions.LXDAPIException as e:
         raise CommandExecutionError(six.text_type(e))
 
     return True
 
 
+def pylxd_object_state(obj):
+    ''' Returns a copy of the writable state of an object
+        (profile/image/container), give it to pylxd_save_object
+        as base after changing obj.
+
+        Its "etag" attribute is the ETag of the object on the server,
+        None when the server has another state than obj already.
+
+    obj :
+        The object
+
+    This is an internal method, no CLI Example.
+    '''
+    state = _PylxdObjectState(copy.deepcopy(obj.marshall()))
+    try:
+        response = obj.api.get()
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
+
+    current = response.json()['metadata']
+    if all(current.get(k) == v for k, v in six.iteritems(state)):
+        state.etag = response.headers.get('ETag')
+    return state
+
+
+class _PylxdObjectState(dict):
+    ''' The marshalled object with the ETag it had on the server. '''
+    etag = None
+
+
+def _pylxd_object_get(kind, name, remote_addr=None, cert=None, key=None,
+                      verify_cert=True):
+    ''' Gets the container or profile name with one GET, returns it
+        with its pylxd_object_state carrying the ETag of that GET.
+
+        kind :
+            "containers" or "profiles"
+    '''
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+    try:
+        response = getattr(client.api, kind)[name].get()
+    except pylxd.exceptions.LXDAPIException:
+        raise SaltInvocationError(
+            '{0} \'{1}\' not found'.format(kind[:-1].capitalize(), name)
+        )
+
+    obj = _inventory_models[kind](client, **response.json()['metadata'])
+    state = _PylxdObjectState(copy.deepcopy(obj.marshall()))
+    state.etag = response.headers.get('ETag')
+    return obj, state
+
+
 def authenticate(remote_addr, password, cert, key, verify_cert=True):
     '''
     Authenticate with a remote LXDaemon.
@@ -803,6 +952,7 @@ def container_delete(name, remote_addr=None,
         name, remote_addr, cert, key, verify_cert, _raw=True
     )
     container.delete(wait=True)
+    _fingerprint_forget(container, remote_addr)
     return True
 
 
@@ -855,6 +1005,175 @@ def container_rename(name, newname, remote_addr=None,
     return _pylxd_model_to_dict(container)
 
 
+def container_claim(pool, name, profiles=None, config=None, devices=None,
+                    start=True, remote_addr=None,
+                    cert=None, key=None, verify_cert=True, spec=None,
+                    _raw=False):
+    '''
+    Claim a stopped container from a warm pool (see the
+    :mod:`lxd_container.pool <salt.states.lxd_container.pool>` state),
+    rename it to name, sync its profiles, config and devices and start it.
+
+    This is much faster than creating a container from its image
+    and bootstrapping it.
+
+    pool :
+        Name of the pool
+
+    name :
+        The new name of the container
+
+    profiles : ['default']
+        List of profiles to apply on this container
+
+    config :
+        A config dict or None (None = unset).
+
+    devices :
+        A device dict or None (None = unset).
+
+    start : True
+        Start the container after claiming it?
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    spec : None
+        Only claim members created with this spec (their
+        "user.salt.pool_spec" config key), see the pool state.
+
+    _raw : False
+        Return the raw pyxld object or a dict?
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt '*' lxd.container_claim ci ci-job-1234
+    '''
+    if profiles is None:
+        profiles = ['default']
+
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+
+    config, devices = normalize_input_values(config, devices)
+
+    for container in pool_members(pool, remote_addr, cert, key,
+                                  verify_cert, _raw=True):
+        if container.status_code == CONTAINER_STATUS_RUNNING:
+            continue
+        if (spec is not None and
+                container.config.get(POOL_SPEC_CONFIG_KEY) != spec):
+            continue
+
+        try:
+            container.rename(name, wait=True)
+        except pylxd.exceptions.LXDAPIException as e:
+            # Claimed by someone else in the meantime.
+            log.debug('Failed to claim "{0}": {1}'.format(
+                container.name, six.text_type(e))
+            )
+            continue
+
+        container = client.containers.get(name)
+        base = pylxd_object_state(container)
+        container.profiles = profiles
+        # This also removes the pool keys.
+        sync_config_devices(container, config, devices)
+        pylxd_save_object(container, base)
+
+        if start:
+            container.start(wait=True)
+
+        if _raw:
+            return container
+
+        return _pylxd_model_to_dict(container)
+
+    raise SaltInvocationError(
+        'The pool \'{0}\' has no free container'.format(pool)
+    )
+
+
+def pool_members(pool, remote_addr=None,
+                 cert=None, key=None, verify_cert=True, _raw=False):
+    '''
+    List the containers in a warm pool, oldest first.
+
+    pool :
+        Name of the pool
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    _raw : False
+        Return the raw pyxld objects or names?
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        salt '*' lxd.pool_members ci
+    '''
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+
+    containers, _ = _pylxd_containers_with_state(client)
+    members = sorted(
+        [c for c in containers
+         if c.config.get(POOL_CONFIG_KEY) == pool],
+        key=lambda c: c.created_at
+    )
+
+    if _raw:
+        return members
+
+    return [c.name for c in members]
+
+
 def container_state(name=None, remote_addr=None,
                     cert=None, key=None, verify_cert=True):
     '''
@@ -1115,6 +1434,96 @@ def container_unfreeze(name, remote_addr=None,
     return _pylxd_model_to_dict(container)
 
 
+def container_publish(name, snapshot=None, aliases=None, public=False,
+                      remote_addr=None, cert=None, key=None, verify_cert=True,
+                      _raw=False):
+    '''
+    Publish a stopped container or one of its snapshots as an image.
+
+    name :
+        Name of the container to publish
+
+    snapshot : None
+        Publish this snapshot instead of the container
+
+    aliases : None
+        List of aliases to point at the new image, aliases which
+        point to an older image get moved.
+
+    public : False
+        Make this image public available
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    _raw : False
+        Return the raw pylxd object or a dict of the image?
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        $ salt '*' lxd.container_publish tmpl snapshot=golden aliases='["tmpl/golden"]'
+    '''
+    if aliases is None:
+        aliases = []
+
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+    container = container_get(
+        name, remote_addr, cert, key, verify_cert, _raw=True
+    )
+
+    try:
+        if snapshot is not None:
+            image = container.snapshots.get(snapshot).publish(
+                public=public, wait=True
+            )
+        else:
+            image = container.publish(public=public, wait=True)
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
+
+    for alias in aliases:
+        try:
+            old = client.images.get_by_alias(alias)
+        except pylxd.exceptions.LXDAPIException:
+            old = None
+
+        if old is not None:
+            if old.fingerprint == image.fingerprint:
+                continue
+            old.delete_alias(alias)
+
+        image.add_alias(alias, '')
+
+    if _raw:
+        return image
+
+    return _pylxd_model_to_dict(image)
+
+
 def container_migrate(name,
                       stop_and_start=False,
                       remote_addr=None,
@@ -1124,13 +1533,28 @@ def container_migrate(name,
                       src_remote_addr=None,
                       src_cert=None,
                       src_key=None,
-                      src_verify_cert=None):
+                      src_verify_cert=None,
+                      incremental=False,
+                      preflight=True):
     ''' Migrate a container.
 
         If the container is running, it either must be shut down
         first (use stop_and_start=True) or criu must be installed
         on the source and destination machines.
 
+        With incremental=True a running container gets copied in two
+        phases: first a full copy of a snapshot while it keeps running,
+        then it gets stopped and only the difference gets transfered
+        with a "refresh" copy before it gets started on the destination.
+        This needs the "container_incremental_copy" API extension on
+        both hosts.
+
+        The returned dict contains a "migration" item with the mode,
+        the measured downtime in seconds and the transfer statistics.
+
+        The transfer honors the limits from the "lxd:transfers" config,
+        see :mod:`lxd.image_copy_lxd <salt.modules.lxd.image_copy_lxd>`.
+
         For this operation both certs need to be authenticated,
         use :mod:`lxd.authenticate <salt.modules.lxd.authenticate`
         to authenticate your cert(s).
@@ -1166,6 +1590,16 @@ def container_migrate(name,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
+        incremental : False
+            Pre-copy a running container before stopping it,
+            requires stop_and_start=True.
+
+        preflight : True
+            Check the destination for the required profiles, storage pools,
+            networks and free space first. Disable it when you did
+            that already with :mod:`lxd.container_migrate_preflight
+            <salt.modules.lxd.container_migrate_preflight>`.
+
         CLI Example:
 
         .. code-block:: bash
@@ -1177,6 +1611,9 @@ def container_migrate(name,
             # Migrate phpmyadmin from srv01 to srv02
             salt '*' lxd.container_migrate phpmyadmin stop_and_start=true remote_addr=https://srv02:8443 cert=~/.config/lxc/client.crt key=~/.config/lxc/client.key verify_cert=False src_remote_addr=https://srv01:8443
 
+            # Same with a pre-copy while phpmyadmin keeps running
+            salt '*' lxd.container_migrate phpmyadmin stop_and_start=true incremental=true remote_addr=https://srv02:8443 cert=~/.config/lxc/client.crt key=~/.config/lxc/client.key verify_cert=False src_remote_addr=https://srv01:8443
+
     # noqa
     '''
     if src_cert is None:
@@ -1196,40 +1633,387 @@ def container_migrate(name,
         remote_addr, cert, key, verify_cert
     )
 
-    for pname in container.profiles:
-        try:
-            dest_client.profiles.get(pname)
-        except pylxd.exceptions.LXDAPIException:
+    if preflight:
+        report = _migrate_preflight(
+            [container], {}, dest_client
+        )['containers'][name]
+        if not report['ready']:
             raise SaltInvocationError(
-                'not all the profiles from the source exist on the target'
+                'Container "{0}" is not ready for migration: {1}'.format(
+                    name, '; '.join(report['errors'])
+                )
             )
 
     was_running = container.status_code == CONTAINER_STATUS_RUNNING
-    if stop_and_start and was_running:
-        container.stop(wait=True)
 
-    try:
-        dest_container = container.migrate(dest_client, wait=True)
-        dest_container.profiles = container.profiles
-        dest_container.save()
-    except pylxd.exceptions.LXDAPIException as e:
-        raise CommandExecutionError(six.text_type(e))
+    if incremental and was_running:
+        if not stop_and_start:
+            raise SaltInvocationError(
+                'An incremental migration requires stop_and_start=True'
+            )
 
-    # Remove the source container
-    container.delete(wait=True)
+        with _TransferSlots([src_remote_addr, remote_addr]) as slots:
+            progress = _TransferProgress(slots)
+            dest_container, migration, stopped_at = \
+                _container_migrate_incremental(
+                    container, dest_client, progress
+                )
+        migration['transfer'] = progress.as_dict()
+    else:
+        migration = {'mode': 'full', 'precopy': 0}
+
+        with _TransferSlots([src_remote_addr, remote_addr]) as slots:
+            progress = _TransferProgress(slots)
+
+            stopped_at = time.time()
+            if stop_and_start and was_running:
+                container.stop(wait=True)
+
+            dest_container = _container_copy(
+                container, dest_client, progress=progress
+            )
+        migration['transfer'] = progress.as_dict()
 
     if stop_and_start and was_running:
         dest_container.start(wait=True)
+        migration['downtime'] = round(time.time() - stopped_at, 3)
+    else:
+        migration['downtime'] = 0
 
-    return _pylxd_model_to_dict(dest_container)
+    # Remove the source container, its stopped already
+    # so this doesn't count into the downtime.
+    container.delete(wait=True)
 
+    result = _pylxd_model_to_dict(dest_container)
+    result['migration'] = migration
+    return result
 
-def container_config_get(name, config_key, remote_addr=None,
-                         cert=None, key=None, verify_cert=True):
-    '''
-    Get a container config value
 
-    name :
+def _container_migrate_incremental(container, dest_client, progress=None):
+    ''' Copies the running container to dest_client while it keeps running,
+        stops it and transfers the remaining difference with a refresh copy.
+
+        Returns a tuple of the (stopped) destination container,
+        a dict with the migration infos and the time the source
+        got stopped.
+
+        This is an internal method, no CLI Example.
+    '''
+    for client in (container.client, dest_client):
+        if ('container_incremental_copy' not in
+                client.host_info.get('api_extensions', [])):
+            raise CommandExecutionError(
+                ('The LXD at "{0}" doesn\'t support incremental copies, '
+                 'use a full migration instead.').format(
+                    client.api._api_endpoint)
+            )
+
+    started_at = time.time()
+    try:
+        # The snapshot is the common base between source and destination,
+        # on ZFS/btrfs the refresh sends only the delta since it.
+        container.snapshots.create(_precopy_snapshot_name, wait=True)
+        precopied = _container_copy(container, dest_client, progress=progress)
+    except pylxd.exceptions.LXDAPIException as e:
+        _snapshot_delete_quietly(container, _precopy_snapshot_name)
+        raise CommandExecutionError(six.text_type(e))
+    except (CommandExecutionError, SaltInvocationError):
+        _snapshot_delete_quietly(container, _precopy_snapshot_name)
+        raise
+
+    precopy = time.time() - started_at
+    log.debug((
+        'Pre-copied the container "{0}" in {1:.3f} seconds'
+    ).format(container.name, precopy))
+
+    stopped_at = time.time()
+    stopped = False
+    try:
+        try:
+            container.stop(wait=True)
+        except pylxd.exceptions.LXDAPIException as e:
+            raise CommandExecutionError(six.text_type(e))
+        stopped = True
+        dest_container = _container_copy(
+            container, dest_client, refresh=True, progress=progress
+        )
+    except CommandExecutionError:
+        # Leave both sides as we found them, else the next run takes
+        # the stale pre-copy for a finished migration.
+        try:
+            precopied.delete(wait=True)
+        except pylxd.exceptions.LXDAPIException as e:
+            log.warning('Failed to delete the pre-copy of "{0}": {1}'.format(
+                container.name, six.text_type(e)
+            ))
+        _snapshot_delete_quietly(container, _precopy_snapshot_name)
+        if stopped:
+            container.start(wait=True)
+        raise
+
+    _snapshot_delete_quietly(dest_container, _precopy_snapshot_name)
+
+    migration = {'mode': 'incremental', 'precopy': round(precopy, 3)}
+    return (dest_container, migration, stopped_at)
+
+
+def container_migrate_preflight(names=None,
+                                remote_addr=None,
+                                cert=None,
+                                key=None,
+                                verify_cert=True,
+                                src_remote_addr=None,
+                                src_cert=None,
+                                src_key=None,
+                                src_verify_cert=None):
+    ''' Checks if one or many containers are ready to get migrated,
+        without changing anything.
+
+        The destination gets asked in a single batch for its profiles,
+        storage pools (with their free space), networks and containers,
+        the result is a readiness report like:
+
+        .. code-block:: python
+
+            {'ready': False,
+             'destination': {'profiles': ['default'],
+                             'storage_pools': {'default': {'total': ...,
+                                                           'used': ...}},
+                             'networks': ['lxdbr0']},
+             'containers': {'phpmyadmin': {'ready': False,
+                                           'exists': False,
+                                           'size': 1234567,
+                                           'missing_profiles': ['autostart'],
+                                           'missing_storage_pools': [],
+                                           'missing_networks': [],
+                                           'errors': ['...']}}}
+
+        names :
+            A container name or a list of names,
+            None checks all containers of the source.
+
+        remote_addr :
+            An URL to the destination remote Server, you also have to give
+            cert and key if you provide remote_addr and its a TCP Address!
+
+            Examples:
+                https://myserver.lan:8443
+                /var/lib/mysocket.sock
+
+        cert :
+            PEM Formatted SSL Certificate.
+
+            Examples:
+                ~/.config/lxc/client.crt
+
+        key :
+            PEM Formatted SSL Key.
+
+            Examples:
+                ~/.config/lxc/client.key
+
+        verify_cert : True
+            Wherever to verify the cert, this is by default True
+            but in the most cases you want to set it off as LXD
+            normaly uses self-signed certificates.
+
+        src_remote_addr :
+            An URL to the source remote Server
+
+        src_cert :
+            PEM Formatted SSL Certificate for the source,
+            if None we copy "cert"
+
+        src_key :
+            PEM Formatted SSL Key for the source, if None we copy "key"
+
+        src_verify_cert :
+            Wherever to verify the cert, if None we copy "verify_cert"
+
+        CLI Example:
+
+        .. code-block:: bash
+
+            # Dry run for all containers on srv01
+            salt '*' lxd.container_migrate_preflight remote_addr=https://srv02:8443 cert=~/.config/lxc/client.crt key=~/.config/lxc/client.key verify_cert=False src_remote_addr=https://srv01:8443
+
+    # noqa
+    '''
+    if src_cert is None:
+        src_cert = cert
+
+    if src_key is None:
+        src_key = key
+
+    if src_verify_cert is None:
+        src_verify_cert = verify_cert
+
+    src_client = pylxd_client_get(
+        src_remote_addr, src_cert, src_key, src_verify_cert
+    )
+    dest_client = pylxd_client_get(
+        remote_addr, cert, key, verify_cert
+    )
+
+    if isinstance(names, six.string_types):
+        names = [names]
+
+    missing = []
+    if names is not None and len(names) == 1:
+        # No need to fetch the whole inventory for one container.
+        containers, states = [], {}
+        try:
+            containers.append(src_client.containers.get(names[0]))
+        except pylxd.exceptions.LXDAPIException:
+            missing.append(names[0])
+    else:
+        containers, states = _pylxd_containers_with_state(src_client)
+
+    if names is not None and len(names) > 1:
+        found = dict([(c.name, c) for c in containers])
+        missing = [n for n in names if n not in found]
+        containers = [found[n] for n in names if n in found]
+
+    return _migrate_preflight(containers, states, dest_client, missing)
+
+
+def _migrate_preflight(containers, states, dest_client, missing=()):
+    ''' Builds the readiness report for moving containers to dest_client.
+
+        containers :
+            A list of pylxd containers
+
+        states :
+            A dict of container name -> state dict,
+            containers not in it get their state fetched.
+
+        missing :
+            Names of the requested containers not found on the source.
+
+        This is an internal method, no CLI Example.
+    '''
+    extensions = dest_client.host_info.get('api_extensions', [])
+
+    def _names(api_node):
+        return [u.split('/')[-1] for u in api_node.get().json()['metadata']]
+
+    try:
+        destination = {
+            'profiles': _names(dest_client.api.profiles),
+            'containers': _names(dest_client.api.containers),
+            'networks': None,
+            'storage_pools': None,
+        }
+        if 'network' in extensions:
+            destination['networks'] = _names(dest_client.api.networks)
+
+        if 'storage' in extensions:
+            destination['storage_pools'] = {}
+            for pool in _names(dest_client.api.storage_pools):
+                space = {}
+                if 'resources' in extensions:
+                    space = dest_client.api.storage_pools[
+                        pool].resources.get().json()['metadata']['space']
+                destination['storage_pools'][pool] = space
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
+
+    # Bytes we plan to put on each destination pool.
+    planned = {}
+
+    report = {'ready': True, 'destination': destination, 'containers': {}}
+    for container in containers:
+        errors = []
+        item = {
+            'exists': container.name in destination['containers'],
+            'size': None,
+            'missing_profiles': [
+                p for p in container.profiles
+                if p not in destination['profiles']
+            ],
+            'missing_storage_pools': [],
+            'missing_networks': [],
+        }
+        if item['exists']:
+            errors.append('Container exists on the destination')
+        if item['missing_profiles']:
+            errors.append('Missing profiles: {0}'.format(
+                ', '.join(item['missing_profiles'])
+            ))
+
+        state = states.get(container.name)
+        if state is None:
+            try:
+                state = container.api.state.get().json()['metadata']
+            except pylxd.exceptions.LXDAPIException as e:
+                raise CommandExecutionError(six.text_type(e))
+        disk = (state or {}).get('disk') or {}
+        item['size'] = disk.get('root', {}).get('usage')
+
+        for dname, device in six.iteritems(container.expanded_devices):
+            if device.get('type') == 'nic':
+                network = device.get('network', device.get('parent'))
+                if (network and destination['networks'] is not None and
+                        network not in destination['networks']):
+                    item['missing_networks'].append(network)
+
+            elif (device.get('type') == 'disk' and device.get('path') == '/'
+                    and device.get('pool')):
+                pool = device['pool']
+                if destination['storage_pools'] is None:
+                    continue
+                if pool not in destination['storage_pools']:
+                    item['missing_storage_pools'].append(pool)
+                    continue
+
+                space = destination['storage_pools'][pool]
+                planned[pool] = planned.get(pool, 0) + (item['size'] or 0)
+                if ('total' in space and
+                        space['total'] - space.get('used', 0) <
+                        planned[pool]):
+                    errors.append(
+                        'Not enough space on the storage pool "{0}"'.format(
+                            pool
+                        )
+                    )
+
+        if item['missing_networks']:
+            errors.append('Missing networks: {0}'.format(
+                ', '.join(item['missing_networks'])
+            ))
+        if item['missing_storage_pools']:
+            errors.append('Missing storage pools: {0}'.format(
+                ', '.join(item['missing_storage_pools'])
+            ))
+
+        item['errors'] = errors
+        item['ready'] = not errors
+        if errors:
+            report['ready'] = False
+        report['containers'][container.name] = item
+
+    for name in missing:
+        report['ready'] = False
+        report['containers'][name] = {
+            'ready': False,
+            'exists': name in destination['containers'],
+            'size': None,
+            'missing_profiles': [],
+            'missing_storage_pools': [],
+            'missing_networks': [],
+            'errors': ['Container not found on the source'],
+        }
+
+    del destination['containers']
+    return report
+
+
+def container_config_get(name, config_key, remote_addr=None,
+                         cert=None, key=None, verify_cert=True):
+    '''
+    Get a container config value
+
+    name :
         Name of the container
 
     config_key :
@@ -1305,12 +2089,12 @@ def container_config_set(name, config_key, config_value, remote_addr=None,
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
     '''
-    container = container_get(
-        name, remote_addr, cert, key, verify_cert, _raw=True
+    container, base = _pylxd_object_get(
+        'containers', name, remote_addr, cert, key, verify_cert
     )
 
     return _set_property_dict_item(
-        container, 'config', config_key, config_value
+        container, 'config', config_key, config_value, base
     )
 
 
@@ -1350,12 +2134,68 @@ def container_config_delete(name, config_key, remote_addr=None,
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
     '''
-    container = container_get(
-        name, remote_addr, cert, key, verify_cert, _raw=True
+    container, base = _pylxd_object_get(
+        'containers', name, remote_addr, cert, key, verify_cert
     )
 
     return _delete_property_dict_item(
-        container, 'config', config_key
+        container, 'config', config_key, base
+    )
+
+
+def container_config_set_many(name, config=None, delete=None,
+                              remote_addr=None,
+                              cert=None, key=None, verify_cert=True):
+    '''
+    Set and delete several container config values with one fetch
+    and one save
+
+    name :
+        Name of the container
+
+    config :
+        A dict of config keys and the values to set
+
+    delete :
+        A list of config keys to delete, missing keys get ignored
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.container_config_set_many <container name> config="{limits.cpu: 2, limits.memory: 2GB}" delete="[boot.autostart]"
+    '''
+    container, base = _pylxd_object_get(
+        'containers', name, remote_addr, cert, key, verify_cert
+    )
+
+    return _set_property_dict_items(
+        container, 'config', config, delete, base
     )
 
 
@@ -1446,13 +2286,13 @@ def container_device_add(name, device_name, device_type='disk',
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
     '''
-    container = container_get(
-        name, remote_addr, cert, key, verify_cert, _raw=True
+    container, base = _pylxd_object_get(
+        'containers', name, remote_addr, cert, key, verify_cert
     )
 
     kwargs['type'] = device_type
     return _set_property_dict_item(
-        container, 'devices', device_name, kwargs
+        container, 'devices', device_name, kwargs, base
     )
 
 
@@ -1492,19 +2332,77 @@ def container_device_delete(name, device_name, remote_addr=None,
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
     '''
-    container = container_get(
-        name, remote_addr, cert, key, verify_cert, _raw=True
+    container, base = _pylxd_object_get(
+        'containers', name, remote_addr, cert, key, verify_cert
     )
 
     return _delete_property_dict_item(
-        container, 'devices', device_name
+        container, 'devices', device_name, base
+    )
+
+
+def container_devices_set_many(name, devices=None, delete=None,
+                               remote_addr=None,
+                               cert=None, key=None, verify_cert=True):
+    '''
+    Set and delete several container devices with one fetch and one save
+
+    name :
+        Name of the container
+
+    devices :
+        A dict of device names and their devices (dicts with
+        a "type" and the additional device args)
+
+    delete :
+        A list of device names to delete, missing devices get ignored
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.container_devices_set_many <container name> devices="{www: {type: disk, source: /srv/www, path: /var/www}}" delete="[eth1]"
+    '''
+    container, base = _pylxd_object_get(
+        'containers', name, remote_addr, cert, key, verify_cert
+    )
+
+    return _set_property_dict_items(
+        container, 'devices', _devices_text(devices), delete, base
     )
 
 
 def container_file_put(name, src, dst, recursive=False, overwrite=False,
                        mode=None, uid=None, gid=None, saltenv='base',
                        remote_addr=None,
-                       cert=None, key=None, verify_cert=True):
+                       cert=None, key=None, verify_cert=True,
+                       transport='auto', compress=False, workers=8,
+                       retries=2):
     '''
     Put a file into a container
 
@@ -1557,11 +2455,41 @@ def container_file_put(name, src, dst, recursive=False, overwrite=False,
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
 
+    transport : auto
+        How to copy a directory (recursive=True):
+
+        tar
+            Stream a tar archive of it into "tar -x" in the container,
+            the container has to run and have tar. Mode, uid and gid
+            of the source files are kept unless given.
+
+        files
+            One request per file, workers at once.
+
+        auto
+            tar when possible, else files.
+
+    compress : False
+        gzip the tar stream
+
+    workers : 8
+        Parallel requests of the files transport, the directories
+        get created first.
+
+    retries : 2
+        Retry a file which failed with the files transport that
+        often, with a growing pause between the tries.
+
+    Files get streamed in chunks, returns a dict with the number of
+    files and bytes transferred, the duration, the rates (bytes/s,
+    MB/s and files/s) and the number of retries.
+
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' lxd.container_file_put <container name> /var/tmp/foo /var/tmp/
+        salt '*' lxd.container_file_put <container name> /srv/www /var/ recursive=True compress=True
 
     '''
     # Possibilities:
@@ -1578,9 +2506,15 @@ def container_file_put(name, src, dst, recursive=False, overwrite=False,
     # Fix mode. Salt commandline doesn't use octals, so 0600 will be
     # the decimal integer 600 (and not the octal 0600). So, it it's
     # and integer, handle it as if it where a octal representation.
-    mode = six.text_type(mode)
-    if not mode.startswith('0'):
-        mode = '0{0}'.format(mode)
+    if mode is not None:
+        mode = six.text_type(mode)
+        if not mode.startswith('0'):
+            mode = '0{0}'.format(mode)
+
+    if transport not in ('auto', 'tar', 'files'):
+        raise SaltInvocationError(
+            "transport must be one of 'auto', 'tar' or 'files'"
+        )
 
     container = container_get(
         name, remote_addr, cert, key, verify_cert, _raw=True
@@ -1613,35 +2547,20 @@ def container_file_put(name, src, dst, recursive=False, overwrite=False,
              "without recursive flag set to true!")
         )
 
-    try:
-        dst_is_directory = False
-        container.files.get(os.path.join(dst, '.'))
-    except pylxd.exceptions.NotFound:
-        pass
-    except pylxd.exceptions.LXDAPIException as why:
-        if six.text_type(why).find('Is a directory') >= 0:
-            dst_is_directory = True
+    # Everything we need to know about the destination in one call
+    dst_in_dir = os.path.join(dst, os.path.basename(src))
+    dst_parent = os.path.dirname(dst.rstrip(os.sep)) or os.sep
+    probes = _container_file_stat(container, [dst, dst_in_dir, dst_parent])
+    dst_is_directory = probes[dst]['type'] == 'directory'
 
     if os.path.isfile(src):
         # Source is a file
         if dst_is_directory:
-            dst = os.path.join(dst, os.path.basename(src))
-            if not overwrite:
-                found = True
-                try:
-                    container.files.get(os.path.join(dst))
-                except pylxd.exceptions.NotFound:
-                    found = False
-                except pylxd.exceptions.LXDAPIException as why:
-                    if six.text_type(why).find('not found') >= 0:
-                        # Old version of pylxd
-                        found = False
-                    else:
-                        raise
-                if found:
-                    raise SaltInvocationError(
-                        "Destination exists and overwrite is false"
-                    )
+            dst = dst_in_dir
+            if not overwrite and probes[dst_in_dir]['exists']:
+                raise SaltInvocationError(
+                    "Destination exists and overwrite is false"
+                )
         if mode is not None or uid is not None or gid is not None:
             # Need to get file stats
             stat = os.stat(src)
@@ -1652,12 +2571,13 @@ def container_file_put(name, src, dst, recursive=False, overwrite=False,
             if gid is None:
                 gid = stat.st_gid
 
+        stats = _FileTransferStats()
         with salt.utils.fopen(src, 'rb') as src_fp:
             container.files.put(
-                dst, src_fp.read(),
+                dst, stats.chunks(src_fp),
                 mode=mode, uid=uid, gid=gid
             )
-        return True
+        return stats.as_dict()
     elif not os.path.isdir(src):
         raise SaltInvocationError(
             "Source is neither file nor directory"
@@ -1673,18 +2593,13 @@ def container_file_put(name, src, dst, recursive=False, overwrite=False,
         # Destination is not a directory and doesn't end with '/'
         # Check that the parent directory of dst exists
         # and is a directory
-        try:
-            container.files.get(os.path.join(os.path.dirname(dst), '.'))
-        except pylxd.exceptions.NotFound:
-            pass
-        except pylxd.exceptions.LXDAPIException as why:
-            if six.text_type(why).find('Is a directory') >= 0:
-                dst_is_directory = True
-                # destination is non-existent
-                # cp -r /src/dir1 /scr/dir1
-                # cp -r /src/dir1 /scr/dir2
-                idx = len(src)
-                overwrite = True
+        if probes[dst_parent]['type'] == 'directory':
+            dst_is_directory = True
+            # destination is non-existent
+            # cp -r /src/dir1 /scr/dir1
+            # cp -r /src/dir1 /scr/dir2
+            idx = len(src)
+            overwrite = True
 
     # Copy src directory recursive
     if not overwrite:
@@ -1692,18 +2607,34 @@ def container_file_put(name, src, dst, recursive=False, overwrite=False,
             "Destination exists and overwrite is false"
         )
 
-    # Collect all directories first, to create them in one call
-    # (for performance reasons)
+    if transport != 'files':
+        if (container.status_code == CONTAINER_STATUS_RUNNING and
+                _container_execute_raw(
+                    container, ['sh', '-c', 'command -v tar']
+                )['result']):
+            stats = _FileTransferStats()
+            _container_put_tar(
+                container, src, idx, dst, mode, uid, gid, compress, stats
+            )
+            return stats.as_dict()
+
+        if transport == 'tar':
+            raise CommandExecutionError(
+                'The tar transport needs a running container with tar'
+            )
+
+    # Collect all directories first, to create them before the
+    # uploads start (for performance reasons)
     dstdirs = []
     for path, _, files in os.walk(src):
         dstdir = os.path.join(dst, path[idx:].lstrip(os.path.sep))
-        dstdirs.append(dstdir)
-    container.execute(['mkdir', '-p'] + dstdirs)
+        dstdirs.append(dstdir.rstrip(os.path.sep) or os.path.sep)
+    _container_mkdirs(container, dstdirs)
 
     set_mode = mode
     set_uid = uid
     set_gid = gid
-    # Now transfer the files
+    uploads = []
     for path, _, files in os.walk(src):
         dstdir = os.path.join(dst, path[idx:].lstrip(os.path.sep))
         for name in files:
@@ -1720,38 +2651,26 @@ def container_file_put(name, src, dst, recursive=False, overwrite=False,
                 if gid is None:
                     set_gid = stat.st_gid
 
-            with salt.utils.fopen(src_name, 'rb') as src_fp:
-                container.files.put(
-                    dst_name, src_fp.read(),
-                    mode=set_mode, uid=set_uid, gid=set_gid
-                )
+            uploads.append((src_name, dst_name, set_mode, set_uid, set_gid))
 
-    return True
+    # Now transfer the files
+    stats = _FileTransferStats()
+    _container_put_files(container, uploads, stats, workers, retries)
 
+    return stats.as_dict()
 
-def container_file_get(name, src, dst, overwrite=False,
-                       mode=None, uid=None, gid=None, remote_addr=None,
-                       cert=None, key=None, verify_cert=True):
+
+def container_file_stat(name, paths, remote_addr=None, cert=None,
+                        key=None, verify_cert=True):
     '''
-    Get a file from a container
+    Stat many paths in a container with one exec, or when the container
+    doesn't run, with header only requests to the files API.
 
     name :
         Name of the container
 
-    src :
-        The source file or directory
-
-    dst :
-        The destination file or directory
-
-    mode :
-        Set file mode to octal number
-
-    uid :
-        Set file uid (owner)
-
-    gid :
-        Set file gid (group)
+    paths :
+        A list of paths (or a single path)
 
     remote_addr :
         An URL to a remote Server, you also have to give cert and key if
@@ -1778,8 +2697,106 @@ def container_file_get(name, src, dst, overwrite=False,
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
 
-    '''
-    # Fix mode. Salt commandline doesn't use octals, so 0600 will be
+    Returns a dict path -> {exists, type, size, mode, uid, gid}, type is
+    one of "file", "directory", "symlink" or "other", size is None
+    without exec.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.container_file_stat <container name> '["/etc/hosts", "/etc"]'
+    '''
+    if isinstance(paths, six.string_types):
+        paths = [paths]
+
+    container = container_get(
+        name, remote_addr, cert, key, verify_cert, _raw=True
+    )
+    return _container_file_stat(container, paths)
+
+
+def container_file_get(name, src, dst, overwrite=False,
+                       mode=None, uid=None, gid=None, remote_addr=None,
+                       cert=None, key=None, verify_cert=True,
+                       recursive=False, transport='auto', workers=8):
+    '''
+    Get a file from a container
+
+    name :
+        Name of the container
+
+    src :
+        The source file or directory
+
+    dst :
+        The destination file or directory
+
+    mode :
+        Set file mode to octal number
+
+    uid :
+        Set file uid (owner)
+
+    gid :
+        Set file gid (group)
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    recursive : False
+        Get a directory recursive
+
+    transport : auto
+        How to get a directory:
+
+        tar
+            Stream a tar archive out of the container,
+            the container has to run and have tar.
+
+        files
+            One request per file, workers at once.
+
+        auto
+            tar when possible, else files.
+
+    workers : 8
+        Parallel requests of the files transport
+
+    Files get streamed to disk in chunks, returns a dict with the number
+    of files and bytes transferred, the duration and the rate (bytes/s).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.container_file_get <container name> /var/log/syslog /tmp/
+        salt '*' lxd.container_file_get <container name> /var/crash /srv/crashes recursive=True
+
+    '''
+    # Fix mode. Salt commandline doesn't use octals, so 0600 will be
     # the decimal integer 600 (and not the octal 0600). So, it it's
     # and integer, handle it as if it where a octal representation.
 
@@ -1789,6 +2806,11 @@ def container_file_get(name, src, dst, overwrite=False,
         if not mode.startswith('0'):
             mode = '0{0}'.format(mode)
 
+    if transport not in ('auto', 'tar', 'files'):
+        raise SaltInvocationError(
+            "transport must be one of 'auto', 'tar' or 'files'"
+        )
+
     container = container_get(
         name, remote_addr, cert, key, verify_cert, _raw=True
     )
@@ -1797,36 +2819,87 @@ def container_file_get(name, src, dst, overwrite=False,
     if not os.path.isabs(dst):
         raise SaltInvocationError('File path must be absolute.')
 
-    if os.path.isdir(dst):
-        dst = os.path.join(dst, os.path.basename(src))
-    elif not os.path.isdir(os.path.dirname(dst)):
-        raise SaltInvocationError(
-            "Parent directory for destination doesn't exist."
+    src = src.rstrip('/') or '/'
+    try:
+        response = container.api.files.get(
+            params={'path': src}, stream=True
         )
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
 
-    if os.path.exists(dst):
-        if not overwrite:
+    if response.headers.get('X-LXD-type') == 'directory':
+        response.close()
+        if not recursive:
             raise SaltInvocationError(
-                'Destination exists and overwrite is false.'
+                'Source is a directory and recursive is false.'
             )
-        if not os.path.isfile(dst):
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        elif not os.path.isdir(os.path.dirname(dst)):
             raise SaltInvocationError(
-                'Destination exists but is not a file.'
+                "Parent directory for destination doesn't exist."
             )
-    else:
-        dst_path = os.path.dirname(dst)
-        if not os.path.isdir(dst_path):
-            raise CommandExecutionError(
-                'No such file or directory \'{0}\''.format(dst_path)
+        if os.path.exists(dst) and not overwrite:
+            raise SaltInvocationError(
+                'Destination exists and overwrite is false.'
+            )
+
+        stats = _FileTransferStats()
+        if transport != 'files':
+            if (container.status_code == CONTAINER_STATUS_RUNNING and
+                    _container_execute_raw(
+                        container, ['sh', '-c', 'command -v tar']
+                    )['result']):
+                _container_get_tar(container, src, dst, stats)
+                _chmod_chown_tree(dst, mode, uid, gid)
+                return stats.as_dict()
+
+            if transport == 'tar':
+                raise CommandExecutionError(
+                    'The tar transport needs a running container with tar'
+                )
+
+        _container_get_files(container, src, dst, workers, stats)
+        _chmod_chown_tree(dst, mode, uid, gid)
+        return stats.as_dict()
+
+    stats = _FileTransferStats()
+    try:
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        elif not os.path.isdir(os.path.dirname(dst)):
+            raise SaltInvocationError(
+                "Parent directory for destination doesn't exist."
             )
-        # Seems to be duplicate of line 1794, produces /path/file_name/file_name
-        #dst = os.path.join(dst, os.path.basename(src))
 
-    with salt.utils.fopen(dst, 'wb') as df:
-        df.write(container.files.get(src))
+        if os.path.exists(dst):
+            if not overwrite:
+                raise SaltInvocationError(
+                    'Destination exists and overwrite is false.'
+                )
+            if not os.path.isfile(dst):
+                raise SaltInvocationError(
+                    'Destination exists but is not a file.'
+                )
+        else:
+            dst_path = os.path.dirname(dst)
+            if not os.path.isdir(dst_path):
+                raise CommandExecutionError(
+                    'No such file or directory \'{0}\''.format(dst_path)
+                )
+            # Seems to be duplicate of line 1794, produces /path/file_name/file_name
+            #dst = os.path.join(dst, os.path.basename(src))
+
+        with salt.utils.fopen(dst, 'wb') as df:
+            for chunk in response.iter_content(_upload_chunk_size):
+                df.write(chunk)
+                stats.add(len(chunk))
+        stats.add(0, files=1)
+    finally:
+        response.close()
 
     if mode:
-        os.chmod(dst, mode)
+        os.chmod(dst, int(mode, 8))
     if uid or uid is '0':
         uid = int(uid)
     else:
@@ -1837,11 +2910,198 @@ def container_file_get(name, src, dst, overwrite=False,
         gid = -1
     if uid != -1 or gid != -1:
         os.chown(dst, uid, gid)
-    return True
+    return stats.as_dict()
+
+
+def container_file_sync(name, src, dst, delete=False, mode=None, uid=None,
+                        gid=None, saltenv='base', test=False, workers=8,
+                        remote_addr=None, cert=None, key=None,
+                        verify_cert=True):
+    '''
+    Sync a file or directory into a container, only files whose
+    sha256, size or mode differ get transferred.
+
+    The container side manifest gets computed in one exec (only files
+    with the same size get hashed), so the container has to run.
+
+    name :
+        Name of the container
+
+    src :
+        The source file or directory, local or salt://
+
+    dst :
+        The destination file or directory, a directory gets synced
+        as dst (not below it).
+
+    delete : False
+        Delete files in dst which are not in src, this is a no-op
+        when src is a single file.
+
+    mode :
+        Set file mode to octal number, default is the mode of the source
+
+    uid :
+        Set file uid (owner)
+
+    gid :
+        Set file gid (group)
+
+    saltenv : base
+        The saltenv to fetch salt:// sources from
+
+    test : False
+        Only report what would change
+
+    workers : 8
+        Parallel uploads
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    Returns a dict with the "uploaded", "chmod" and "deleted" paths,
+    the number of "unchanged" files and the "transfer" stats.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.container_file_sync <container name> salt://nginx/conf /etc/nginx delete=True
+    '''
+    if mode is not None:
+        mode = six.text_type(mode)
+        if not mode.startswith('0'):
+            mode = '0{0}'.format(mode)
+
+    container = container_get(
+        name, remote_addr, cert, key, verify_cert, _raw=True
+    )
+    if container.status_code != CONTAINER_STATUS_RUNNING:
+        raise CommandExecutionError(
+            'Container "{0}" is not running'.format(name)
+        )
+
+    src_root, sources = _file_sync_sources(src, dst, saltenv)
+    if src_root is None:
+        # A single file, never delete its siblings in dst_root
+        dst_root = os.path.dirname(dst.rstrip('/')) or '/'
+        delete = False
+    else:
+        dst_root = dst.rstrip('/') or '/'
+
+    local = _local_manifest(sources)
+    # A record can hold thousands of files.
+    records = _ManifestCache('containers', max_entries=500)
+    record_key = '|'.join(
+        (six.text_type(remote_addr), name, dst_root)
+    )
+    record = records.get(record_key) or {}
+    remote, remote_files = _remote_manifest(
+        container, dst_root, local, record, delete
+    )
+
+    ret = {'uploaded': [], 'chmod': [], 'deleted': [], 'unchanged': 0}
+    uploads = []
+    chmods = []
+    for path, entry in sorted(six.iteritems(local)):
+        want_mode = mode or entry['mode']
+        have = remote.get(path)
+        full_path = _sync_join(dst_root, path)
+        if (have is None or have['size'] != entry['size'] or
+                have['sha256'] != entry['sha256']):
+            uploads.append((entry['path'], full_path, want_mode))
+            ret['uploaded'].append(full_path)
+        elif int(have['mode'], 8) != int(want_mode, 8):
+            chmods.append((want_mode, full_path))
+            ret['chmod'].append(full_path)
+        else:
+            ret['unchanged'] += 1
+
+    deletes = []
+    if delete:
+        deletes = sorted(set(remote_files) - set(local))
+        ret['deleted'] = [_sync_join(dst_root, p) for p in deletes]
+
+    stats = _FileTransferStats()
+    if test:
+        ret['transfer'] = stats.as_dict()
+        return ret
+
+    # Directories, modes and deletions in one exec
+    script = []
+    dirs = sorted(set(os.path.dirname(u[1]) for u in uploads))
+    if dirs:
+        script.append('mkdir -p ' + ' '.join(shlex_quote(d) for d in dirs))
+    for want_mode, full_path in chmods:
+        script.append('chmod {0} {1}'.format(want_mode, shlex_quote(full_path)))
+    for path in ret['deleted']:
+        script.append('rm -f ' + shlex_quote(path))
+    if script:
+        result = _container_execute_stream(
+            container, ['sh', '-e'], None, 4096,
+            stdin='\n'.join(script) + '\n'
+        )
+        if not result['result']:
+            raise CommandExecutionError(
+                'Syncing "{0}" failed: {1}'.format(dst, result['stderr'])
+            )
+
+    _container_put_files(
+        container,
+        [(src_name, dst_name, want_mode, uid, gid)
+         for src_name, dst_name, want_mode in uploads],
+        stats, workers
+    )
+
+    # Remember what's in the container now, uploaded files have
+    # a new mtime and inode and get hashed once on the next run.
+    uploaded = set(u[1] for u in uploads)
+    record = {}
+    for path, entry in six.iteritems(local):
+        have = {}
+        if _sync_join(dst_root, path) not in uploaded:
+            have = remote.get(path, {})
+        record[path] = {
+            'size': entry['size'],
+            'sha256': entry['sha256'],
+            'mtime': have.get('mtime'),
+            'inode': have.get('inode'),
+        }
+    records.set(record_key, record)
+    records.save()
+
+    ret['transfer'] = stats.as_dict()
+    return ret
 
 
 def container_execute(name, cmd, remote_addr=None,
-                      cert=None, key=None, verify_cert=True):
+                      cert=None, key=None, verify_cert=True,
+                      stream=False, head_bytes=65536, tail_bytes=65536,
+                      output_file=None, line_callback=None,
+                      environment=None, cwd=None, user=None, group=None,
+                      stdin=None, timeout=None):
     '''
     Execute a command list on a container.
 
@@ -1879,16 +3139,123 @@ def container_execute(name, cmd, remote_addr=None,
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
 
+    stream : False
+        Read the output incrementally from the exec websockets instead
+        of buffering it whole, only the first head_bytes and the last
+        tail_bytes of stdout and stderr are returned.
+        Implied by output_file and line_callback.
+
+    head_bytes : 65536
+        Bytes to keep from the start of each stream, None for all.
+
+    tail_bytes : 65536
+        Bytes to keep from the end of each stream.
+
+    output_file : None
+        Write the complete stdout and stderr to this file on the minion.
+
+    line_callback : None
+        A callable which gets called with ("stdout"|"stderr", line)
+        for every line of output (Python callers only).
+
+    environment : None
+        A dict of environment variables for the command
+
+    cwd : None
+        The working directory of the command
+
+    user : None
+        The uid to run the command as
+
+    group : None
+        The gid to run the command as
+
+        cwd, user and group need the LXD API extension
+        "container_exec_user_group_cwd".
+
+    stdin : None
+        Data to feed to the command on stdin, a string or
+        (Python callers only) a file object.
+
+    timeout : None
+        Kill the command with SIGKILL after this many seconds,
+        the result gets "timed_out": True.
+
     CLI Example:
 
     .. code-block:: bash
 
         salt '*' lxd.container_execute <container name> '["ls", "-l"]'
+        salt '*' lxd.container_execute <container name> '["apt-get", "-y", "upgrade"]' stream=True output_file=/var/log/upgrade.log
+        salt '*' lxd.container_execute <container name> '["sh"]' stdin='echo $FOO' environment='{"FOO": "bar"}' timeout=10
 
     '''
     container = container_get(
         name, remote_addr, cert, key, verify_cert, _raw=True
     )
+
+    exec_kwargs = dict(
+        environment=environment, cwd=cwd, user=user, group=group,
+        stdin=stdin, timeout=timeout
+    )
+    if not (stream or output_file or line_callback):
+        if all(v is None for v in exec_kwargs.values()):
+            return _container_execute_raw(container, cmd)
+        # Keep the whole output, like without the options.
+        head_bytes = None
+
+    return _container_execute_stream(
+        container, cmd, head_bytes, tail_bytes,
+        output_file, line_callback, **exec_kwargs
+    )
+
+
+def _container_execute_stream(container, cmd, head_bytes=65536,
+                              tail_bytes=65536, output_file=None,
+                              line_callback=None, **exec_kwargs):
+    ''' Executes cmd on the pylxd container object with bounded
+        output buffers and returns the container_execute result dict,
+        exec_kwargs are passed to _container_exec.
+    '''
+    fp = None
+    if output_file is not None:
+        fp = salt.utils.fopen(os.path.expanduser(output_file), 'wb')
+
+    stdout = _BoundedOutput('stdout', head_bytes, tail_bytes, fp,
+                            line_callback)
+    stderr = _BoundedOutput('stderr', head_bytes, tail_bytes, fp,
+                            line_callback)
+    try:
+        exit_code, timed_out = _container_exec(
+            container, cmd, stdout.write, stderr.write, **exec_kwargs
+        )
+    finally:
+        stdout.flush()
+        stderr.flush()
+        if fp is not None:
+            fp.close()
+
+    saltresult = dict(
+        exit_code=exit_code,
+        stdout=stdout.text,
+        stderr=stderr.text,
+        stdout_bytes=stdout.total,
+        stderr_bytes=stderr.total,
+        truncated=stdout.truncated or stderr.truncated,
+        result=exit_code == 0 and not timed_out,
+    )
+    if timed_out:
+        saltresult['timed_out'] = True
+    if output_file is not None:
+        saltresult['output_file'] = output_file
+
+    return saltresult
+
+
+def _container_execute_raw(container, cmd):
+    ''' Executes cmd on the pylxd container object and returns
+        the container_execute result dict.
+    '''
     try:
         result = container.execute(cmd)
         saltresult = {}
@@ -1918,254 +3285,672 @@ def container_execute(name, cmd, remote_addr=None,
     return saltresult
 
 
-####################
-# Profile Management
-####################
-def profile_list(list_names=False, remote_addr=None,
-                 cert=None, key=None, verify_cert=True):
-    ''' Lists all profiles from the LXD.
+def container_execute_batch(name, cmds, stop_on_error=True,
+                            environment=None, cwd=None, user=None,
+                            group=None, timeout=None, remote_addr=None,
+                            cert=None, key=None, verify_cert=True):
+    '''
+    Execute many commands in a container through one shell process,
+    so the whole batch costs one exec operation.
 
-        list_names :
+    name :
+        Name of the container
 
-            Return a list of names instead of full blown dicts.
+    cmds :
+        A list of commands, each one a command list or a shell string.
 
-        remote_addr :
-            An URL to a remote Server, you also have to give cert and key if
-            you provide remote_addr and its a TCP Address!
+        Example :
+            '[["apt-get", "update"], "echo done > /tmp/done"]'
 
-            Examples:
-                https://myserver.lan:8443
-                /var/lib/mysocket.sock
+    stop_on_error : True
+        Don't run the remaining commands after one failed
 
-        cert :
-            PEM Formatted SSL Certificate.
+    environment : None
+        A dict of environment variables for the shell
 
-            Examples:
-                ~/.config/lxc/client.crt
+    cwd : None
+        The working directory of the shell
 
-        key :
-            PEM Formatted SSL Key.
+    user : None
+        The uid to run the shell as
 
-            Examples:
-                ~/.config/lxc/client.key
+    group : None
+        The gid to run the shell as
 
-        verify_cert : True
-            Wherever to verify the cert, this is by default True
-            but in the most cases you want to set it off as LXD
-            normaly uses self-signed certificates.
+    timeout : None
+        Kill the shell after this many seconds
 
-        CLI Examples:
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
 
-        .. code-block:: bash
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
 
-            salt '*' lxd.profile_list true --out=json
-            salt '*' lxd.profile_list --out=json
-    '''
+    cert :
+        PEM Formatted SSL Certificate.
 
-    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+        Examples:
+            ~/.config/lxc/client.crt
 
-    profiles = client.profiles.all()
-    if list_names:
-        return [p.name for p in profiles]
+    key :
+        PEM Formatted SSL Key.
 
-    return [_pylxd_model_to_dict(i) for i in profiles]
+        Examples:
+            ~/.config/lxc/client.key
 
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
 
-def profile_create(name, config=None, devices=None, description=None,
-                   remote_addr=None,
-                   cert=None, key=None, verify_cert=True):
-    ''' Creates a profile.
+    Returns a dict with the container_execute result of every command
+    which ran in "results".
 
-        name :
-            The name of the profile to get.
+    CLI Example:
 
-        config :
-            A config dict or None (None = unset).
+    .. code-block:: bash
 
-            Can also be a list:
-                [{'key': 'boot.autostart', 'value': 1},
-                 {'key': 'security.privileged', 'value': '1'}]
+        salt '*' lxd.container_execute_batch <container name> '[["hostname"], ["uptime"]]'
+    '''
+    container = container_get(
+        name, remote_addr, cert, key, verify_cert, _raw=True
+    )
 
-        devices :
-            A device dict or None (None = unset).
+    # Every command ends with a marker carrying its exit code
+    # on stdout and a marker on stderr.
+    token = hashlib.sha1(os.urandom(16)).hexdigest()[:16]
+    marker = '\x1esalt-{0}:'.format(token)
+    script = []
+    for idx, cmd in enumerate(cmds):
+        if not isinstance(cmd, six.string_types):
+            cmd = ' '.join(shlex_quote(six.text_type(c)) for c in cmd)
+        script.append('{0} </dev/null'.format(cmd))
+        script.append('rc=$?')
+        script.append("printf '\\036salt-{0}:{1}:%d\\n' $rc".format(
+            token, idx))
+        script.append("printf '\\036salt-{0}:{1}\\n' >&2".format(
+            token, idx))
+        if stop_on_error:
+            script.append('[ $rc -eq 0 ] || exit $rc')
+    script.append('exit 0')
+
+    result = _container_execute_stream(
+        container, ['sh'], None, 0,
+        environment=environment, cwd=cwd, user=user, group=group,
+        stdin='\n'.join(script) + '\n', timeout=timeout
+    )
 
-        description :
-            A description string or None (None = unset).
+    stdout_regex = re.compile(re.escape(marker) + r'(\d+):(\d+)\n')
+    stderr_regex = re.compile(re.escape(marker) + r'(\d+)\n')
+    stderrs = {}
+    pos = 0
+    for match in stderr_regex.finditer(result['stderr']):
+        stderrs[int(match.group(1))] = result['stderr'][pos:match.start()]
+        pos = match.end()
+
+    results = []
+    pos = 0
+    for match in stdout_regex.finditer(result['stdout']):
+        idx, exit_code = int(match.group(1)), int(match.group(2))
+        results.append({
+            'cmd': cmds[idx],
+            'exit_code': exit_code,
+            'stdout': result['stdout'][pos:match.start()],
+            'stderr': stderrs.get(idx, ''),
+            'result': exit_code == 0,
+        })
+        pos = match.end()
+
+    ret = {
+        'results': results,
+        'exit_code': result['exit_code'],
+        'result': (result['result'] and len(results) == len(cmds) and
+                   all(r['result'] for r in results)),
+    }
+    if result.get('timed_out'):
+        ret['timed_out'] = True
 
-        remote_addr :
-            An URL to a remote Server, you also have to give cert and key if
-            you provide remote_addr and its a TCP Address!
+    return ret
 
-            Examples:
-                https://myserver.lan:8443
-                /var/lib/mysocket.sock
 
-        cert :
-            PEM Formatted SSL Certificate.
+def exec_async(name, cmd, environment=None, cwd=None, user=None,
+               group=None, remote_addr=None, cert=None, key=None,
+               verify_cert=True):
+    '''
+    Start a command list in a container in the background and return
+    right away, the exit code and the output go to files below
+    /var/tmp in the container. Collect them with :mod:`exec_result
+    <salt.modules.lxd.exec_result>`.
 
-            Examples:
-                ~/.config/lxc/client.crt
+    name :
+        Name of the container
 
-        key :
-            PEM Formatted SSL Key.
+    cmd :
+        Command to be executed (as a list)
 
-            Examples:
-                ~/.config/lxc/client.key
+    environment : None
+        A dict of environment variables for the command
 
-        verify_cert : True
-            Wherever to verify the cert, this is by default True
-            but in the most cases you want to set it off as LXD
-            normaly uses self-signed certificates.
+    cwd : None
+        The working directory of the command
 
-        CLI Examples:
+    user : None
+        The uid to run the command as
 
-        .. code-block:: bash
+    group : None
+        The gid to run the command as
 
-            $ salt '*' lxd.profile_create autostart config="{boot.autostart: 1, boot.autostart.delay: 2, boot.autostart.priority: 1}"
-            $ salt '*' lxd.profile_create shared_mounts devices="{shared_mount: {type: 'disk', source: '/home/shared', path: '/home/shared'}}"
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
 
-        See the `lxd-docs`_ for the details about the config and devices dicts.
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
 
-        .. _lxd-docs: https://github.com/lxc/lxd/blob/master/doc/rest-api.md#post-10
+    cert :
+        PEM Formatted SSL Certificate.
 
-        # noqa
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    Returns a dict with the "id" of the job.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.exec_async <container name> '["/usr/local/bin/backup"]'
     '''
-    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+    if isinstance(cmd, six.string_types):
+        raise SaltInvocationError('cmd must be a list.')
 
-    config, devices = normalize_input_values(
-        config,
-        devices
+    container = container_get(
+        name, remote_addr, cert, key, verify_cert, _raw=True
     )
+    extensions = container.client.host_info.get('api_extensions', [])
+
+    # LXD forgets finished operations after a few seconds,
+    # so the exit code and the output go to files.
+    token = hashlib.sha1(os.urandom(16)).hexdigest()[:16]
+    stdout_file, stderr_file, rc_file = _exec_files(token)
+    data = {
+        'command': [
+            'sh', '-c',
+            '"$@" >{0} 2>{1}; rc=$?; echo $rc >{2}; exit $rc'.format(
+                shlex_quote(stdout_file), shlex_quote(stderr_file),
+                shlex_quote(rc_file)
+            ),
+            'sh'
+        ] + list(cmd),
+        'environment': environment or {},
+        'wait-for-websocket': False,
+        'interactive': False,
+    }
+    if cwd is not None or user is not None or group is not None:
+        if 'container_exec_user_group_cwd' not in extensions:
+            raise SaltInvocationError(
+                'cwd, user and group need the LXD API extension '
+                '"container_exec_user_group_cwd"'
+            )
+        if cwd is not None:
+            data['cwd'] = cwd
+        if user is not None:
+            data['user'] = int(user)
+        if group is not None:
+            data['group'] = int(group)
 
     try:
-        profile = client.profiles.create(name, config, devices)
+        response = container.api['exec'].post(json=data)
     except pylxd.exceptions.LXDAPIException as e:
         raise CommandExecutionError(six.text_type(e))
 
-    if description is not None:
-        profile.description = description
-        pylxd_save_object(profile)
+    operation_id = response.json()['operation'].split('/')[-1]
+    return {
+        'id': '/'.join((name, operation_id, token)),
+        'name': name,
+        'operation': operation_id,
+    }
 
-    return _pylxd_model_to_dict(profile)
 
+def exec_result(id, wait=False, timeout=None, cleanup=True,
+                head_bytes=65536, tail_bytes=65536, remote_addr=None,
+                cert=None, key=None, verify_cert=True):
+    '''
+    Collect the exit code and the output of a job started
+    with :mod:`exec_async <salt.modules.lxd.exec_async>`.
 
-def profile_get(name, remote_addr=None,
-                cert=None, key=None, verify_cert=True, _raw=False):
-    ''' Gets a profile from the LXD
+    id :
+        The id exec_async returned
 
-        name :
-            The name of the profile to get.
+    wait : False
+        Wait for the job to finish, else return with "running": True
+        when it's still running.
 
-        remote_addr :
-            An URL to a remote Server, you also have to give cert and key if
-            you provide remote_addr and its a TCP Address!
+    timeout : None
+        Seconds to wait when wait is True
 
-            Examples:
-                https://myserver.lan:8443
-                /var/lib/mysocket.sock
+    cleanup : True
+        Delete the exit code and output files in the container
+        after reading them
 
-        cert :
-            PEM Formatted SSL Certificate.
+    head_bytes : 65536
+        Bytes to keep from the start of each output stream, None for all.
 
-            Examples:
-                ~/.config/lxc/client.crt
+    tail_bytes : 65536
+        Bytes to keep from the end of each output stream.
 
-        key :
-            PEM Formatted SSL Key.
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
 
-            Examples:
-                ~/.config/lxc/client.key
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
 
-        verify_cert : True
-            Wherever to verify the cert, this is by default True
-            but in the most cases you want to set it off as LXD
-            normaly uses self-signed certificates.
+    cert :
+        PEM Formatted SSL Certificate.
 
-        _raw :
-            Return the pylxd object, this is internal and by states in use.
+        Examples:
+            ~/.config/lxc/client.crt
 
-        CLI Examples:
+    key :
+        PEM Formatted SSL Key.
 
-        .. code-block:: bash
+        Examples:
+            ~/.config/lxc/client.key
 
-            $ salt '*' lxd.profile_get autostart
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.exec_result <id> wait=True timeout=600
     '''
-    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+    try:
+        name, operation_id, token = id.split('/')
+    except ValueError:
+        raise SaltInvocationError('Invalid exec id "{0}"'.format(id))
+
+    container = container_get(
+        name, remote_addr, cert, key, verify_cert, _raw=True
+    )
+    client = container.client
+
+    ret = {'id': id, 'name': name, 'running': False}
 
-    profile = None
     try:
-        profile = client.profiles.get(name)
-    except pylxd.exceptions.LXDAPIException:
-        raise SaltInvocationError(
-            'Profile \'{0}\' not found'.format(name)
+        if wait:
+            params = {}
+            if timeout is not None:
+                params['timeout'] = timeout
+            response = client.api.operations[operation_id].wait.get(
+                params=params
+            )
+        else:
+            response = client.api.operations[operation_id].get()
+        operation = response.json()['metadata']
+        if operation['status_code'] < 200:
+            ret['running'] = True
+            return ret
+    except pylxd.exceptions.NotFound:
+        # Finished a while ago
+        pass
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
+
+    stdout_file, stderr_file, rc_file = _exec_files(token)
+    try:
+        exit_code = int(container.files.get(rc_file))
+    except (pylxd.exceptions.LXDAPIException, ValueError):
+        raise CommandExecutionError(
+            'The exit code of "{0}" is lost'.format(id)
         )
 
-    if _raw:
-        return profile
+    ret['exit_code'] = exit_code
+    ret['result'] = exit_code == 0
 
-    return _pylxd_model_to_dict(profile)
+    for path, stream in ((stdout_file, 'stdout'), (stderr_file, 'stderr')):
+        output = _BoundedOutput(stream, head_bytes, tail_bytes)
+        try:
+            response = container.api.files.get(
+                params={'path': path}, stream=True
+            )
+            try:
+                for chunk in response.iter_content(65536):
+                    output.write(chunk)
+            finally:
+                response.close()
+        except pylxd.exceptions.NotFound:
+            pass
+        except pylxd.exceptions.LXDAPIException as e:
+            raise CommandExecutionError(six.text_type(e))
+        ret[stream] = output.text
+        ret['{0}_bytes'.format(stream)] = output.total
+
+    if cleanup:
+        _container_execute_raw(
+            container, ['rm', '-f', stdout_file, stderr_file, rc_file]
+        )
 
+    return ret
 
-def profile_delete(name, remote_addr=None,
-                   cert=None, key=None, verify_cert=True):
-    ''' Deletes a profile.
 
-        name :
-            The name of the profile to delete.
+def execute_many(targets, cmd, concurrency=10, timeout=None,
+                 head_bytes=4096, tail_bytes=4096, remote_addr=None,
+                 cert=None, key=None, verify_cert=True):
+    '''
+    Execute the same command list in many running containers at once.
 
-        remote_addr :
-            An URL to a remote Server, you also have to give cert and key if
-            you provide remote_addr and its a TCP Address!
+    targets :
+        A list (or comma separated string) of container names,
+        globs ("web*") or profile selectors ("profile:<name>").
 
-            Examples:
-                https://myserver.lan:8443
-                /var/lib/mysocket.sock
+    cmd :
+        Command to be executed (as a list)
 
-        cert :
-            PEM Formatted SSL Certificate.
+    concurrency : 10
+        How many containers run the command at the same time
 
-            Examples:
-                ~/.config/lxc/client.crt
+    timeout : None
+        Seconds to wait for all containers, commands which did not
+        finish in time get killed and are reported as timed out.
 
-        key :
-            PEM Formatted SSL Key.
+    head_bytes : 4096
+        Bytes to keep from the start of each output stream
 
-            Examples:
-                ~/.config/lxc/client.key
+    tail_bytes : 4096
+        Bytes to keep from the end of each output stream
 
-        verify_cert : True
-            Wherever to verify the cert, this is by default True
-            but in the most cases you want to set it off as LXD
-            normaly uses self-signed certificates.
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
 
-        CLI Example:
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
 
-        .. code-block:: bash
+    cert :
+        PEM Formatted SSL Certificate.
 
-            $ salt '*' lxd.profile_delete shared_mounts
-    '''
-    profile = profile_get(
-        name,
-        remote_addr,
-        cert,
-        key,
-        verify_cert,
-        _raw=True
-    )
+        Examples:
+            ~/.config/lxc/client.crt
 
-    profile.delete()
-    return True
+    key :
+        PEM Formatted SSL Key.
 
+        Examples:
+            ~/.config/lxc/client.key
 
-def profile_config_get(name, config_key, remote_addr=None,
-                       cert=None, key=None, verify_cert=True):
-    ''' Get a profile config item.
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
 
-        name :
-            The name of the profile to get the config item from.
+    Returns a dict with the container_execute result per container in
+    "results" and the count of containers per exit code in "summary".
 
-        config_key :
-            The key for the item to retrieve.
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.execute_many 'web*,profile:db' '["openssl", "version"]' concurrency=20
+    '''
+    if isinstance(targets, six.string_types):
+        targets = [t.strip() for t in targets.split(',') if t.strip()]
+
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+    containers, _ = _pylxd_containers_with_state(client)
+
+    selected = []
+    for container in containers:
+        for target in targets:
+            if target.startswith('profile:'):
+                matched = target[len('profile:'):] in container.profiles
+            else:
+                matched = fnmatch.fnmatchcase(container.name, target)
+            if matched:
+                selected.append(container)
+                break
+
+    results = {}
+    running = []
+    for container in selected:
+        if container.status_code != CONTAINER_STATUS_RUNNING:
+            results[container.name] = {
+                'result': False, 'error': 'Container is not running'
+            }
+        else:
+            running.append(container)
+
+    timed_out = {
+        'result': False,
+        'error': 'Timed out after {0} seconds'.format(timeout)
+    }
+    deadline = None if timeout is None else time.time() + timeout
+
+    def _execute(container):
+        # Commands waiting for a free slot get only what's left.
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return dict(timed_out)
+        try:
+            return _container_execute_stream(
+                container, cmd, head_bytes, tail_bytes, timeout=remaining
+            )
+        except Exception as e:
+            return {'result': False, 'error': six.text_type(e)}
+
+    pool = ThreadPool(max(1, min(int(concurrency), len(running) or 1)))
+    try:
+        jobs = [(c.name, pool.apply_async(_execute, (c,))) for c in running]
+        for container_name, job in jobs:
+            remaining = None
+            if deadline is not None:
+                # Give the killed commands a moment to report back.
+                remaining = max(0, deadline - time.time()) + 10
+            try:
+                results[container_name] = job.get(remaining)
+            except multiprocessing.TimeoutError:
+                results[container_name] = dict(timed_out)
+    finally:
+        pool.terminate()
+
+    summary = {'total': len(results), 'succeeded': 0, 'failed': 0,
+               'errors': 0, 'exit_codes': {}}
+    for result in results.values():
+        if 'exit_code' not in result:
+            summary['errors'] += 1
+            continue
+        if result['result']:
+            summary['succeeded'] += 1
+        else:
+            summary['failed'] += 1
+        code = six.text_type(result['exit_code'])
+        summary['exit_codes'][code] = summary['exit_codes'].get(code, 0) + 1
+
+    return {'results': results, 'summary': summary}
+
+
+def container_bootstrap(name, scripts, restart=True,
+                        marker='/etc/salt_lxd_bootstraped', saltenv='base',
+                        remote_addr=None, cert=None, key=None,
+                        verify_cert=True):
+    '''
+    Run bootstrap scripts once in a running container.
+
+    The marker file inside the container is checked with one exec, when it
+    contains "True" nothing happens. Else all scripts with a "src" get
+    pushed in one tar transfer, all commands and the write of the marker
+    run in one "sh -e" exec and the container gets restarted once.
+
+    name :
+        Name of the container
+
+    scripts :
+        A list of dicts with "cmd" (a command list) and optional
+        "src" (local or salt:// file) and "dst" (path in the container).
+        A "src" without "dst" gets fed to "cmd" (default: /bin/sh -s)
+        through stdin.
+
+        Example :
+            '[{"cmd": ["/bin/sleep", "2"]},
+              {"src": "salt://lxd/scripts/bootstrap.sh",
+               "dst": "/root/bootstrap.sh",
+               "cmd": ["/root/bootstrap.sh"]}]'
+
+    restart : True
+        Restart the container after the scripts ran
+
+    marker : '/etc/salt_lxd_bootstraped'
+        The marker file inside the container
+
+    saltenv : base
+        The saltenv to fetch salt:// sources from
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    Returns a dict with "bootstrapped" (False if the marker was already
+    there) and the result of the exec which ran the commands in "result".
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.container_bootstrap <container name> '[{"cmd": ["/bin/true"]}]'
+    '''
+    container = container_get(
+        name, remote_addr, cert, key, verify_cert, _raw=True
+    )
+
+    result = _container_execute_raw(
+        container,
+        ['sh', '-c', 'cat {0} 2>/dev/null || true'.format(shlex_quote(marker))]
+    )
+    if 'True' in result['stdout']:
+        return {'bootstrapped': False, 'result': None}
+
+    sources = {}
+    for idx, script in enumerate(scripts):
+        if 'src' not in script:
+            continue
+
+        src = os.path.expanduser(script['src'])
+        if src.find('://') >= 0:
+            src = __salt__['cp.cache_file'](src, saltenv=saltenv)
+            if not src:
+                raise SaltInvocationError(
+                    "File '{0}' not found".format(script['src'])
+                )
+        if not os.path.isfile(src):
+            raise CommandExecutionError(
+                'No such file \'{0}\''.format(src)
+            )
+        sources[idx] = src
+
+    # Scripts without "dst" land in tmp_dir and get fed to their cmd.
+    tmp = '/tmp/salt_lxd_bootstrap.tar'
+    tmp_dir = '/tmp/salt_lxd_bootstrap'
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for idx, src in sorted(six.iteritems(sources)):
+            dst = scripts[idx].get('dst', '{0}/{1}'.format(tmp_dir, idx))
+            info = tar.gettarinfo(src, arcname=dst.lstrip('/'))
+            info.mode = 0o700
+            info.uid = info.gid = 0
+            info.uname = info.gname = 'root'
+            with salt.utils.fopen(src, 'rb') as src_fp:
+                tar.addfile(info, src_fp)
+
+    script = []
+    if archive.tell():
+        container.files.put(tmp, archive.getvalue(), mode='0600')
+        script.append("trap 'rm -rf {0} {1}' EXIT".format(
+            shlex_quote(tmp), shlex_quote(tmp_dir)
+        ))
+        script.append('tar -x -p -f {0} -C /'.format(shlex_quote(tmp)))
+
+    # The commands must not read the rest of this script from stdin.
+    for idx, cmd_script in enumerate(scripts):
+        if idx in sources and 'dst' not in cmd_script:
+            cmd = cmd_script.get('cmd', ['/bin/sh', '-s'])
+            stdin = '{0}/{1}'.format(tmp_dir, idx)
+        else:
+            cmd = cmd_script['cmd']
+            stdin = '/dev/null'
+        script.append('{0} <{1}'.format(
+            ' '.join(shlex_quote(c) for c in cmd), shlex_quote(stdin)
+        ))
+
+    script.append('echo True >{0}'.format(shlex_quote(marker)))
+    script.append('chmod 0600 {0}'.format(shlex_quote(marker)))
+
+    result = _container_execute_stream(
+        container, ['sh', '-e'], stdin='\n'.join(script) + '\n'
+    )
+    if not result['result']:
+        raise CommandExecutionError(
+            'Bootstrapping "{0}" failed: {1}'.format(name, result['stderr'])
+        )
+
+    if restart:
+        container.restart(wait=True)
+
+    return {'bootstrapped': True, 'result': result}
+
+
+####################
+# Profile Management
+####################
+def profile_list(list_names=False, remote_addr=None,
+                 cert=None, key=None, verify_cert=True):
+    ''' Lists all profiles from the LXD.
+
+        list_names :
+
+            Return a list of names instead of full blown dicts.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2192,37 +3977,43 @@ def profile_config_get(name, config_key, remote_addr=None,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        CLI Example:
+        CLI Examples:
 
         .. code-block:: bash
 
-            $ salt '*' lxd.profile_config_get autostart boot.autostart
+            salt '*' lxd.profile_list true --out=json
+            salt '*' lxd.profile_list --out=json
     '''
-    profile = profile_get(
-        name,
-        remote_addr,
-        cert,
-        key,
-        verify_cert,
-        _raw=True
-    )
 
-    return _get_property_dict_item(profile, 'config', config_key)
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+
+    profiles = client.profiles.all()
+    if list_names:
+        return [p.name for p in profiles]
 
+    return [_pylxd_model_to_dict(i) for i in profiles]
 
-def profile_config_set(name, config_key, config_value,
-                       remote_addr=None,
-                       cert=None, key=None, verify_cert=True):
-    ''' Set a profile config item.
+
+def profile_create(name, config=None, devices=None, description=None,
+                   remote_addr=None,
+                   cert=None, key=None, verify_cert=True):
+    ''' Creates a profile.
 
         name :
-            The name of the profile to set the config item to.
+            The name of the profile to get.
 
-        config_key :
-            The items key.
+        config :
+            A config dict or None (None = unset).
 
-        config_value :
-            Its items value.
+            Can also be a list:
+                [{'key': 'boot.autostart', 'value': 1},
+                 {'key': 'security.privileged', 'value': '1'}]
+
+        devices :
+            A device dict or None (None = unset).
+
+        description :
+            A description string or None (None = unset).
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2249,35 +4040,45 @@ def profile_config_set(name, config_key, config_value,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        CLI Example:
+        CLI Examples:
 
         .. code-block:: bash
 
-            $ salt '*' lxd.profile_config_set autostart boot.autostart 0
+            $ salt '*' lxd.profile_create autostart config="{boot.autostart: 1, boot.autostart.delay: 2, boot.autostart.priority: 1}"
+            $ salt '*' lxd.profile_create shared_mounts devices="{shared_mount: {type: 'disk', source: '/home/shared', path: '/home/shared'}}"
+
+        See the `lxd-docs`_ for the details about the config and devices dicts.
+
+        .. _lxd-docs: https://github.com/lxc/lxd/blob/master/doc/rest-api.md#post-10
+
+        # noqa
     '''
-    profile = profile_get(
-        name,
-        remote_addr,
-        cert,
-        key,
-        verify_cert,
-        _raw=True
-    )
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
 
-    return _set_property_dict_item(
-        profile, 'config', config_key, config_value
+    config, devices = normalize_input_values(
+        config,
+        devices
     )
 
+    try:
+        profile = client.profiles.create(name, config, devices)
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
 
-def profile_config_delete(name, config_key, remote_addr=None,
-                          cert=None, key=None, verify_cert=True):
-    ''' Delete a profile config item.
+    if description is not None:
+        base = pylxd_object_state(profile)
+        profile.description = description
+        pylxd_save_object(profile, base)
 
-        name :
-            The name of the profile to delete the config item.
+    return _pylxd_model_to_dict(profile)
 
-        config_key :
-            The config key for the value to retrieve.
+
+def profile_get(name, remote_addr=None,
+                cert=None, key=None, verify_cert=True, _raw=False):
+    ''' Gets a profile from the LXD
+
+        name :
+            The name of the profile to get.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2304,35 +4105,37 @@ def profile_config_delete(name, config_key, remote_addr=None,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        CLI Example:
+        _raw :
+            Return the pylxd object, this is internal and by states in use.
+
+        CLI Examples:
 
         .. code-block:: bash
 
-            $ salt '*' lxd.profile_config_delete autostart boot.autostart.delay
+            $ salt '*' lxd.profile_get autostart
     '''
-    profile = profile_get(
-        name,
-        remote_addr,
-        cert,
-        key,
-        verify_cert,
-        _raw=True
-    )
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
 
-    return _delete_property_dict_item(
-        profile, 'config', config_key
-    )
+    profile = None
+    try:
+        profile = client.profiles.get(name)
+    except pylxd.exceptions.LXDAPIException:
+        raise SaltInvocationError(
+            'Profile \'{0}\' not found'.format(name)
+        )
 
+    if _raw:
+        return profile
 
-def profile_device_get(name, device_name, remote_addr=None,
-                       cert=None, key=None, verify_cert=True):
-    ''' Get a profile device.
+    return _pylxd_model_to_dict(profile)
 
-        name :
-            The name of the profile to get the device from.
 
-        device_name :
-            The name of the device to retrieve.
+def profile_delete(name, remote_addr=None,
+                   cert=None, key=None, verify_cert=True):
+    ''' Deletes a profile.
+
+        name :
+            The name of the profile to delete.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2363,7 +4166,7 @@ def profile_device_get(name, device_name, remote_addr=None,
 
         .. code-block:: bash
 
-            $ salt '*' lxd.profile_device_get default eth0
+            $ salt '*' lxd.profile_delete shared_mounts
     '''
     profile = profile_get(
         name,
@@ -2374,20 +4177,20 @@ def profile_device_get(name, device_name, remote_addr=None,
         _raw=True
     )
 
-    return _get_property_dict_item(profile, 'devices', device_name)
+    profile.delete()
+    _fingerprint_forget(profile, remote_addr)
+    return True
 
 
-def profile_device_set(name, device_name, device_type='disk',
-                       remote_addr=None,
-                       cert=None, key=None, verify_cert=True,
-                       **kwargs):
-    ''' Set a profile device.
+def profile_config_get(name, config_key, remote_addr=None,
+                       cert=None, key=None, verify_cert=True):
+    ''' Get a profile config item.
 
         name :
-            The name of the profile to set the device to.
+            The name of the profile to get the config item from.
 
-        device_name :
-            The name of the device to set.
+        config_key :
+            The key for the item to retrieve.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2418,9 +4221,7 @@ def profile_device_set(name, device_name, device_type='disk',
 
         .. code-block:: bash
 
-            $ salt '*' lxd.profile_device_set autostart eth1 nic nictype=bridged parent=lxdbr0
-
-        # noqa
+            $ salt '*' lxd.profile_config_get autostart boot.autostart
     '''
     profile = profile_get(
         name,
@@ -2431,25 +4232,22 @@ def profile_device_set(name, device_name, device_type='disk',
         _raw=True
     )
 
-    kwargs['type'] = device_type
+    return _get_property_dict_item(profile, 'config', config_key)
 
-    for k, v in six.iteritems(kwargs):
-        kwargs[k] = six.text_type(v)
 
-    return _set_property_dict_item(
-        profile, 'devices', device_name, kwargs
-    )
-
-
-def profile_device_delete(name, device_name, remote_addr=None,
-                          cert=None, key=None, verify_cert=True):
-    ''' Delete a profile device.
+def profile_config_set(name, config_key, config_value,
+                       remote_addr=None,
+                       cert=None, key=None, verify_cert=True):
+    ''' Set a profile config item.
 
         name :
-            The name of the profile to delete the device.
+            The name of the profile to set the config item to.
 
-        device_name :
-            The name of the device to delete.
+        config_key :
+            The items key.
+
+        config_value :
+            Its items value.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2480,36 +4278,26 @@ def profile_device_delete(name, device_name, remote_addr=None,
 
         .. code-block:: bash
 
-            $ salt '*' lxd.profile_device_delete autostart eth1
-
-        # noqa
-
+            $ salt '*' lxd.profile_config_set autostart boot.autostart 0
     '''
-    profile = profile_get(
-        name,
-        remote_addr,
-        cert,
-        key,
-        verify_cert,
-        _raw=True
+    profile, base = _pylxd_object_get(
+        'profiles', name, remote_addr, cert, key, verify_cert
     )
 
-    return _delete_property_dict_item(
-        profile, 'devices', device_name
+    return _set_property_dict_item(
+        profile, 'config', config_key, config_value, base
     )
 
 
-##################
-# Image Management
-##################
-def image_list(list_aliases=False, remote_addr=None,
-               cert=None, key=None, verify_cert=True):
-    ''' Lists all images from the LXD.
+def profile_config_delete(name, config_key, remote_addr=None,
+                          cert=None, key=None, verify_cert=True):
+    ''' Delete a profile config item.
 
-        list_aliases :
+        name :
+            The name of the profile to delete the config item.
 
-            Return a dict with the fingerprint as key and
-            a list of aliases as value instead.
+        config_key :
+            The config key for the value to retrieve.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2536,32 +4324,35 @@ def image_list(list_aliases=False, remote_addr=None,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        CLI Examples:
+        CLI Example:
 
         .. code-block:: bash
 
-            $ salt '*' lxd.image_list true --out=json
-            $ salt '*' lxd.image_list --out=json
+            $ salt '*' lxd.profile_config_delete autostart boot.autostart.delay
     '''
-    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+    profile, base = _pylxd_object_get(
+        'profiles', name, remote_addr, cert, key, verify_cert
+    )
 
-    images = client.images.all()
-    if list_aliases:
-        return {i.fingerprint: [a['name'] for a in i.aliases] for i in images}
+    return _delete_property_dict_item(
+        profile, 'config', config_key, base
+    )
 
-    return [_pylxd_model_to_dict(i) for i in images]
 
+def profile_config_set_many(name, config=None, delete=None,
+                            remote_addr=None,
+                            cert=None, key=None, verify_cert=True):
+    ''' Set and delete several profile config items with one fetch
+        and one save.
 
-def image_get(fingerprint,
-              remote_addr=None,
-              cert=None,
-              key=None,
-              verify_cert=True,
-              _raw=False):
-    ''' Get an image by its fingerprint
+        name :
+            The name of the profile.
 
-        fingerprint :
-            The fingerprint of the image to retrieve
+        config :
+            A dict of config keys and the values to set.
+
+        delete :
+            A list of config keys to delete, missing keys get ignored.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2588,41 +4379,30 @@ def image_get(fingerprint,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        _raw : False
-            Return the raw pylxd object or a dict of it?
+        CLI Example:
 
-        CLI Examples:
+        .. code-block:: bash
 
-        ..code-block:: bash
+            $ salt '*' lxd.profile_config_set_many autostart config="{boot.autostart: 1, boot.autostart.delay: 2}"
 
-            $ salt '*' lxd.image_get <fingerprint>
+        # noqa
     '''
-    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
-
-    image = None
-    try:
-        image = client.images.get(fingerprint)
-    except pylxd.exceptions.LXDAPIException:
-        raise SaltInvocationError(
-            'Image with fingerprint \'{0}\' not found'.format(fingerprint)
-        )
+    profile, base = _pylxd_object_get(
+        'profiles', name, remote_addr, cert, key, verify_cert
+    )
 
-    if _raw:
-        return image
+    return _set_property_dict_items(profile, 'config', config, delete, base)
 
-    return _pylxd_model_to_dict(image)
 
+def profile_device_get(name, device_name, remote_addr=None,
+                       cert=None, key=None, verify_cert=True):
+    ''' Get a profile device.
 
-def image_get_by_alias(alias,
-                       remote_addr=None,
-                       cert=None,
-                       key=None,
-                       verify_cert=True,
-                       _raw=False):
-    ''' Get an image by an alias
+        name :
+            The name of the profile to get the device from.
 
-        alias :
-            The alias of the image to retrieve
+        device_name :
+            The name of the device to retrieve.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2649,41 +4429,35 @@ def image_get_by_alias(alias,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        _raw : False
-            Return the raw pylxd object or a dict of it?
-
-        CLI Examples:
+        CLI Example:
 
-        ..code-block:: bash
+        .. code-block:: bash
 
-            $ salt '*' lxd.image_get_by_alias xenial/amd64
+            $ salt '*' lxd.profile_device_get default eth0
     '''
-    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
-
-    image = None
-    try:
-        image = client.images.get_by_alias(alias)
-    except pylxd.exceptions.LXDAPIException:
-        raise SaltInvocationError(
-            'Image with alias \'{0}\' not found'.format(alias)
-        )
-
-    if _raw:
-        return image
+    profile = profile_get(
+        name,
+        remote_addr,
+        cert,
+        key,
+        verify_cert,
+        _raw=True
+    )
 
-    return _pylxd_model_to_dict(image)
+    return _get_property_dict_item(profile, 'devices', device_name)
 
 
-def image_delete(image,
-                 remote_addr=None,
-                 cert=None,
-                 key=None,
-                 verify_cert=True):
-    ''' Delete an image by an alias or fingerprint
+def profile_device_set(name, device_name, device_type='disk',
+                       remote_addr=None,
+                       cert=None, key=None, verify_cert=True,
+                       **kwargs):
+    ''' Set a profile device.
 
         name :
-            The alias or fingerprint of the image to delete,
-            can be a obj for the states.
+            The name of the profile to set the device to.
+
+        device_name :
+            The name of the device to set.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2710,36 +4484,37 @@ def image_delete(image,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        CLI Examples:
+        CLI Example:
 
-        ..code-block:: bash
+        .. code-block:: bash
 
-            $ salt '*' lxd.image_delete xenial/amd64
+            $ salt '*' lxd.profile_device_set autostart eth1 nic nictype=bridged parent=lxdbr0
+
+        # noqa
     '''
+    profile, base = _pylxd_object_get(
+        'profiles', name, remote_addr, cert, key, verify_cert
+    )
 
-    image = _verify_image(image, remote_addr, cert, key, verify_cert)
+    kwargs['type'] = device_type
 
-    image.delete()
-    return True
+    for k, v in six.iteritems(kwargs):
+        kwargs[k] = six.text_type(v)
 
+    return _set_property_dict_item(
+        profile, 'devices', device_name, kwargs, base
+    )
 
-def image_from_simplestreams(server,
-                             alias,
-                             remote_addr=None,
-                             cert=None,
-                             key=None,
-                             verify_cert=True,
-                             aliases=None,
-                             public=False,
-                             auto_update=False,
-                             _raw=False):
-    ''' Create an image from simplestreams
 
-        server :
-            Simplestreams server URI
+def profile_device_delete(name, device_name, remote_addr=None,
+                          cert=None, key=None, verify_cert=True):
+    ''' Delete a profile device.
 
-        alias :
-            The alias of the image to retrieve
+        name :
+            The name of the profile to delete the device.
+
+        device_name :
+            The name of the device to delete.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2766,61 +4541,39 @@ def image_from_simplestreams(server,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        aliases : []
-            List of aliases to append to the copied image
-
-        public : False
-            Make this image public available
-
-        auto_update : False
-            Should LXD auto update that image?
-
-        _raw : False
-            Return the raw pylxd object or a dict of the image?
-
-        CLI Examples:
+        CLI Example:
 
-        ..code-block:: bash
+        .. code-block:: bash
 
-            $ salt '*' lxd.image_from_simplestreams "https://cloud-images.ubuntu.com/releases" "trusty/amd64" aliases='["t", "trusty/amd64"]' auto_update=True
+            $ salt '*' lxd.profile_device_delete autostart eth1
 
         # noqa
-    '''
-    if aliases is None:
-        aliases = []
 
-    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
-
-    try:
-        image = client.images.create_from_simplestreams(
-            server, alias, public=public, auto_update=auto_update
-        )
-    except pylxd.exceptions.LXDAPIException as e:
-        raise CommandExecutionError(six.text_type(e))
+    '''
+    profile, base = _pylxd_object_get(
+        'profiles', name, remote_addr, cert, key, verify_cert
+    )
 
-    # Aliases support
-    for alias in aliases:
-        image_alias_add(image, alias)
+    return _delete_property_dict_item(
+        profile, 'devices', device_name, base
+    )
 
-    if _raw:
-        return image
 
-    return _pylxd_model_to_dict(image)
+def profile_devices_set_many(name, devices=None, delete=None,
+                             remote_addr=None,
+                             cert=None, key=None, verify_cert=True):
+    ''' Set and delete several profile devices with one fetch
+        and one save.
 
+        name :
+            The name of the profile.
 
-def image_from_url(url,
-                   remote_addr=None,
-                   cert=None,
-                   key=None,
-                   verify_cert=True,
-                   aliases=None,
-                   public=False,
-                   auto_update=False,
-                   _raw=False):
-    ''' Create an image from an url
+        devices :
+            A dict of device names and their devices (dicts with
+            a "type" and the additional device args).
 
-        url :
-            The URL from where to download the image
+        delete :
+            A list of device names to delete, missing devices get ignored.
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2847,61 +4600,86 @@ def image_from_url(url,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        aliases : []
-            List of aliases to append to the copied image
+        CLI Example:
 
-        public : False
-            Make this image public available
+        .. code-block:: bash
 
-        auto_update : False
-            Should LXD auto update that image?
+            $ salt '*' lxd.profile_devices_set_many autostart devices="{eth1: {type: nic, nictype: bridged, parent: lxdbr0}}" delete="[eth2]"
 
-        _raw : False
-            Return the raw pylxd object or a dict of the image?
+        # noqa
+    '''
+    profile, base = _pylxd_object_get(
+        'profiles', name, remote_addr, cert, key, verify_cert
+    )
 
-        CLI Examples:
+    return _set_property_dict_items(
+        profile, 'devices', _devices_text(devices), delete, base
+    )
 
-        ..code-block:: bash
 
-            $ salt '*' lxd.image_from_url https://dl.stgraber.org/lxd aliases='["busybox-amd64"]'
+##################
+# Image Management
+##################
+def image_list(list_aliases=False, remote_addr=None,
+               cert=None, key=None, verify_cert=True):
+    ''' Lists all images from the LXD.
 
-        # noqa
-    '''
-    if aliases is None:
-        aliases = []
+        list_aliases :
 
-    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+            Return a dict with the fingerprint as key and
+            a list of aliases as value instead.
 
-    try:
-        image = client.images.create_from_url(
-            url, public=public, auto_update=auto_update
-        )
-    except pylxd.exceptions.LXDAPIException as e:
-        raise CommandExecutionError(six.text_type(e))
+        remote_addr :
+            An URL to a remote Server, you also have to give cert and key if
+            you provide remote_addr and its a TCP Address!
 
-    # Aliases support
-    for alias in aliases:
-        image_alias_add(image, alias)
+            Examples:
+                https://myserver.lan:8443
+                /var/lib/mysocket.sock
 
-    if _raw:
-        return image
+        cert :
+            PEM Formatted SSL Certificate.
 
-    return _pylxd_model_to_dict(image)
+            Examples:
+                ~/.config/lxc/client.crt
 
+        key :
+            PEM Formatted SSL Key.
 
-def image_from_file(filename,
-                    remote_addr=None,
-                    cert=None,
-                    key=None,
-                    verify_cert=True,
-                    aliases=None,
-                    public=False,
-                    saltenv='base',
-                    _raw=False):
-    ''' Create an image from a file
+            Examples:
+                ~/.config/lxc/client.key
 
-        filename :
-            The filename of the rootfs
+        verify_cert : True
+            Wherever to verify the cert, this is by default True
+            but in the most cases you want to set it off as LXD
+            normaly uses self-signed certificates.
+
+        CLI Examples:
+
+        .. code-block:: bash
+
+            $ salt '*' lxd.image_list true --out=json
+            $ salt '*' lxd.image_list --out=json
+    '''
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+
+    images = client.images.all()
+    if list_aliases:
+        return {i.fingerprint: [a['name'] for a in i.aliases] for i in images}
+
+    return [_pylxd_model_to_dict(i) for i in images]
+
+
+def image_get(fingerprint,
+              remote_addr=None,
+              cert=None,
+              key=None,
+              verify_cert=True,
+              _raw=False):
+    ''' Get an image by its fingerprint
+
+        fingerprint :
+            The fingerprint of the image to retrieve
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -2928,44 +4706,24 @@ def image_from_file(filename,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
-        aliases : []
-            List of aliases to append to the copied image
-
-        public : False
-            Make this image public available
-
-        saltenv : base
-            The saltenv to use for salt:// copies
-
         _raw : False
-            Return the raw pylxd object or a dict of the image?
+            Return the raw pylxd object or a dict of it?
 
         CLI Examples:
 
         ..code-block:: bash
 
-            $ salt '*' lxd.image_from_file salt://lxd/files/busybox.tar.xz aliases=["busybox-amd64"]
-
-        # noqa
+            $ salt '*' lxd.image_get <fingerprint>
     '''
-    if aliases is None:
-        aliases = []
-
-    cached_file = __salt__['cp.cache_file'](filename, saltenv=saltenv)
-    data = b''
-    with salt.utils.fopen(cached_file, 'r+b') as fp:
-        data = fp.read()
-
     client = pylxd_client_get(remote_addr, cert, key, verify_cert)
 
+    image = None
     try:
-        image = client.images.create(data, public=public, wait=True)
-    except pylxd.exceptions.LXDAPIException as e:
-        raise CommandExecutionError(six.text_type(e))
-
-    # Aliases support
-    for alias in aliases:
-        image_alias_add(image, alias)
+        image = client.images.get(fingerprint)
+    except pylxd.exceptions.LXDAPIException:
+        raise SaltInvocationError(
+            'Image with fingerprint \'{0}\' not found'.format(fingerprint)
+        )
 
     if _raw:
         return image
@@ -2973,148 +4731,214 @@ def image_from_file(filename,
     return _pylxd_model_to_dict(image)
 
 
-def image_copy_lxd(source,
-                   src_remote_addr,
-                   src_cert,
-                   src_key,
-                   src_verify_cert,
-                   remote_addr,
-                   cert,
-                   key,
-                   verify_cert=True,
-                   aliases=None,
-                   public=None,
-                   auto_update=None,
-                   _raw=False):
-    ''' Copy an image from another LXD instance
-
-    source :
-        An alias or a fingerprint of the source.
+def image_get_by_alias(alias,
+                       remote_addr=None,
+                       cert=None,
+                       key=None,
+                       verify_cert=True,
+                       _raw=False):
+    ''' Get an image by an alias
 
-    src_remote_addr :
-        An URL to the source remote daemon
+        alias :
+            The alias of the image to retrieve
 
-        Examples:
-            https://mysourceserver.lan:8443
+        remote_addr :
+            An URL to a remote Server, you also have to give cert and key if
+            you provide remote_addr and its a TCP Address!
 
-    src_cert :
-        PEM Formatted SSL Certificate for the source
+            Examples:
+                https://myserver.lan:8443
+                /var/lib/mysocket.sock
 
-        Examples:
-            ~/.config/lxc/client.crt
+        cert :
+            PEM Formatted SSL Certificate.
 
-    src_key :
-        PEM Formatted SSL Key for the source
+            Examples:
+                ~/.config/lxc/client.crt
 
-        Examples:
-            ~/.config/lxc/client.key
+        key :
+            PEM Formatted SSL Key.
 
-    src_verify_cert : True
-        Wherever to verify the cert, this is by default True
-        but in the most cases you want to set it off as LXD
-        normaly uses self-signed certificates.
+            Examples:
+                ~/.config/lxc/client.key
 
-    remote_addr :
-        Address of the destination daemon
+        verify_cert : True
+            Wherever to verify the cert, this is by default True
+            but in the most cases you want to set it off as LXD
+            normaly uses self-signed certificates.
 
-        Examples:
-            https://mydestserver.lan:8443
+        _raw : False
+            Return the raw pylxd object or a dict of it?
 
-    cert :
-        PEM Formatted SSL Certificate for the destination
+        CLI Examples:
 
-        Examples:
-            ~/.config/lxc/client.crt
+        ..code-block:: bash
 
-    key :
-        PEM Formatted SSL Key for the destination
+            $ salt '*' lxd.image_get_by_alias xenial/amd64
+    '''
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
 
-        Examples:
-            ~/.config/lxc/client.key
+    image = None
+    try:
+        image = client.images.get_by_alias(alias)
+    except pylxd.exceptions.LXDAPIException:
+        raise SaltInvocationError(
+            'Image with alias \'{0}\' not found'.format(alias)
+        )
 
-    verify_cert : True
-        Wherever to verify the cert, this is by default True
-        but in the most cases you want to set it off as LXD
-        normaly uses self-signed certificates.
+    if _raw:
+        return image
 
-    aliases : []
-        List of aliases to append to the copied image
+    return _pylxd_model_to_dict(image)
 
-    public : None
-        Make this image public available, None = copy source
 
-    auto_update : None
-        Wherever to auto-update from the original source, None = copy source
+def image_delete(image,
+                 remote_addr=None,
+                 cert=None,
+                 key=None,
+                 verify_cert=True):
+    ''' Delete an image by an alias or fingerprint
 
-    _raw : False
-        Return the raw pylxd object or a dict of the destination image?
+        name :
+            The alias or fingerprint of the image to delete,
+            can be a obj for the states.
 
-    CLI Examples:
+        remote_addr :
+            An URL to a remote Server, you also have to give cert and key if
+            you provide remote_addr and its a TCP Address!
 
-    .. code-block:: bash
+            Examples:
+                https://myserver.lan:8443
+                /var/lib/mysocket.sock
 
-        $ salt '*' lxd.image_copy_lxd xenial/amd64 https://srv01:8443 ~/.config/lxc/client.crt ~/.config/lxc/client.key false https://srv02:8443 ~/.config/lxc/client.crt ~/.config/lxc/client.key false aliases="['xenial/amd64']"
+        cert :
+            PEM Formatted SSL Certificate.
 
-    # noqa
-    '''
-    if aliases is None:
-        aliases = []
+            Examples:
+                ~/.config/lxc/client.crt
 
-    log.debug(
-        'Trying to copy the image "{0}" from "{1}" to "{2}"'.format(
-            source, src_remote_addr, remote_addr
-        )
-    )
+        key :
+            PEM Formatted SSL Key.
 
-    # This will fail with a SaltInvocationError if
-    # the image doesn't exists on the source and with a CommandExecutionError
-    # on connection problems.
-    src_image = None
-    try:
-        src_image = image_get_by_alias(
-            source, src_remote_addr, src_cert,
-            src_key, src_verify_cert, _raw=True
-        )
-    except SaltInvocationError:
-        src_image = image_get(
-            source, src_remote_addr, src_cert,
-            src_key, src_verify_cert, _raw=True
-        )
+            Examples:
+                ~/.config/lxc/client.key
 
-    # Will fail with a CommandExecutionError on connection problems.
-    dest_client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+        verify_cert : True
+            Wherever to verify the cert, this is by default True
+            but in the most cases you want to set it off as LXD
+            normaly uses self-signed certificates.
 
-    dest_image = src_image.copy(
-        dest_client, public=public, auto_update=auto_update, wait=True
-    )
+        CLI Examples:
 
-    # Aliases support
-    for alias in aliases:
-        image_alias_add(dest_image, alias)
+        ..code-block:: bash
 
-    if _raw:
-        return dest_image
+            $ salt '*' lxd.image_delete xenial/amd64
+    '''
 
-    return _pylxd_model_to_dict(dest_image)
+    image = _verify_image(image, remote_addr, cert, key, verify_cert)
 
+    image.delete()
+    return True
 
-def image_alias_add(image,
-                    alias,
-                    description='',
-                    remote_addr=None,
-                    cert=None,
-                    key=None,
-                    verify_cert=True):
-    ''' Create an alias on the given image
 
-        image :
-            An image alias, a fingerprint or a image object
+def image_from_simplestreams(server,
+                             alias,
+                             remote_addr=None,
+                             cert=None,
+                             key=None,
+                             verify_cert=True,
+                             aliases=None,
+                             public=False,
+                             auto_update=False,
+                             _raw=False):
+    ''' Create an image from simplestreams
+
+        server :
+            Simplestreams server URI
 
         alias :
-            The alias to add
+            The alias of the image to retrieve
 
-        description :
-            Description of the alias
+        remote_addr :
+            An URL to a remote Server, you also have to give cert and key if
+            you provide remote_addr and its a TCP Address!
+
+            Examples:
+                https://myserver.lan:8443
+                /var/lib/mysocket.sock
+
+        cert :
+            PEM Formatted SSL Certificate.
+
+            Examples:
+                ~/.config/lxc/client.crt
+
+        key :
+            PEM Formatted SSL Key.
+
+            Examples:
+                ~/.config/lxc/client.key
+
+        verify_cert : True
+            Wherever to verify the cert, this is by default True
+            but in the most cases you want to set it off as LXD
+            normaly uses self-signed certificates.
+
+        aliases : []
+            List of aliases to append to the copied image
+
+        public : False
+            Make this image public available
+
+        auto_update : False
+            Should LXD auto update that image?
+
+        _raw : False
+            Return the raw pylxd object or a dict of the image?
+
+        CLI Examples:
+
+        ..code-block:: bash
+
+            $ salt '*' lxd.image_from_simplestreams "https://cloud-images.ubuntu.com/releases" "trusty/amd64" aliases='["t", "trusty/amd64"]' auto_update=True
+
+        # noqa
+    '''
+    if aliases is None:
+        aliases = []
+
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+
+    try:
+        image = client.images.create_from_simplestreams(
+            server, alias, public=public, auto_update=auto_update
+        )
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
+
+    # Aliases support
+    for alias in aliases:
+        image_alias_add(image, alias)
+
+    if _raw:
+        return image
+
+    return _pylxd_model_to_dict(image)
+
+
+def image_from_url(url,
+                   remote_addr=None,
+                   cert=None,
+                   key=None,
+                   verify_cert=True,
+                   aliases=None,
+                   public=False,
+                   auto_update=False,
+                   _raw=False):
+    ''' Create an image from an url
+
+        url :
+            The URL from where to download the image
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -3141,37 +4965,61 @@ def image_alias_add(image,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
+        aliases : []
+            List of aliases to append to the copied image
+
+        public : False
+            Make this image public available
+
+        auto_update : False
+            Should LXD auto update that image?
+
+        _raw : False
+            Return the raw pylxd object or a dict of the image?
+
         CLI Examples:
 
-        .. code-block:: bash
+        ..code-block:: bash
 
-            $ salt '*' lxd.image_alias_add xenial/amd64 x "Short version of xenial/amd64"
+            $ salt '*' lxd.image_from_url https://dl.stgraber.org/lxd aliases='["busybox-amd64"]'
 
         # noqa
     '''
-    image = _verify_image(image, remote_addr, cert, key, verify_cert)
+    if aliases is None:
+        aliases = []
 
-    for alias_info in image.aliases:
-        if alias_info['name'] == alias:
-            return True
-    image.add_alias(alias, description)
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
 
-    return True
+    try:
+        image = client.images.create_from_url(
+            url, public=public, auto_update=auto_update
+        )
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
 
+    # Aliases support
+    for alias in aliases:
+        image_alias_add(image, alias)
 
-def image_alias_delete(image,
-                       alias,
-                       remote_addr=None,
-                       cert=None,
-                       key=None,
-                       verify_cert=True):
-    ''' Delete an alias (this is currently not restricted to the image)
+    if _raw:
+        return image
 
-        image :
-            An image alias, a fingerprint or a image object
+    return _pylxd_model_to_dict(image)
 
-        alias :
-            The alias to delete
+
+def image_from_file(filename,
+                    remote_addr=None,
+                    cert=None,
+                    key=None,
+                    verify_cert=True,
+                    aliases=None,
+                    public=False,
+                    saltenv='base',
+                    _raw=False):
+    ''' Create an image from a file
+
+        filename :
+            The filename of the rootfs
 
         remote_addr :
             An URL to a remote Server, you also have to give cert and key if
@@ -3198,379 +5046,2529 @@ def image_alias_delete(image,
             but in the most cases you want to set it off as LXD
             normaly uses self-signed certificates.
 
+        aliases : []
+            List of aliases to append to the copied image
+
+        public : False
+            Make this image public available
+
+        saltenv : base
+            The saltenv to use for salt:// copies
+
+        _raw : False
+            Return the raw pylxd object or a dict of the image?
+
         CLI Examples:
 
-        .. code-block:: bash
+        ..code-block:: bash
 
-            $ salt '*' lxd.image_alias_add xenial/amd64 x "Short version of xenial/amd64"
+            $ salt '*' lxd.image_from_file salt://lxd/files/busybox.tar.xz aliases=["busybox-amd64"]
 
         # noqa
     '''
-    image = _verify_image(image, remote_addr, cert, key, verify_cert)
+    if aliases is None:
+        aliases = []
+
+    cached_file = __salt__['cp.cache_file'](filename, saltenv=saltenv)
+
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+
+    headers = {}
+    if public:
+        headers['X-LXD-Public'] = '1'
 
+    # The fingerprint of an unified image is its sha256, hash the
+    # chunks while they get uploaded so the image is read only once.
+    sha256 = hashlib.sha256()
+    stats = _FileTransferStats()
     try:
-        image.delete_alias(alias)
-    except pylxd.exceptions.LXDAPIException:
-        return False
+        with salt.utils.fopen(cached_file, 'rb') as fp:
+            response = client.api.images.post(
+                data=stats.chunks(fp, digest=sha256), headers=headers
+            )
+        operation = client.operations.wait_for_operation(
+            response.json()['operation']
+        )
+        fingerprint = (operation.metadata or {}).get(
+            'fingerprint', sha256.hexdigest()
+        )
+        image = client.images.get(fingerprint)
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
 
-    return True
+    # Aliases support
+    for alias in aliases:
+        image_alias_add(image, alias)
 
-#####################
-# Snapshot Management
-#####################
+    if _raw:
+        return image
 
+    result = _pylxd_model_to_dict(image)
+    result['transfer'] = stats.as_dict()
+    return result
 
-def snapshots_all(container=None, remote_addr=None,
-                  cert=None, key=None, verify_cert=True):
+
+def image_copy_lxd(source,
+                   src_remote_addr,
+                   src_cert,
+                   src_key,
+                   src_verify_cert,
+                   remote_addr,
+                   cert,
+                   key,
+                   verify_cert=True,
+                   aliases=None,
+                   public=None,
+                   auto_update=None,
+                   _raw=False):
+    ''' Copy an image from another LXD instance
+
+    source :
+        An alias or a fingerprint of the source.
+
+    src_remote_addr :
+        An URL to the source remote daemon
+
+        Examples:
+            https://mysourceserver.lan:8443
+
+    src_cert :
+        PEM Formatted SSL Certificate for the source
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    src_key :
+        PEM Formatted SSL Key for the source
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    src_verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    remote_addr :
+        Address of the destination daemon
+
+        Examples:
+            https://mydestserver.lan:8443
+
+    cert :
+        PEM Formatted SSL Certificate for the destination
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key for the destination
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    aliases : []
+        List of aliases to append to the copied image
+
+    public : None
+        Make this image public available, None = copy source
+
+    auto_update : None
+        Wherever to auto-update from the original source, None = copy source
+
+    _raw : False
+        Return the raw pylxd object or a dict of the destination image?
+
+    The dict of the destination image contains a "transfer" item with
+    the bytes transfered, the last and average rate in bytes/s
+    and the duration.
+
+    The transfers between LXD daemons (this and container_migrate) can
+    be limited with the "lxd:transfers" config (minion config or pillar),
+    max_concurrent is the maximum number of transfers running at once
+    and max_rate a rate in bytes/s (or "100MB"), new transfers wait until
+    the measured rate of the running ones is below it. The global limits
+    count for all transfers of the minion, the ones under "remotes" only
+    for transfers from/to the given remote_addr:
+
+    .. code-block:: yaml
+
+        lxd:
+          transfers:
+            max_concurrent: 4
+            max_rate: 200MB
+            wait_timeout: 3600
+            remotes:
+              https://srv02:8443:
+                max_concurrent: 1
+                max_rate: 50MB
+
+    CLI Examples:
+
+    .. code-block:: bash
+
+        $ salt '*' lxd.image_copy_lxd xenial/amd64 https://srv01:8443 ~/.config/lxc/client.crt ~/.config/lxc/client.key false https://srv02:8443 ~/.config/lxc/client.crt ~/.config/lxc/client.key false aliases="['xenial/amd64']"
+
+    # noqa
+    '''
+    if aliases is None:
+        aliases = []
+
+    log.debug(
+        'Trying to copy the image "{0}" from "{1}" to "{2}"'.format(
+            source, src_remote_addr, remote_addr
+        )
+    )
+
+    # This will fail with a SaltInvocationError if
+    # the image doesn't exists on the source and with a CommandExecutionError
+    # on connection problems.
+    src_image = None
+    try:
+        src_image = image_get_by_alias(
+            source, src_remote_addr, src_cert,
+            src_key, src_verify_cert, _raw=True
+        )
+    except SaltInvocationError:
+        src_image = image_get(
+            source, src_remote_addr, src_cert,
+            src_key, src_verify_cert, _raw=True
+        )
+
+    # Will fail with a CommandExecutionError on connection problems.
+    dest_client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+
+    with _TransferSlots([src_remote_addr, remote_addr]) as slots:
+        progress = _TransferProgress(slots)
+        dest_image = _image_copy(
+            src_image, dest_client, public, auto_update, progress
+        )
+
+    transfer = progress.as_dict()
+    log.debug('Copied the image "{0}": {1}'.format(source, transfer))
+
+    # Aliases support
+    for alias in aliases:
+        image_alias_add(dest_image, alias)
+
+    if _raw:
+        return dest_image
+
+    result = _pylxd_model_to_dict(dest_image)
+    result['transfer'] = transfer
+    return result
+
+
+def _image_copy(image, dest_client, public=None, auto_update=None,
+                progress=None):
+    ''' Lets dest_client pull the image, like pylxd's Image.copy()
+        but it reports the progress of the operation.
+
+        This is an internal method, no CLI Example.
+    '''
+    try:
+        image.sync()
+
+        config = {
+            'filename': image.filename,
+            'public': image.public if public is None else public,
+            'auto_update': (
+                image.auto_update if auto_update is None else auto_update
+            ),
+            'properties': image.properties,
+            'source': {
+                'type': 'image',
+                'mode': 'pull',
+                'server': '/'.join(
+                    image.client.api._api_endpoint.split('/')[:-1]
+                ),
+                'protocol': 'lxd',
+                'fingerprint': image.fingerprint
+            }
+        }
+
+        if image.public is not True:
+            response = image.api.secret.post(json={})
+            config['source']['secret'] = \
+                response.json()['metadata']['metadata']['secret']
+            config['source']['certificate'] = \
+                image.client.host_info['environment']['certificate']
+
+        response = dest_client.api.images.post(json=config)
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
+
+    _pylxd_operation_wait(
+        dest_client, response.json()['operation'], progress
+    )
+
+    return dest_client.images.get(image.fingerprint)
+
+
+def image_alias_add(image,
+                    alias,
+                    description='',
+                    remote_addr=None,
+                    cert=None,
+                    key=None,
+                    verify_cert=True):
+    ''' Create an alias on the given image
+
+        image :
+            An image alias, a fingerprint or a image object
+
+        alias :
+            The alias to add
+
+        description :
+            Description of the alias
+
+        remote_addr :
+            An URL to a remote Server, you also have to give cert and key if
+            you provide remote_addr and its a TCP Address!
+
+            Examples:
+                https://myserver.lan:8443
+                /var/lib/mysocket.sock
+
+        cert :
+            PEM Formatted SSL Certificate.
+
+            Examples:
+                ~/.config/lxc/client.crt
+
+        key :
+            PEM Formatted SSL Key.
+
+            Examples:
+                ~/.config/lxc/client.key
+
+        verify_cert : True
+            Wherever to verify the cert, this is by default True
+            but in the most cases you want to set it off as LXD
+            normaly uses self-signed certificates.
+
+        CLI Examples:
+
+        .. code-block:: bash
+
+            $ salt '*' lxd.image_alias_add xenial/amd64 x "Short version of xenial/amd64"
+
+        # noqa
+    '''
+    image = _verify_image(image, remote_addr, cert, key, verify_cert)
+
+    for alias_info in image.aliases:
+        if alias_info['name'] == alias:
+            return True
+    image.add_alias(alias, description)
+
+    return True
+
+
+def image_alias_delete(image,
+                       alias,
+                       remote_addr=None,
+                       cert=None,
+                       key=None,
+                       verify_cert=True):
+    ''' Delete an alias (this is currently not restricted to the image)
+
+        image :
+            An image alias, a fingerprint or a image object
+
+        alias :
+            The alias to delete
+
+        remote_addr :
+            An URL to a remote Server, you also have to give cert and key if
+            you provide remote_addr and its a TCP Address!
+
+            Examples:
+                https://myserver.lan:8443
+                /var/lib/mysocket.sock
+
+        cert :
+            PEM Formatted SSL Certificate.
+
+            Examples:
+                ~/.config/lxc/client.crt
+
+        key :
+            PEM Formatted SSL Key.
+
+            Examples:
+                ~/.config/lxc/client.key
+
+        verify_cert : True
+            Wherever to verify the cert, this is by default True
+            but in the most cases you want to set it off as LXD
+            normaly uses self-signed certificates.
+
+        CLI Examples:
+
+        .. code-block:: bash
+
+            $ salt '*' lxd.image_alias_add xenial/amd64 x "Short version of xenial/amd64"
+
+        # noqa
+    '''
+    image = _verify_image(image, remote_addr, cert, key, verify_cert)
+
+    try:
+        image.delete_alias(alias)
+    except pylxd.exceptions.LXDAPIException:
+        return False
+
+    return True
+
+#####################
+# Snapshot Management
+#####################
+
+
+def snapshots_all(container=None, remote_addr=None,
+                  cert=None, key=None, verify_cert=True):
     containers = container_get(
         container, remote_addr, cert, key, verify_cert, _raw=True
     )
-    if container:
-        containers = [containers]
-    ret = {}
-    for cont in containers:
-        ret.update({cont.name: [{'name': c.name}
-                                for c in cont.snapshots.all()]})
+    if container:
+        containers = [containers]
+    ret = {}
+    for cont in containers:
+        ret.update({cont.name: [{'name': c.name}
+                                for c in cont.snapshots.all()]})
+
+    return ret
+
+
+def snapshots_create(container, name=None, remote_addr=None,
+                     cert=None, key=None, verify_cert=True):
+    cont = container_get(
+        container, remote_addr, cert, key, verify_cert, _raw=True
+    )
+    if not name:
+        name = datetime.now().strftime('%Y%m%d%H%M%S')
+
+    cont.snapshots.create(name, wait=True)
+
+    for c in snapshots_all(
+            container, remote_addr, cert, key, verify_cert
+    ).get(container):
+        if c.get('name') == name:
+            return {'name': name}
+
+    return {'name': False}
+
+
+def snapshots_delete(container, name, remote_addr=None,
+                     cert=None, key=None, verify_cert=True):
+    cont = container_get(
+        container, remote_addr, cert, key, verify_cert, _raw=True
+    )
+
+    try:
+        for s in cont.snapshots.all():
+            if s.name == name:
+                s.delete()
+                return True
+    except pylxd.exceptions.LXDAPIException:
+        pass
+
+    return False
+
+
+def snapshots_get(container, name, remote_addr=None,
+                  cert=None, key=None, verify_cert=True):
+    container = container_get(
+        container, remote_addr, cert, key, verify_cert, _raw=True
+    )
+    return container.snapshots.get(name)
+
+#####################
+# Inventory Management
+#####################
+
+
+def inventory(remote_addr=None, cert=None, key=None, verify_cert=True,
+              refresh=False):
+    '''
+    Get the containers, profiles and images of a remote, loaded with
+    one recursive request per kind on first use and kept for the rest
+    of the run. The states read their objects from it.
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    refresh : False
+        Reload it
+
+    Returns a dict with the containers and profiles by name,
+    the images by fingerprint and the image aliases.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.inventory
+    '''
+    if refresh:
+        for kind in _inventory_kinds:
+            inventory_update(
+                kind, None, remote_addr, cert, key, verify_cert
+            )
+
+    with _inventory_lock(remote_addr, cert, key, verify_cert):
+        inv = dict(
+            (kind, _inventory_kind(kind, remote_addr, cert, key, verify_cert))
+            for kind in _inventory_kinds
+        )
+        inv['aliases'] = _inventory_aliases(inv['images'])
+        return copy.deepcopy(inv)
+
+
+def inventory_object(kind, name, remote_addr=None, cert=None, key=None,
+                     verify_cert=True, _raw=False):
+    '''
+    Get a container, profile or image from the inventory of the remote,
+    without a request once the inventory got loaded.
+
+    kind :
+        One of "containers", "profiles" or "images"
+
+    name :
+        The name of the container or profile, the alias or the
+        fingerprint of the image.
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    _raw :
+        Return the pylxd object, this is internal and by states in use.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.inventory_object containers web01
+        salt '*' lxd.inventory_object images xenial/amd64
+    '''
+    with _inventory_lock(remote_addr, cert, key, verify_cert):
+        objects = _inventory_kind(kind, remote_addr, cert, key, verify_cert)
+
+        key_name = name
+        if kind == 'images' and name not in objects:
+            key_name = _inventory_aliases(objects).get(name)
+
+        if key_name not in objects:
+            raise SaltInvocationError(
+                '{0} \'{1}\' not found'.format(
+                    kind[:-1].capitalize(), name)
+            )
+        metadata = copy.deepcopy(objects[key_name])
+
+    client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+    obj = _inventory_models[kind](client, **metadata)
+
+    if _raw:
+        return obj
+
+    return _pylxd_model_to_dict(obj)
+
+
+def inventory_update(kind, name=None, remote_addr=None, cert=None,
+                     key=None, verify_cert=True):
+    '''
+    Refresh an object in the inventory of the remote after changing it,
+    without name the whole kind gets reloaded on its next use.
+
+    kind :
+        One of "containers", "profiles" or "images"
+
+    name :
+        The name of the container or profile, the alias or the
+        fingerprint of the image.
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if
+        you provide remote_addr and its a TCP Address!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Certificate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' lxd.inventory_update containers web01
+    '''
+    if kind not in _inventory_kinds:
+        raise SaltInvocationError(
+            'kind must be one of {0}'.format(', '.join(_inventory_kinds))
+        )
+
+    with _inventory_lock(remote_addr, cert, key, verify_cert):
+        remote = __context__.get('lxd.inventory', {}).get(
+            _pool_key(remote_addr, cert, key, verify_cert), {}
+        )
+        if kind not in remote:
+            # Not loaded, nothing to refresh.
+            return True
+
+        if name is None:
+            del remote[kind]
+            return True
+
+        objects = remote[kind]
+        client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+        api = getattr(client.api, kind)
+        try:
+            if kind == 'images' and name not in objects:
+                name = api.aliases[name].get().json()['metadata']['target']
+            metadata = api[name].get().json()['metadata']
+        except pylxd.exceptions.NotFound:
+            if kind != 'images':
+                objects.pop(name, None)
+            else:
+                # An alias or an image is gone.
+                del remote[kind]
+            return True
+        except pylxd.exceptions.LXDAPIException as e:
+            raise CommandExecutionError(six.text_type(e))
+
+        if kind == 'images':
+            # Aliases may have moved from another image to this one.
+            aliases = set(a['name'] for a in metadata.get('aliases') or [])
+            for image in six.itervalues(objects):
+                image['aliases'] = [a for a in image.get('aliases') or []
+                                    if a['name'] not in aliases]
+            name = metadata['fingerprint']
+        objects[name] = metadata
+
+    return True
+
+
+################
+# Helper Methods
+################
+
+
+def normalize_input_values(config, devices):
+    # This is special for pcdummy and his ext_pillar mongo usage.
+    #
+    # It translates:
+    #    [{key: key1, value: value1}, {key: key2, value: value2}]
+    # to:
+    #    {key1: value1, key2: value2}
+    #
+    # MongoDB doesn't like dots in field names.
+    if isinstance(config, list):
+        if (config and
+                'key' in config[0] and
+                'value' in config[0]):
+            config = {d['key']: d['value'] for d in config}
+        else:
+            config = {}
+
+    if isinstance(config, six.string_types):
+        raise SaltInvocationError(
+            "config can't be a string, validate your YAML input."
+        )
+
+    if isinstance(devices, six.string_types):
+        raise SaltInvocationError(
+            "devices can't be a string, validate your YAML input."
+        )
+
+    # Golangs wants strings
+    if config is not None:
+        for k, v in six.iteritems(config):
+            config[k] = six.text_type(v)
+    if devices is not None:
+        for dn in devices:
+            for k, v in six.iteritems(devices[dn]):
+                devices[dn][k] = v
+
+    return (config, devices,)
+
+
+def config_devices_diff(obj, newconfig, newdevices):
+    ''' Diffs the given config and devices against the object
+        (a profile or a container) without changing anything.
+
+        Returns a dict with a "config" and/or a "devices" list of
+        (op, key, old, new) tuples, op is one of "add", "change" and
+        "remove". Returns an empty dict when nothing differs.
+
+        LXD internals (volatile.* and image.* config keys and the
+        root device) and the user.salt.fingerprint key are ignored.
+
+        obj :
+            The object to diff with.
+
+        newconfig:
+            The new config to check with the obj.
+
+        newdevices:
+            The new devices to check with the obj.
+    '''
+    config, devices = _config_devices_canonical(newconfig, newdevices)
+    have_config, have_devices = _config_devices_canonical(
+        obj.config, obj.devices
+    )
+
+    # Most runs change nothing, one dict compare tells us that.
+    if config == have_config and devices == have_devices:
+        return {}
+
+    diff = {}
+    for section, new, have in (('config', config, have_config),
+                               ('devices', devices, have_devices)):
+        section_diff = []
+        for k in sorted(set(new) | set(have)):
+            if k not in have:
+                section_diff.append(('add', k, None, new[k]))
+            elif k not in new:
+                section_diff.append(('remove', k, have[k], None))
+            elif new[k] != have[k]:
+                section_diff.append(('change', k, have[k], new[k]))
+        if section_diff:
+            diff[section] = section_diff
+
+    return diff
+
+
+def sync_config_devices(obj, newconfig, newdevices, test=False):
+    ''' Syncs the given config and devices with the object
+        (a profile or a container)
+        returns a changes dict with all changes made.
+
+        Use config_devices_diff to get the changes as (op, key, old, new)
+        tuples.
+
+        obj :
+            The object to sync with / or just test with.
+
+        newconfig:
+            The new config to check with the obj.
+
+        newdevices:
+            The new devices to check with the obj.
+
+        test:
+            Wherever to not change anything and give "Would change" message.
+    '''
+    changes = {}
+    diff = config_devices_diff(obj, newconfig, newdevices)
+
+    config_changes = {}
+    for op, k, old, new in diff.get('config', []):
+        config_changes[k] = _config_change_messages[op][test].format(
+            k, new, old
+        )
+        if test:
+            continue
+        if op == 'remove':
+            del obj.config[k]
+        else:
+            obj.config[k] = new
+
+    if config_changes:
+        changes['config'] = config_changes
+
+    devices_changes = {}
+    for op, k, old, new in diff.get('devices', []):
+        devices_changes[k] = _device_change_messages[op][test].format(k)
+        if test:
+            continue
+        if op == 'remove':
+            del obj.devices[k]
+        else:
+            # The given values, not their canonical form.
+            obj.devices[k] = newdevices[k]
+
+    if devices_changes:
+        changes['devices'] = devices_changes
+
+    return changes
+
+
+# Messages of sync_config_devices by op and test,
+# formatted with the key, the new and the old value.
+_config_change_messages = {
+    'add': {
+        False: 'Added config key "{0}" = "{1}"',
+        True: 'Would add config key "{0}" = "{1}"',
+    },
+    'change': {
+        False: 'Changed config key "{0}" to "{1}", its value was "{2}"',
+        True: ('Would change config key "{0}" to "{1}", '
+               'its current value is "{2}"'),
+    },
+    'remove': {
+        False: 'Removed config key "{0}", its value was "{2}"',
+        True: 'Would remove config key "{0}" with value "{2}"',
+    },
+}
+
+_device_change_messages = {
+    'add': {
+        False: 'Added device "{0}"',
+        True: 'Would add device "{0}"',
+    },
+    'change': {
+        False: 'Changed device "{0}"',
+        True: 'Would change device "{0}"',
+    },
+    'remove': {
+        False: 'Removed device "{0}"',
+        True: 'Would remove device "{0}"',
+    },
+}
+
+
+def _config_devices_canonical(config, devices):
+    ''' Returns config and devices with text keys and values and
+        without the LXD internals, the form config_devices_diff compares.
+    '''
+    canonical_config = {}
+    for k, v in six.iteritems(config or {}):
+        k = six.text_type(k)
+        # Ignore LXD internals and our fingerprint.
+        if (k.startswith('volatile.') or k.startswith('image.') or
+                k == FINGERPRINT_CONFIG_KEY):
+            continue
+        canonical_config[k] = six.text_type(v)
+
+    canonical_devices = {}
+    for k, v in six.iteritems(devices or {}):
+        k = six.text_type(k)
+        # Ignore LXD internals.
+        if k == u'root':
+            continue
+        canonical_devices[k] = dict(
+            (six.text_type(dk), six.text_type(dv))
+            for dk, dv in six.iteritems(v or {})
+        )
+
+    return canonical_config, canonical_devices
+
+
+def spec_fingerprint(profiles=None, config=None, devices=None,
+                     description=None):
+    ''' Returns a hash of the given desired spec as given to the states,
+        present stores it in the "user.salt.fingerprint" config key.
+
+        The input isn't normalized, that's what makes it cheap.
+    '''
+    return hashlib.sha256(json.dumps(
+        [profiles, config, devices, description],
+        sort_keys=True, default=six.text_type
+    ).encode('utf-8')).hexdigest()
+
+
+def fingerprint_unchanged(obj, fingerprint, remote_addr=None):
+    ''' Returns True when the object (a profile or a container) has
+        been synced with the spec of fingerprint and nobody changed it
+        since, so there is no need to diff it.
+
+        The state of the object is compared with the one cached by
+        fingerprint_save, like a HTTP ETag. The object comes from a
+        get or a list, which don't keep the ETag header, asking LXD for
+        it would cost the extra GET per object this check saves.
+
+        obj :
+            The object to check.
+
+        fingerprint:
+            The spec_fingerprint of the desired spec.
+
+        remote_addr:
+            The remote the object is on.
+    '''
+    if obj.config.get(FINGERPRINT_CONFIG_KEY) != fingerprint:
+        return False
+
+    cache = _fingerprint_cache()
+    return cache.get(_fingerprint_cache_key(obj, remote_addr)) == \
+        _observed_digest(obj)
+
+
+def fingerprint_set(obj, fingerprint):
+    ''' Stores fingerprint in the config of the object (a profile or a
+        container), returns True when it changed. The object still
+        has to be saved.
+
+        obj :
+            The object to tag.
+
+        fingerprint:
+            The spec_fingerprint of the desired spec.
+    '''
+    if obj.config.get(FINGERPRINT_CONFIG_KEY) == fingerprint:
+        return False
+    obj.config[FINGERPRINT_CONFIG_KEY] = fingerprint
+    return True
+
+
+def fingerprint_save(obj, remote_addr=None):
+    ''' Caches the state of the object (a profile or a container)
+        after it got saved, see fingerprint_unchanged.
+
+        obj :
+            The saved object.
+
+        remote_addr:
+            The remote the object is on.
+    '''
+    cache = _fingerprint_cache()
+    cache.set(_fingerprint_cache_key(obj, remote_addr), _observed_digest(obj))
+
+
+def _fingerprint_cache():
+    ''' The observed digests of all objects, loaded once per run and
+        written once when the run is over (the cache gets dropped with
+        __context__ or the process exits).
+    '''
+    with _context_lock:
+        if 'lxd.fingerprints' not in __context__:
+            cache = _ManifestCache('fingerprints')
+            cache.save_at_exit()
+            __context__['lxd.fingerprints'] = cache
+        return __context__['lxd.fingerprints']
+
+
+def _fingerprint_forget(obj, remote_addr):
+    ''' Drops the observed digest of a deleted object. '''
+    cache = _fingerprint_cache()
+    cache.discard(_fingerprint_cache_key(obj, remote_addr))
+
+
+def _fingerprint_cache_key(obj, remote_addr):
+    return '|'.join([
+        remote_addr or 'local', obj.__class__.__name__.lower(), obj.name
+    ])
+
+
+def _observed_digest(obj):
+    ''' sha256 of what LXD builds the ETag of the object from,
+        computed from the already fetched object as its ETag header
+        is only known after another GET.
+    '''
+    config, devices = _config_devices_canonical(obj.config, obj.devices)
+    return hashlib.sha256(json.dumps(
+        [config, devices, getattr(obj, 'profiles', None),
+         getattr(obj, 'description', None)],
+        sort_keys=True, default=six.text_type
+    ).encode('utf-8')).hexdigest()
+
+
+def state_aggregate(low, chunks, running, funs):
+    ''' The mod_aggregate of the lxd states, folds the other states
+        with the same state function and remote into low, which
+        applies them all concurrently with state_batch.
+
+        States with other requisites than low or with onchanges,
+        watch, onfail, prereq or listen requisites are not folded.
+        The folded states get their batch arg set to True, they return
+        the ret recorded when low applied them.
+
+        low :
+            The low chunk Salt is going to run.
+
+        chunks :
+            All low chunks of the run.
+
+        running :
+            The rets of the chunks run so far by their tag.
+
+        funs :
+            The state functions which can get folded by name.
+
+    This is an internal method, no CLI Example.
+    '''
+    if (low.get('fun') not in funs or low.get('batch') is True or
+            any(low.get(req) for req in _aggregate_conditional_requisites)):
+        return low
+
+    code = funs[low['fun']].__code__
+    args = code.co_varnames[:code.co_argcount]
+    batch = []
+    for chunk in chunks:
+        if (chunk.get('state') != low.get('state') or
+                chunk.get('fun') != low.get('fun') or
+                '__agg__' in chunk or
+                _state_tag(chunk) in running or
+                _state_tag(chunk) == _state_tag(low)):
+            continue
+
+        if any(chunk.get(k) != low.get(k) for k in _aggregate_remote_args):
+            continue
+
+        if any(chunk.get(req)
+               for req in _aggregate_conditional_requisites):
+            continue
+
+        if any(r not in (low.get(req) or [])
+               for req in _aggregate_requisites
+               for r in chunk.get(req) or []):
+            continue
+
+        batch.append(dict(
+            (k, chunk[k]) for k in args if k in chunk and k != 'batch'
+        ))
+        chunk['__agg__'] = True
+        chunk['batch'] = True
+
+    if batch:
+        low['batch'] = (low.get('batch') or []) + batch
+
+    return low
+
+
+def state_batch(fun, kwargs, concurrency=10):
+    ''' Applies the state fun with kwargs (its locals()) and the states
+        state_aggregate folded into it (kwargs["batch"]) concurrently,
+        returns the ret of kwargs and records the others for when Salt
+        runs them.
+
+        With kwargs["batch"] True it returns the recorded ret.
+
+    This is an internal method, no CLI Example.
+    '''
+    batched = __context__.setdefault('lxd.batched', {})
+    if kwargs['batch'] is True:
+        with _context_lock:
+            ret = batched.pop(_batch_key(fun, kwargs['name'], kwargs), None)
+        if ret is not None:
+            return ret
+        # The aggregating state didn't run, apply it now.
+        return fun(**dict(kwargs, batch=None))
+
+    calls = [dict(kwargs, batch=None)] + kwargs['batch']
+    pool = ThreadPool(min(len(calls), concurrency))
+    try:
+        rets = pool.map(lambda call: fun(**call), calls)
+    finally:
+        pool.terminate()
+
+    with _context_lock:
+        for call, ret in zip(calls[1:], rets[1:]):
+            batched[_batch_key(fun, call['name'], kwargs)] = ret
+
+    return rets[0]
+
+
+def _batch_key(fun, name, kwargs):
+    ''' The key of a folded state, the remote args are the same for
+        all states of a batch.
+    '''
+    return tuple(
+        [fun.__module__, fun.__name__, name] +
+        [six.text_type(kwargs.get(k)) for k in _aggregate_remote_args]
+    )
+
+
+def _state_tag(low):
+    ''' The tag Salt keeps the ret of a low chunk under. '''
+    return '{0[state]}_|-{0[__id__]}_|-{0[name]}_|-{0[fun]}'.format(low)
+
+
+def _set_property_dict_item(obj, prop, key, value, base=None):
+    ''' Sets the dict item key of the attr from obj.
+
+        Basicaly it does getattr(obj, prop)[key] = value.
+
+
+        For the disk device we added some checks to make
+        device changes on the CLI saver.
+    '''
+    return _set_property_dict_items(obj, prop, {key: value}, base=base)
+
+
+def _set_property_dict_items(obj, prop, values, delete=None, base=None):
+    ''' Sets the dict items of values and deletes the keys in delete
+        of the attr from obj and saves it once.
+
+        base is the pylxd_object_state of obj, _pylxd_object_get
+        returns it with the object, else it costs another GET.
+    '''
+    if isinstance(values, six.string_types) or \
+            isinstance(delete, six.string_types):
+        raise SaltInvocationError(
+            "{0} can't be a string, validate your input.".format(prop)
+        )
+
+    if base is None:
+        base = pylxd_object_state(obj)
+    attr = getattr(obj, prop)
+    for key in delete or []:
+        attr.pop(key, None)
+    for key, value in six.iteritems(values or {}):
+        _check_property_dict_item(prop, value)
+        attr[key] = value if prop == 'devices' else six.text_type(value)
+
+    pylxd_save_object(obj, base)
+
+    return _pylxd_model_to_dict(obj)
+
+
+def _devices_text(devices):
+    ''' LXD wants strings as device args. '''
+    return dict(
+        (device_name, dict((k, six.text_type(v))
+                           for k, v in six.iteritems(device)))
+        for device_name, device in six.iteritems(devices or {})
+    )
+
+
+def _check_property_dict_item(prop, value):
+    ''' Checks a device and strips the salt internal "__" args. '''
+    if prop != 'devices':
+        return
+
+    device_type = value['type']
+
+    if device_type == 'disk':
+
+        if 'path' not in value:
+            raise SaltInvocationError(
+                "path must be given as parameter"
+            )
+
+        if value['path'] != '/' and 'source' not in value:
+            raise SaltInvocationError(
+                "source must be given as parameter"
+            )
+
+    for k in list(value.keys()):
+        if k.startswith('__'):
+            del value[k]
+
+
+def _get_property_dict_item(obj, prop, key):
+    attr = getattr(obj, prop)
+    if key not in attr:
+        raise SaltInvocationError(
+            "'{0}' doesn't exists".format(key)
+        )
+
+    return attr[key]
+
+
+def _delete_property_dict_item(obj, prop, key, base=None):
+    attr = getattr(obj, prop)
+    if key not in attr:
+        raise SaltInvocationError(
+            "'{0}' doesn't exists".format(key)
+        )
+
+    if base is None:
+        base = pylxd_object_state(obj)
+    del attr[key]
+    pylxd_save_object(obj, base)
+
+    return True
+
+
+def _verify_image(image,
+                  remote_addr=None,
+                  cert=None,
+                  key=None,
+                  verify_cert=True):
+    # Get image by alias/fingerprint or check for fingerprint attribute
+    if isinstance(image, six.string_types):
+        name = image
+
+        # This will fail with a SaltInvocationError if
+        # the image doesn't exists on the source and with a
+        # CommandExecutionError on connection problems.
+        image = None
+        try:
+            image = image_get_by_alias(
+                name, remote_addr, cert,
+                key, verify_cert, _raw=True
+            )
+        except SaltInvocationError:
+            image = image_get(
+                name, remote_addr, cert,
+                key, verify_cert, _raw=True
+            )
+    elif not hasattr(image, 'fingerprint'):
+        raise SaltInvocationError(
+            'Invalid image \'{0}\''.format(image)
+        )
+    return image
+
+
+def _pylxd_migration_data(container):
+    ''' Generates the data for a migration (copy/move) of the container,
+        pylxd's generate_migration_data() doesn't keep the profiles
+        and the ephemeral flag.
+    '''
+    container.sync()
+    response = container.api.post(json={'migration': True})
+    operation_id = response.json()['operation'].split('/')[-1]
+
+    return {
+        'name': container.name,
+        'architecture': container.architecture,
+        'config': container.config,
+        'devices': container.devices,
+        'ephemeral': container.ephemeral,
+        'profiles': container.profiles,
+        'source': {
+            'type': 'migration',
+            'operation': container.client.api.operations[
+                operation_id]._api_endpoint,
+            'mode': 'pull',
+            'certificate': container.client.host_info[
+                'environment']['certificate'],
+            'secrets': response.json()['metadata']['metadata'],
+        }
+    }
+
+
+def _container_copy(container, dest_client, refresh=False, progress=None):
+    ''' Lets dest_client pull the container, with refresh=True only the
+        difference to the existing destination container gets transfered.
+
+        This is an internal method, no CLI Example.
+    '''
+    if container.client.api._api_endpoint.startswith('http+unix://'):
+        raise SaltInvocationError(
+            'Cannot migrate from a local client connection'
+        )
+
+    try:
+        migration_data = _pylxd_migration_data(container)
+        if refresh:
+            migration_data['source']['refresh'] = True
+        response = dest_client.api.containers.post(json=migration_data)
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
+
+    if progress is not None:
+        progress.next_operation()
+    _pylxd_operation_wait(
+        dest_client, response.json()['operation'], progress
+    )
+
+    return dest_client.containers.get(container.name)
+
+
+def _pylxd_operation_wait(client, operation, progress=None, interval=1):
+    ''' Waits for an operation to finish, feeds its metadata to progress
+        while it runs and raises a CommandExecutionError on failure.
+
+        This is an internal method, no CLI Example.
+    '''
+    operation_id = operation.split('/')[-1]
+    while True:
+        try:
+            data = client.api.operations[
+                operation_id].get().json()['metadata']
+        except pylxd.exceptions.LXDAPIException as e:
+            raise CommandExecutionError(six.text_type(e))
+
+        if progress is not None and data.get('metadata'):
+            progress.update(data['metadata'])
+
+        # Keep in sync with: https://github.com/lxc/lxd/blob/master/shared/api/status_code.go  # noqa
+        if data['status_code'] == 200:
+            return data
+        if data['status_code'] >= 400:
+            raise CommandExecutionError(
+                data.get('err') or data.get('status')
+            )
+
+        time.sleep(interval)
+
+
+def _parse_byte_size(value):
+    ''' Translates 1024, "1024", "1kB", "1.5MiB" or "2G" to bytes. '''
+    if value is None or isinstance(value, six.integer_types + (float,)):
+        return value
+
+    match = re.match(
+        r'^\s*([\d.]+)\s*([kKMGTPE]?)(?:i?B)?\s*$', six.text_type(value)
+    )
+    if match is None:
+        raise SaltInvocationError(
+            'Invalid byte size "{0}"'.format(value)
+        )
+    return int(float(match.group(1)) * _byte_units[match.group(2).upper()])
+
+
+class _TransferProgress(object):
+    ''' Collects the progress LXD reports in the operation metadata
+        of transfers (fs_progress, download_progress, ...).
+    '''
+
+    def __init__(self, slots=None):
+        self.slots = slots
+        self.started = time.time()
+        self.bytes = 0
+        self.rate = 0
+        self.percent = None
+        self._offset = 0
+
+    def next_operation(self):
+        ''' Another operation starts counting from 0 '''
+        self._offset = self.bytes
+
+    def update(self, metadata):
+        for key, value in six.iteritems(metadata):
+            if isinstance(value, dict) and key == 'progress':
+                # Newer LXD versions give us the numbers.
+                if 'processed' in value:
+                    self.bytes = self._offset + int(value['processed'])
+                if 'speed' in value:
+                    self.rate = int(value['speed'])
+                if 'percent' in value:
+                    self.percent = int(value['percent'])
+                continue
+
+            if (not key.endswith('_progress') or
+                    not isinstance(value, six.string_types)):
+                continue
+
+            match = _progress_regex.search(value)
+            if match is None:
+                continue
+            if match.group('percent') is not None:
+                self.percent = int(match.group('percent'))
+            if match.group('size') is not None:
+                self.bytes = self._offset + _parse_byte_size(
+                    match.group('size')
+                )
+            if match.group('rate') is not None:
+                self.rate = _parse_byte_size(match.group('rate'))
+
+        if self.slots is not None:
+            self.slots.update(self.rate)
+
+    def as_dict(self):
+        duration = time.time() - self.started
+        return {
+            'bytes': self.bytes,
+            'rate': self.rate,
+            'average_rate': int(self.bytes / duration) if duration else 0,
+            'percent': self.percent,
+            'duration': round(duration, 3),
+        }
+
+
+class _FileTransferStats(object):
+    ''' Counts the files and bytes of file transfers, thread safe. '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.files = 0
+        self.bytes = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def chunks(self, fp, chunk_size=None, digest=None):
+        ''' Yields fp in chunks of chunk_size bytes and counts them
+            once all got sent, a generator makes requests stream the
+            body. The chunks get fed into digest (a hashlib object)
+            when given.
+        '''
+        chunk_size = chunk_size or _upload_chunk_size
+        sent = 0
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            sent += len(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            yield chunk
+        self.add(sent, 1)
+
+    def reader(self, fp):
+        ''' Returns a file object like fp which counts the bytes read. '''
+        stats = self
+
+        class _Reader(object):
+            def read(self, size=-1):
+                data = fp.read(size)
+                with stats._lock:
+                    stats.bytes += len(data)
+                return data
+
+        return _Reader()
+
+    def add(self, nbytes, files=0):
+        with self._lock:
+            self.bytes += nbytes
+            self.files += files
+
+    def retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def as_dict(self):
+        duration = time.time() - self.started
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'duration': round(duration, 3),
+            'rate': int(self.bytes / duration) if duration else 0,
+            'mb_rate': round(self.bytes / duration / 1024 ** 2, 2)
+            if duration else 0,
+            'files_rate': round(self.files / duration, 1) if duration else 0,
+            'retries': self.retries,
+        }
+
+
+class _TransferSlots(object):
+    ''' Waits for and holds a transfer slot in the global scope and for
+        each of the given remotes as configured in "lxd:transfers".
+
+        The slots are flock()ed files in the minion cachedir, so the limits
+        count for all salt processes of the minion and a slot gets freed
+        by the kernel if its process dies.
+
+        LXD transfers images and containers from daemon to daemon, there
+        is nothing we could slow down while they run. So max_rate is
+        an admission limit, the holders write their current rate into
+        their slot files and new transfers wait until the sum of them
+        is below max_rate.
+    '''
+
+    def __init__(self, remote_addrs):
+        limits = __salt__['config.get']('lxd:transfers', {}) or {}
+        remotes = limits.get('remotes', {}) or {}
+
+        self.wait_timeout = limits.get('wait_timeout', 3600)
+        self.scopes = [('global', limits)]
+        for remote_addr in sorted(set([six.text_type(r)
+                                       for r in remote_addrs if r])):
+            if remote_addr in remotes:
+                self.scopes.append((remote_addr, remotes[remote_addr]))
+
+        self.directory = os.path.join(
+            __opts__['cachedir'], 'lxd', 'transfers'
+        )
+        self._held = []
+
+    def __enter__(self):
+        deadline = time.time() + self.wait_timeout
+
+        # Always in the same order, global first.
+        for scope, limits in self.scopes:
+            if not limits.get('max_concurrent') and not limits.get('max_rate'):
+                continue
+
+            fp = self._acquire(scope, limits)
+            while fp is None:
+                if time.time() > deadline:
+                    self.release()
+                    raise CommandExecutionError(
+                        ('Timed out waiting for a free transfer slot '
+                         'in "{0}"').format(scope)
+                    )
+                time.sleep(1)
+                fp = self._acquire(scope, limits)
+
+            self._held.append(fp)
+
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _acquire(self, scope, limits):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        prefix = hashlib.sha1(scope.encode('utf-8')).hexdigest()[:12]
+
+        max_rate = _parse_byte_size(limits.get('max_rate'))
+        if max_rate and self._current_rate(prefix) >= max_rate:
+            return None
+
+        if limits.get('max_concurrent'):
+            indexes = range(int(limits['max_concurrent']))
+        else:
+            indexes = itertools.count()
+
+        for idx in indexes:
+            fp = salt.utils.fopen(
+                os.path.join(self.directory, '{0}.{1}'.format(prefix, idx)),
+                'a+'
+            )
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                fp.close()
+                continue
+
+            fp.seek(0)
+            fp.truncate()
+            return fp
+
+        return None
+
+    def _current_rate(self, prefix):
+        rate = 0
+        for fname in os.listdir(self.directory):
+            if not fname.startswith(prefix + '.'):
+                continue
+
+            with salt.utils.fopen(
+                    os.path.join(self.directory, fname), 'r') as fp:
+                try:
+                    # Free slot, maybe a stale rate of a died process.
+                    fcntl.flock(fp, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+                    continue
+                except IOError:
+                    pass
+
+                try:
+                    rate += int(fp.read().strip() or 0)
+                except ValueError:
+                    pass
+
+        return rate
+
+    def update(self, rate):
+        for fp in self._held:
+            fp.seek(0)
+            fp.truncate()
+            fp.write(six.text_type(rate))
+            fp.flush()
+
+    def release(self):
+        while self._held:
+            fp = self._held.pop()
+            fp.seek(0)
+            fp.truncate()
+            fcntl.flock(fp, fcntl.LOCK_UN)
+            fp.close()
+
+
+def _pylxd_containers_with_state(client):
+    ''' Gets all containers with a single recursive request,
+        returns a list of pylxd containers and a dict
+        of name -> state dict (empty when LXD is too old
+        to include the state).
+    '''
+    recursion = 1
+    if 'container_full' in client.host_info.get('api_extensions', []):
+        recursion = 2
+
+    try:
+        response = client.api.containers.get(params={'recursion': recursion})
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
+
+    containers = []
+    states = {}
+    for data in response.json()['metadata']:
+        state = data.pop('state', None)
+        data.pop('snapshots', None)
+        data.pop('backups', None)
+        if state is not None:
+            states[data['name']] = state
+        containers.append(Container(client, **data))
+
+    return (containers, states)
+
+
+def _snapshot_delete_quietly(container, name):
+    try:
+        container.snapshots.get(name).delete(wait=True)
+    except pylxd.exceptions.LXDAPIException as e:
+        log.warning('Failed to delete the snapshot "{0}/{1}": {2}'.format(
+            container.name, name, six.text_type(e)
+        ))
+
+
+def _container_exec(container, cmd, stdout_handler, stderr_handler,
+                    environment=None, cwd=None, user=None, group=None,
+                    stdin=None, timeout=None):
+    ''' Runs cmd in the container over the exec websockets, passes the
+        output chunks (bytes) to the handlers as they arrive
+        and returns a tuple (exit code, timed out).
+
+        stdin can be a string, bytes or a file object, the process
+        gets killed with SIGKILL after timeout seconds.
+    '''
+    if not WS4PY_AVAILABLE:
+        raise CommandExecutionError(
+            'Streaming exec requires the ws4py python module.'
+        )
+
+    if isinstance(cmd, six.string_types):
+        raise SaltInvocationError('cmd must be a list.')
+
+    client = container.client
+    extensions = client.host_info.get('api_extensions', [])
+
+    data = {
+        'command': list(cmd),
+        'environment': environment or {},
+        'wait-for-websocket': True,
+        'interactive': False,
+    }
+
+    if cwd is not None or user is not None or group is not None:
+        if 'container_exec_user_group_cwd' not in extensions:
+            raise SaltInvocationError(
+                'cwd, user and group need the LXD API extension '
+                '"container_exec_user_group_cwd"'
+            )
+        if cwd is not None:
+            data['cwd'] = cwd
+        if user is not None:
+            data['user'] = int(user)
+        if group is not None:
+            data['group'] = int(group)
+
+    kill_by_signal = 'container_exec_signal_handling' in extensions
+    if timeout is not None and not kill_by_signal:
+        # Let coreutils kill it inside the container.
+        data['command'] = (
+            ['timeout', '-s', 'KILL', six.text_type(timeout)] + data['command']
+        )
+
+    try:
+        response = container.api['exec'].post(json=data)
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
 
-    return ret
+    fds = response.json()['metadata']['metadata']['fds']
+    operation_id = response.json()['operation'].split('/')[-1]
+    path = _urlparse(
+        client.api.operations[operation_id].websocket._api_endpoint
+    ).path
 
+    timed_out = False
+    manager = WebSocketManager()
+    control = None
+    try:
+        if timeout is not None and kill_by_signal:
+            control = WebSocketBaseClient(client.websocket_url)
+            control.resource = '{0}?secret={1}'.format(
+                path, fds['control']
+            )
+            control.connect()
 
-def snapshots_create(container, name=None, remote_addr=None,
-                     cert=None, key=None, verify_cert=True):
-    cont = container_get(
-        container, remote_addr, cert, key, verify_cert, _raw=True
-    )
-    if not name:
-        name = datetime.now().strftime('%Y%m%d%H%M%S')
+        stdin_ws = _ExecWebsocket(None, None, client.websocket_url)
+        stdin_ws.resource = '{0}?secret={1}'.format(path, fds['0'])
+        stdin_ws.connect()
 
-    cont.snapshots.create(name)
+        for fd, handler in (('1', stdout_handler), ('2', stderr_handler)):
+            ws = _ExecWebsocket(manager, handler, client.websocket_url)
+            ws.resource = '{0}?secret={1}'.format(path, fds[fd])
+            ws.connect()
 
-    for c in snapshots_all(container).get(container):
-        if c.get('name') == name:
-            return {'name': name}
+        manager.start()
 
-    return {'name': False}
+        # The command starts once all websockets are connected,
+        # feed it from a thread to keep reading its output.
+        feeder = threading.Thread(
+            target=stdin_ws.send_payload, args=(stdin,)
+        )
+        feeder.daemon = True
+        feeder.start()
+        deadline = None if timeout is None else time.time() + timeout
+        while manager.websockets:
+            if deadline is not None and time.time() > deadline:
+                timed_out = True
+                deadline = None
+                if control is not None:
+                    control.send(json.dumps(
+                        {'command': 'signal', 'signal': 9}
+                    ))
+            time.sleep(.1)
+    finally:
+        manager.stop()
+        if control is not None:
+            control.close()
+
+    try:
+        operation = client.operations.wait_for_operation(operation_id)
+    except pylxd.exceptions.NotFound:
+        # The operation is already gone, see container_execute.
+        return (0, timed_out)
 
+    exit_code = int(operation.metadata['return'])
+    if not kill_by_signal and exit_code == 137 and timeout is not None:
+        timed_out = True
 
-def snapshots_delete(container, name, remote_addr=None,
-                     cert=None, key=None, verify_cert=True):
-    cont = container_get(
-        container, remote_addr, cert, key, verify_cert, _raw=True
-    )
+    return (exit_code, timed_out)
 
-    try:
-        for s in cont.snapshots.all():
-            if s.name == name:
-                s.delete()
-                return True
-    except pylxd.exceptions.LXDAPIException:
-        pass
 
-    return False
+class _BoundedOutput(object):
+    ''' Keeps the first head_bytes and the last tail_bytes of an
+        exec output stream, optional copies everything to fp
+        and calls line_callback(name, line) per line.
+    '''
+    def __init__(self, name, head_bytes=None, tail_bytes=0, fp=None,
+                 line_callback=None):
+        self.name = name
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes or 0
+        self.fp = fp
+        self.line_callback = line_callback
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self._partial = b''
+
+    def write(self, data):
+        data = bytes(data)
+        self.total += len(data)
+
+        if self.fp is not None:
+            self.fp.write(data)
+
+        if self.line_callback is not None:
+            lines = (self._partial + data).split(b'\n')
+            self._partial = lines.pop()
+            for line in lines:
+                self.line_callback(
+                    self.name, line.decode('utf-8', 'replace')
+                )
 
+        if self.head_bytes is None:
+            self.head += data
+            return
 
-def snapshots_get(container, name, remote_addr=None,
-                  cert=None, key=None, verify_cert=True):
-    container = container_get(
-        container, remote_addr, cert, key, verify_cert, _raw=True
-    )
-    return container.snapshots.get(name)
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
 
-################
-# Helper Methods
-################
+        if data and self.tail_bytes:
+            self.tail += data
+            if len(self.tail) > self.tail_bytes:
+                del self.tail[:len(self.tail) - self.tail_bytes]
 
+    def flush(self):
+        if self.line_callback is not None and self._partial:
+            self.line_callback(
+                self.name, self._partial.decode('utf-8', 'replace')
+            )
+        self._partial = b''
+
+    @property
+    def truncated(self):
+        return self.total - len(self.head) - len(self.tail)
+
+    @property
+    def text(self):
+        head = self.head.decode('utf-8', 'replace')
+        tail = self.tail.decode('utf-8', 'replace')
+        if self.truncated:
+            return '{0}\n[... {1} bytes truncated ...]\n{2}'.format(
+                head, self.truncated, tail
+            )
+        return head + tail
 
-def normalize_input_values(config, devices):
-    # This is special for pcdummy and his ext_pillar mongo usage.
-    #
-    # It translates:
-    #    [{key: key1, value: value1}, {key: key2, value: value2}]
-    # to:
-    #    {key1: value1, key2: value2}
-    #
-    # MongoDB doesn't like dots in field names.
-    if isinstance(config, list):
-        if (config and
-                'key' in config[0] and
-                'value' in config[0]):
-            config = {d['key']: d['value'] for d in config}
-        else:
-            config = {}
 
-    if isinstance(config, six.string_types):
-        raise SaltInvocationError(
-            "config can't be a string, validate your YAML input."
+class _ExecWebsocket(WebSocketBaseClient):
+    ''' An exec websocket which passes every message to handler,
+        without a manager it's the stdin websocket (see send_payload).
+    '''
+    def __init__(self, manager, handler, *args, **kwargs):
+        self.manager = manager
+        self.handler = handler
+        super(_ExecWebsocket, self).__init__(*args, **kwargs)
+
+    def handshake_ok(self):
+        if self.manager is not None:
+            self.manager.add(self)
+
+    def send_payload(self, payload):
+        ''' Sends payload (string, bytes or a file object) and EOF. '''
+        try:
+            if isinstance(payload, six.text_type):
+                payload = payload.encode('utf-8')
+            if hasattr(payload, 'read'):
+                for chunk in iter(lambda: payload.read(65536), b''):
+                    self.send(chunk, binary=True)
+            elif payload:
+                self.send(payload, binary=True)
+            # An empty message is EOF for the process
+            self.send(b'', binary=False)
+        finally:
+            self.close()
+
+    def received_message(self, message):
+        if len(message.data) == 0:
+            self.close()
+            self.manager.remove(self)
+            return
+        self.handler(message.data)
+
+
+def _container_put_tar(container, src, idx, dst, mode=None, uid=None,
+                       gid=None, compress=False, stats=None):
+    ''' Streams a tar archive of the directory src into "tar -x" in the
+        container, src[idx:] of every path gets extracted below dst.
+        Counts the files and the archive bytes in stats.
+    '''
+    archive = tempfile.SpooledTemporaryFile(max_size=16 * 1024 ** 2)
+    try:
+        with tarfile.open(fileobj=archive,
+                          mode='w:gz' if compress else 'w') as tar:
+            for path, dirs, files in os.walk(src):
+                for name in dirs + files:
+                    src_name = os.path.join(path, name)
+                    info = tar.gettarinfo(
+                        src_name,
+                        arcname=src_name[idx:].lstrip(os.path.sep)
+                    )
+                    if info is None:
+                        # Sockets and the like
+                        continue
+                    if mode is not None and info.isfile():
+                        info.mode = int(mode, 8)
+                    if uid is not None:
+                        info.uid = int(uid)
+                    if gid is not None:
+                        info.gid = int(gid)
+                    # Numeric ids only
+                    info.uname = info.gname = ''
+
+                    if info.isfile():
+                        with salt.utils.fopen(src_name, 'rb') as src_fp:
+                            tar.addfile(info, src_fp)
+                        if stats is not None:
+                            stats.files += 1
+                    else:
+                        tar.addfile(info)
+        archive.seek(0)
+
+        result = _container_execute_stream(
+            container,
+            ['sh', '-c',
+             'mkdir -p "$1" && tar -x -p {0}-f - -C "$1"'.format(
+                 '-z ' if compress else ''),
+             'sh', dst],
+            None, 0,
+            stdin=archive if stats is None else stats.reader(archive)
         )
+    finally:
+        archive.close()
 
-    if isinstance(devices, six.string_types):
-        raise SaltInvocationError(
-            "devices can't be a string, validate your YAML input."
+    if not result['result']:
+        raise CommandExecutionError(
+            'Extracting into "{0}" failed: {1}'.format(dst, result['stderr'])
         )
 
-    # Golangs wants strings
-    if config is not None:
-        for k, v in six.iteritems(config):
-            config[k] = six.text_type(v)
-    if devices is not None:
-        for dn in devices:
-            for k, v in six.iteritems(devices[dn]):
-                devices[dn][k] = v
 
-    return (config, devices,)
+def _container_mkdirs(container, dirs):
+    ''' Creates dirs in the container, parents first. One "mkdir -p"
+        when the container runs, else one files API request per
+        directory.
+    '''
+    dirs = sorted(set(dirs), key=lambda d: (d.count('/'), d))
+    if not dirs:
+        return
 
+    if container.status_code == CONTAINER_STATUS_RUNNING:
+        result = _container_execute_raw(container, ['mkdir', '-p'] + dirs)
+        if not result['result']:
+            raise CommandExecutionError(
+                'Creating directories failed: {0}'.format(result['stderr'])
+            )
+        return
 
-def sync_config_devices(obj, newconfig, newdevices, test=False):
-    ''' Syncs the given config and devices with the object
-        (a profile or a container)
-        returns a changes dict with all changes made.
+    files = container.client.api.containers[container.name].files
+    for path in dirs:
+        try:
+            files.post(
+                params={'path': path}, data=b'',
+                headers={'X-LXD-type': 'directory'}
+            )
+        except pylxd.exceptions.LXDAPIException as e:
+            raise CommandExecutionError(
+                'Creating directory "{0}" failed: {1}'.format(
+                    path, six.text_type(e))
+            )
 
-        obj :
-            The object to sync with / or just test with.
 
-        newconfig:
-            The new config to check with the obj.
+def _container_put_files(container, uploads, stats, workers=8, retries=2):
+    ''' Puts (src_name, dst_name, mode, uid, gid) uploads with
+        workers requests at once, the directories have to exist.
+        Failed files get retried with a backoff, raises when a file
+        still fails after retries.
+    '''
+    def _upload(upload):
+        src_name, dst_name, set_mode, set_uid, set_gid = upload
+        for attempt in range(max(0, int(retries)) + 1):
+            if attempt:
+                stats.retry()
+                time.sleep(min(0.5 * 2 ** (attempt - 1), 5))
+            try:
+                with salt.utils.fopen(src_name, 'rb') as src_fp:
+                    container.files.put(
+                        dst_name, stats.chunks(src_fp),
+                        mode=set_mode, uid=set_uid, gid=set_gid
+                    )
+                return None
+            except (pylxd.exceptions.LXDAPIException,
+                    requests.exceptions.RequestException,
+                    IOError) as e:
+                log.debug('Putting "%s" failed: %s', dst_name, e)
+                error = e
+        return dst_name, six.text_type(error)
+
+    pool = ThreadPool(max(1, int(workers)))
+    try:
+        failed = [f for f in pool.map(_upload, uploads) if f is not None]
+    finally:
+        pool.terminate()
 
-        newdevices:
-            The new devices to check with the obj.
+    if failed:
+        raise CommandExecutionError(
+            '{0} of {1} files failed, "{2}": {3}'.format(
+                len(failed), len(uploads), failed[0][0], failed[0][1])
+        )
 
-        test:
-            Wherever to not change anything and give "Would change" message.
-    '''
-    changes = {}
 
-    #
-    # config changes
-    #
-    if newconfig is None:
-        newconfig = {}
+# Reads paths on stdin and prints "S|type|size|mode|uid|gid"
+# or "N" (not found) for each of them.
+_stat_script = '''
+while IFS= read -r path; do
+    out=$(stat -L -c '%F|%s|%a|%u|%g' "$path" 2>/dev/null ||
+          stat -c '%F|%s|%a|%u|%g' "$path" 2>/dev/null) &&
+        echo "S|$out" || echo N
+done
+'''
 
-    newconfig = dict(list(zip(
-        map(six.text_type, newconfig.keys()),
-        map(six.text_type, newconfig.values())
-    )))
-    cck = set(newconfig.keys())
+_stat_types = {
+    'directory': 'directory',
+    'regular file': 'file',
+    'regular empty file': 'file',
+    'symbolic link': 'symlink',
+    'file': 'file',
+    'symlink': 'symlink',
+}
 
-    obj.config = dict(list(zip(
-        map(six.text_type, obj.config.keys()),
-        map(six.text_type, obj.config.values())
-    )))
-    ock = set(obj.config.keys())
 
-    config_changes = {}
-    # Removed keys
-    for k in ock.difference(cck):
-        # Ignore LXD internals.
-        if k.startswith('volatile.') or k.startswith('image.'):
+def _container_file_stat(container, paths):
+    ''' See container_file_stat, takes a pylxd container. '''
+    paths = list(paths)
+    ret = {}
+
+    if container.status_code == CONTAINER_STATUS_RUNNING:
+        result = _container_execute_stream(
+            container, ['sh', '-c', _stat_script], None, 4096,
+            stdin=''.join('{0}\n'.format(p) for p in paths)
+        )
+        lines = result['stdout'].splitlines()
+        if result['result'] and len(lines) == len(paths):
+            for path, line in zip(paths, lines):
+                if line == 'N':
+                    ret[path] = {'exists': False, 'type': None}
+                    continue
+                _, ftype, size, fmode, fuid, fgid = line.split('|')
+                ret[path] = {
+                    'exists': True,
+                    'type': _stat_types.get(ftype, 'other'),
+                    'size': int(size),
+                    'mode': '0' + fmode,
+                    'uid': int(fuid),
+                    'gid': int(fgid),
+                }
+            return ret
+
+    # Without exec ask the files API, streamed so we only read
+    # the headers and not the content.
+    for path in paths:
+        try:
+            response = container.api.files.get(
+                params={'path': path}, stream=True
+            )
+        except pylxd.exceptions.LXDAPIException as why:
+            if six.text_type(why).find('Is a directory') >= 0:
+                # Old LXD
+                ret[path] = {'exists': True, 'type': 'directory',
+                             'size': None, 'mode': None,
+                             'uid': None, 'gid': None}
+            else:
+                ret[path] = {'exists': False, 'type': None}
             continue
 
-        if not test:
-            config_changes[k] = (
-                'Removed config key "{0}", its value was "{1}"'
-            ).format(k, obj.config[k])
-            del obj.config[k]
-        else:
-            config_changes[k] = (
-                'Would remove config key "{0} with value "{1}"'
-            ).format(k, obj.config[k])
+        headers = response.headers
+        response.close()
+        ret[path] = {
+            'exists': True,
+            'type': _stat_types.get(headers.get('X-LXD-type', 'file'),
+                                    'other'),
+            'size': None,
+            'mode': headers.get('X-LXD-mode'),
+            'uid': int(headers['X-LXD-uid']) if 'X-LXD-uid' in headers
+            else None,
+            'gid': int(headers['X-LXD-gid']) if 'X-LXD-gid' in headers
+            else None,
+        }
 
-    # same keys
-    for k in cck.intersection(ock):
-        # Ignore LXD internals.
-        if k.startswith('volatile.') or k.startswith('image.'):
-            continue
+    return ret
 
-        if newconfig[k] != obj.config[k]:
-            if not test:
-                config_changes[k] = (
-                    'Changed config key "{0}" to "{1}", '
-                    'its value was "{2}"'
-                ).format(k, newconfig[k], obj.config[k])
-                obj.config[k] = newconfig[k]
-            else:
-                config_changes[k] = (
-                    'Would change config key "{0}" to "{1}", '
-                    'its current value is "{2}"'
-                ).format(k, newconfig[k], obj.config[k])
 
-    # New keys
-    for k in cck.difference(ock):
-        # Ignore LXD internals.
-        if k.startswith('volatile.') or k.startswith('image.'):
-            continue
+def _container_get_tar(container, src, dst, stats):
+    ''' Streams a tar archive of the directory src out of the container
+        and extracts it as dst.
+    '''
+    archive = tempfile.SpooledTemporaryFile(max_size=16 * 1024 ** 2)
+    try:
+        def _write(data):
+            archive.write(data)
+            stats.add(len(data))
+
+        errors = _BoundedOutput('stderr', 4096, 4096)
+        exit_code, _ = _container_exec(
+            container, ['tar', '-c', '-f', '-', '-C', src, '.'],
+            _write, errors.write
+        )
+        if exit_code != 0:
+            raise CommandExecutionError(
+                'Archiving "{0}" failed: {1}'.format(src, errors.text)
+            )
 
-        if not test:
-            config_changes[k] = (
-                'Added config key "{0}" = "{1}"'
-            ).format(k, newconfig[k])
-            obj.config[k] = newconfig[k]
+        archive.seek(0)
+        if not os.path.isdir(dst):
+            os.mkdir(dst)
+        root = os.path.realpath(dst)
+
+        def _inside(path):
+            return path == root or path.startswith(root + os.sep)
+
+        extract_kwargs = {}
+        if hasattr(tarfile, 'data_filter'):
+            extract_kwargs['filter'] = 'data'
+
+        with tarfile.open(fileobj=archive, mode='r|') as tar:
+            for member in tar:
+                # Don't let the container write outside of dst, resolve
+                # the links extracted before, a chain like "a -> .",
+                # "b -> a/.." and "b/evil" gets past a per member check.
+                if member.islnk() or member.isdev():
+                    continue
+                parent = os.path.realpath(os.path.join(
+                    root, os.path.dirname(member.name)
+                ))
+                path = os.path.join(parent, os.path.basename(member.name))
+                if not _inside(parent) or not _inside(path):
+                    continue
+                if member.issym() and not _inside(os.path.realpath(
+                        os.path.join(parent, member.linkname))):
+                    continue
+                if member.isfile():
+                    stats.add(0, files=1)
+                tar.extract(member, dst, **extract_kwargs)
+    finally:
+        archive.close()
+
+
+def _container_get_files(container, src, dst, workers, stats):
+    ''' Gets the directory src as dst with one request per file,
+        workers at once.
+    '''
+    def _download(download):
+        src_name, dst_name = download
+        response = container.api.files.get(
+            params={'path': src_name}, stream=True
+        )
+        try:
+            if response.headers.get('X-LXD-type') == 'directory':
+                return download
+            with salt.utils.fopen(dst_name, 'wb') as df:
+                for chunk in response.iter_content(_upload_chunk_size):
+                    df.write(chunk)
+                    stats.add(len(chunk))
+            stats.add(0, files=1)
+        finally:
+            response.close()
+
+    pending = [(src, dst)]
+    pool = ThreadPool(max(1, int(workers)))
+    try:
+        while pending:
+            downloads = []
+            for src_dir, dst_dir in pending:
+                if not os.path.isdir(dst_dir):
+                    os.mkdir(dst_dir)
+                entries = container.api.files.get(
+                    params={'path': src_dir}
+                ).json()['metadata']
+                for entry in entries:
+                    downloads.append((
+                        '{0}/{1}'.format(src_dir.rstrip('/'), entry),
+                        os.path.join(dst_dir, entry)
+                    ))
+
+            # Directories come back and get listed in the next round
+            pending = [d for d in pool.map(_download, downloads)
+                       if d is not None]
+    except pylxd.exceptions.LXDAPIException as e:
+        raise CommandExecutionError(six.text_type(e))
+    finally:
+        pool.terminate()
+
+
+def _chmod_chown_tree(path, mode=None, uid=None, gid=None):
+    ''' Sets mode (files only), uid and gid below path. '''
+    uid = -1 if uid is None else int(uid)
+    gid = -1 if gid is None else int(gid)
+    if mode is None and uid == -1 and gid == -1:
+        return
+
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            fullname = os.path.join(root, name)
+            if mode is not None and name in files:
+                os.chmod(fullname, int(mode, 8))
+            if uid != -1 or gid != -1:
+                os.lchown(fullname, uid, gid)
+
+
+def _file_sync_sources(src, dst, saltenv):
+    ''' Resolves src (local or salt://) to a local root directory and a
+        dict of "./relative path" -> local path, the root is None for a
+        single file (which gets synced as dst).
+    '''
+    if src.find('://') >= 0:
+        cached = __salt__['cp.cache_file'](src, saltenv=saltenv)
+        if cached:
+            src = cached
         else:
-            config_changes[k] = (
-                'Would add config key "{0}" = "{1}"'
-            ).format(k, newconfig[k])
+            # Maybe a directory
+            if not __salt__['cp.cache_dir'](src, saltenv=saltenv):
+                raise SaltInvocationError("'{0}' not found".format(src))
+            src = os.path.join(
+                __opts__['cachedir'], 'files', saltenv,
+                src.split('://', 1)[1].lstrip('/')
+            )
+    src = os.path.expanduser(src).rstrip(os.path.sep) or os.path.sep
 
-    if config_changes:
-        changes['config'] = config_changes
+    if os.path.isfile(src):
+        return (None, {'./' + os.path.basename(dst.rstrip('/')): src})
 
-    #
-    # devices changes
-    #
-    if newdevices is None:
-        newdevices = {}
+    if not os.path.isdir(src):
+        raise CommandExecutionError(
+            'No such file or directory \'{0}\''.format(src)
+        )
 
-    dk = set(obj.devices.keys())
-    ndk = set(newdevices.keys())
+    sources = {}
+    for path, _, files in os.walk(src):
+        for name in files:
+            local_path = os.path.join(path, name)
+            if '\n' in local_path or os.path.islink(local_path):
+                continue
+            rel = os.path.relpath(local_path, src).replace(os.path.sep, '/')
+            sources['./' + rel] = local_path
 
-    devices_changes = {}
-    # Removed devices
-    for k in dk.difference(ndk):
-        # Ignore LXD internals.
-        if k == u'root':
-            continue
+    return (src, sources)
 
-        if not test:
-            devices_changes[k] = (
-                'Removed device "{0}"'
-            ).format(k)
-            del obj.devices[k]
+
+def _local_manifest(sources):
+    ''' Returns "./relative path" -> {path, size, mode, sha256}
+        of the local sources, files with the same path, mtime, size and
+        inode as in the manifest cache don't get hashed again.
+    '''
+    cache = _ManifestCache('local')
+    manifest = {}
+    for rel, path in six.iteritems(sources):
+        stat = os.stat(path)
+        key = [stat.st_mtime, stat.st_size, stat.st_ino]
+        cached = cache.get(path)
+        if cached is not None and cached['key'] == key:
+            sha256 = cached['sha256']
         else:
-            devices_changes[k] = (
-                'Would remove device "{0}"'
-            ).format(k)
+            sha256 = _sha256_file(path)
+            cache.set(path, {'key': key, 'sha256': sha256})
+        manifest[rel] = {
+            'path': path,
+            'size': stat.st_size,
+            'mode': '0{0:o}'.format(stat.st_mode & 0o7777),
+            'sha256': sha256,
+        }
+    cache.save()
+    return manifest
+
+
+class _ManifestCache(object):
+    ''' A JSON file in the minion cachedir "lxd/manifests",
+        "local" caches the hashes of local files, "containers" the
+        manifests of the last syncs and "fingerprints" the observed
+        digests of profiles and containers.
+
+        It keeps the max_entries most recently used entries, the
+        entries of deleted files and containers drop out over time.
+        The threads of state_batch share the cached ones, so all
+        access goes through its lock.
+    '''
 
-    # Changed devices
-    for k, v in six.iteritems(obj.devices):
-        # Ignore LXD internals also for new devices.
-        if k == u'root':
-            continue
+    def __init__(self, name, max_entries=10000):
+        self.path = os.path.join(
+            __opts__['cachedir'], 'lxd', 'manifests', name + '.json'
+        )
+        self.max_entries = max_entries
+        self.data = collections.OrderedDict()
+        self.dirty = False
+        self.lock = threading.RLock()
+        try:
+            with salt.utils.fopen(self.path, 'r') as fp:
+                self.data = json.load(
+                    fp, object_pairs_hook=collections.OrderedDict
+                )
+        except (IOError, OSError, ValueError):
+            pass
 
-        if k not in newdevices:
-            # In test mode we don't delete devices above.
-            continue
+    def get(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                # The least recently used come first.
+                self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            self.dirty = True
+
+    def discard(self, key):
+        with self.lock:
+            if self.data.pop(key, None) is not None:
+                self.dirty = True
+
+    def save(self):
+        self._save(self.__dict__)
+
+    def save_at_exit(self):
+        ''' Saves it once, when it gets garbage collected or the process
+            exits, whatever comes first.
+        '''
+        # The callback must not reference self, else it lives forever.
+        multiprocessing.util.Finalize(
+            self, _ManifestCache._save, args=(self.__dict__,),
+            exitpriority=10
+        )
 
-        if newdevices[k] != v:
-            if not test:
-                devices_changes[k] = (
-                    'Changed device "{0}"'
-                ).format(k)
-                obj.devices[k] = newdevices[k]
-            else:
-                devices_changes[k] = (
-                    'Would change device "{0}"'
-                ).format(k)
+    @staticmethod
+    def _save(attrs):
+        with attrs['lock']:
+            if not attrs['dirty']:
+                return
+
+            data = attrs['data']
+            while len(data) > attrs['max_entries']:
+                data.popitem(last=False)
+
+            directory = os.path.dirname(attrs['path'])
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            # Other salt processes may read it right now.
+            tmp = '{0}.{1}'.format(attrs['path'], os.getpid())
+            with salt.utils.fopen(tmp, 'w') as fp:
+                json.dump(data, fp)
+            os.rename(tmp, attrs['path'])
+            attrs['dirty'] = False
+
+
+def _sha256_file(path):
+    ''' Returns the sha256 hexdigest of path, read in chunks '''
+    sha256 = hashlib.sha256()
+    with salt.utils.fopen(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(_upload_chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# Reads "size\nmtime:inode\npath\n" on stdin and prints
+# "M size mode mtime inode sha256|-|= path" for every existing file.
+# The sha256 only when the size matches, "=" when mtime and inode
+# are the recorded ones (it's unchanged since the last sync).
+# With a second argument it lists all files as "F path" too.
+_remote_manifest_script = '''
+cd "$1" 2>/dev/null || exit 0
+list="$2"
+while IFS= read -r want && IFS= read -r seen && IFS= read -r path; do
+    [ -f "$path" ] && [ ! -L "$path" ] || continue
+    set -- $(stat -c '%s %a %Y %i' "$path")
+    sum=-
+    if [ "$1" = "$want" ]; then
+        if [ "$3:$4" = "$seen" ]; then
+            sum==
+        else
+            sum=$(sha256sum "$path" | cut -d ' ' -f 1)
+        fi
+    fi
+    printf 'M %s %s %s %s %s %s\\n' "$1" "$2" "$3" "$4" "$sum" "$path"
+done
+if [ -n "$list" ]; then
+    find . -type f | sed 's/^/F /'
+fi
+'''
 
-    # New devices
-    for k in ndk.difference(dk):
-        # Ignore LXD internals.
-        if k == u'root':
-            continue
 
-        if not test:
-            devices_changes[k] = (
-                'Added device "{0}"'
-            ).format(k)
-            obj.devices[k] = newdevices[k]
-        else:
-            devices_changes[k] = (
-                'Would add device "{0}"'
-            ).format(k)
+def _remote_manifest(container, root, local, record, list_all=False):
+    ''' Returns the manifest of the files in local below root in the
+        container, and a list of all files when list_all is True.
 
-    if devices_changes:
-        changes['devices'] = devices_changes
+        Files whose mtime and inode are the same as in record (the
+        manifest of the last sync) don't get hashed again.
+    '''
+    seen = {}
+    for rel, entry in six.iteritems(record):
+        if entry.get('mtime') is not None:
+            seen[rel] = '{0}:{1}'.format(entry['mtime'], entry['inode'])
+    stdin = ''.join(
+        '{0}\n{1}\n{2}\n'.format(entry['size'], seen.get(rel, '-'), rel)
+        for rel, entry in six.iteritems(local)
+    )
+    cmd = ['sh', '-c', _remote_manifest_script, 'sh', root]
+    if list_all:
+        cmd.append('1')
 
-    return changes
+    result = _container_execute_stream(container, cmd, None, 4096,
+                                       stdin=stdin)
+    if not result['result']:
+        raise CommandExecutionError(
+            'Getting the manifest of "{0}" failed: {1}'.format(
+                root, result['stderr']
+            )
+        )
 
+    manifest = {}
+    files = []
+    for line in result['stdout'].splitlines():
+        if line.startswith('M '):
+            size, mode, mtime, inode, sha256, path = line[2:].split(' ', 5)
+            if sha256 == '=':
+                sha256 = record[path]['sha256']
+            manifest[path] = {
+                'size': int(size),
+                'mode': '0' + mode,
+                'mtime': mtime,
+                'inode': inode,
+                'sha256': None if sha256 == '-' else sha256,
+            }
+        elif line.startswith('F '):
+            files.append(line[2:])
+
+    return (manifest, files)
+
+
+def _sync_join(root, path):
+    ''' Joins root and a "./relative path" of a manifest '''
+    return '{0}/{1}'.format(root.rstrip('/'), path[2:])
+
+
+def _exec_files(token):
+    ''' Returns the paths of the stdout, stderr and exit code files
+        of an exec_async job.
+    '''
+    return tuple(
+        '/var/tmp/salt-exec-{0}.{1}'.format(token, ext)
+        for ext in ('stdout', 'stderr', 'rc')
+    )
 
-def _set_property_dict_item(obj, prop, key, value):
-    ''' Sets the dict item key of the attr from obj.
 
-        Basicaly it does getattr(obj, prop)[key] = value.
+def _pool_key(remote_addr, cert, key, verify_cert):
+    ''' The key of a remote in the connection pool and the inventory. '''
+    return '|'.join((six.text_type(remote_addr),
+                     six.text_type(cert),
+                     six.text_type(key),
+                     six.text_type(verify_cert),))
 
 
-        For the disk device we added some checks to make
-        device changes on the CLI saver.
+def _inventory_kind(kind, remote_addr, cert, key, verify_cert):
+    ''' Returns the metadata of all objects of kind on the remote by name
+        (fingerprint for images), loads them on first use.
     '''
-    attr = getattr(obj, prop)
-    if prop == 'devices':
-        device_type = value['type']
-
-        if device_type == 'disk':
+    if kind not in _inventory_kinds:
+        raise SaltInvocationError(
+            'kind must be one of {0}'.format(', '.join(_inventory_kinds))
+        )
 
-            if 'path' not in value:
-                raise SaltInvocationError(
-                    "path must be given as parameter"
+    with _inventory_lock(remote_addr, cert, key, verify_cert):
+        remote = __context__.setdefault('lxd.inventory', {}).setdefault(
+            _pool_key(remote_addr, cert, key, verify_cert), {}
+        )
+        if kind not in remote:
+            client = pylxd_client_get(remote_addr, cert, key, verify_cert)
+            try:
+                response = getattr(client.api, kind).get(
+                    params={'recursion': 1}
                 )
+            except pylxd.exceptions.LXDAPIException as e:
+                raise CommandExecutionError(six.text_type(e))
 
-            if value['path'] != '/' and 'source' not in value:
-                raise SaltInvocationError(
-                    "source must be given as parameter"
-                )
+            key_name = 'fingerprint' if kind == 'images' else 'name'
+            remote[kind] = dict(
+                (metadata[key_name], metadata)
+                for metadata in response.json()['metadata']
+            )
 
-        for k in value.keys():
-            if k.startswith('__'):
-                del value[k]
+        return remote[kind]
 
-        attr[key] = value
 
-    else:  # config
-        attr[key] = six.text_type(value)
+def _inventory_lock(remote_addr, cert, key, verify_cert):
+    ''' The lock of the inventory of a remote, hold it while reading
+        the dicts _inventory_kind returns.
+    '''
+    with _context_lock:
+        return __context__.setdefault('lxd.inventory_locks', {}).setdefault(
+            _pool_key(remote_addr, cert, key, verify_cert),
+            threading.RLock()
+        )
 
-    pylxd_save_object(obj)
 
-    return _pylxd_model_to_dict(obj)
+def _inventory_aliases(images):
+    ''' Returns the image fingerprints by alias. '''
+    return dict(
+        (alias['name'], fingerprint)
+        for fingerprint, image in six.iteritems(images)
+        for alias in image.get('aliases') or []
+    )
 
 
-def _get_property_dict_item(obj, prop, key):
-    attr = getattr(obj, prop)
-    if key not in attr:
-        raise SaltInvocationError(
-            "'{0}' doesn't exists".format(key)
-        )
+def _pylxd_object_delta(base, state):
+    ''' Returns the changes from the marshalled object base to state as
+        a PATCH body and a dict of the removed keys of its dicts.
+    '''
+    patch = {}
+    removed = {}
+    for key, value in six.iteritems(state):
+        old = base.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            changed = dict(
+                (k, v) for k, v in six.iteritems(value) if old.get(k) != v
+            )
+            if changed:
+                patch[key] = changed
+            gone = [k for k in old if k not in value]
+            if gone:
+                removed[key] = gone
+        elif old != value:
+            patch[key] = value
 
-    return attr[key]
+    return patch, removed
 
 
-def _delete_property_dict_item(obj, prop, key):
-    attr = getattr(obj, prop)
-    if key not in attr:
-        raise SaltInvocationError(
-            "'{0}' doesn't exists".format(key)
+def _pylxd_put_rebased(obj, patch, removed, tries=3):
+    ''' Applies patch and removed to the current object on the server and
+        PUTs it back with its ETag as If-Match, so we don't overwrite
+        changes others made since we fetched obj.
+    '''
+    api = obj.api
+    for _ in range(tries):
+        response = api.get()
+        etag = response.headers.get('ETag')
+        current = response.json()['metadata']
+
+        body = dict((k, copy.deepcopy(current.get(k, v)))
+                    for k, v in six.iteritems(obj.marshall()))
+        for key, value in six.iteritems(patch):
+            if isinstance(value, dict) and isinstance(body.get(key), dict):
+                body[key].update(value)
+            else:
+                body[key] = value
+        for key, names in six.iteritems(removed):
+            for k in names:
+                body.get(key, {}).pop(k, None)
+
+        response = api.session.put(
+            api._api_endpoint, json=body,
+            headers={'If-Match': etag} if etag else None,
+            timeout=api._timeout
         )
+        if response.status_code == 412:
+            # Changed in the meantime, again.
+            continue
+        api._assert_response(response, allowed_status_codes=(200, 202))
+        _pylxd_wait_response(obj, response)
+        return
 
-    del attr[key]
-    pylxd_save_object(obj)
-
-    return True
-
+    raise CommandExecutionError(
+        'The object got changed {0} times while saving it'.format(tries)
+    )
 
-def _verify_image(image,
-                  remote_addr=None,
-                  cert=None,
-                  key=None,
-                  verify_cert=True):
-    # Get image by alias/fingerprint or check for fingerprint attribute
-    if isinstance(image, six.string_types):
-        name = image
 
-        # This will fail with a SaltInvocationError if
-        # the image doesn't exists on the source and with a
-        # CommandExecutionError on connection problems.
-        image = None
-        try:
-            image = image_get_by_alias(
-                name, remote_addr, cert,
-                key, verify_cert, _raw=True
-            )
-        except SaltInvocationError:
-            image = image_get(
-                name, remote_addr, cert,
-                key, verify_cert, _raw=True
-            )
-    elif not hasattr(image, 'fingerprint'):
-        raise SaltInvocationError(
-            'Invalid image \'{0}\''.format(image)
+def _pylxd_wait_response(obj, response):
+    ''' Waits for the operation of an async response. '''
+    if response.json().get('type') == 'async':
+        obj.client.operations.wait_for_operation(
+            response.json()['operation']
         )
-    return image
 
 
 def _pylxd_model_to_dict(obj):
@@ -3598,8 +7596,19 @@ if not hasattr(pylxd.exceptions, 'NotFound'):
 
 try:
     from pylxd.container import Container
+    from pylxd.image import Image
+    from pylxd.profile import Profile
 except ImportError:
     from pylxd.models.container import Container
+    from pylxd.models.image import Image
+    from pylxd.models.profile import Profile
+
+# The pylxd models of the inventory kinds
+_inventory_models = {
+    'containers': Container,
+    'profiles': Profile,
+    'images': Image,
+}
 
 
 class FilesManager(Container.FilesManager):
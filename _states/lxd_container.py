@@ -30,6 +30,10 @@ Manage LXD containers.
 
 # Import python libs
 from __future__ import absolute_import, print_function, unicode_literals
+import copy
+import hashlib
+import json
+import uuid
 
 # Import salt libs
 from salt.exceptions import CommandExecutionError
@@ -46,6 +50,9 @@ CONTAINER_STATUS_RUNNING = 103
 CONTAINER_STATUS_FROZEN = 110
 CONTAINER_STATUS_STOPPED = 102
 
+# The state functions mod_aggregate folds
+_aggregate_funs = ('present', 'running', 'stopped')
+
 
 def __virtual__():
     '''
@@ -66,7 +73,10 @@ def present(name,
             remote_addr=None,
             cert=None,
             key=None,
-            verify_cert=True):
+            verify_cert=True,
+            pool=None,
+            bootstrap_scripts=None,
+            batch=None):
     '''
     Create the named container if it does not exist
 
@@ -158,7 +168,27 @@ def present(name,
         Wherever to verify the cert, this is by default True
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
+
+    pool : None
+        Claim the container from this warm pool (see :mod:`pool
+        <salt.states.lxd_container.pool>`) instead of creating it,
+        it gets created from source if the pool is empty or its
+        members got created from another source, profiles, config,
+        devices, architecture or bootstrap_scripts.
+
+    bootstrap_scripts : None
+        With pool, the bootstrap scripts the pool members must have run.
+        Use :mod:`bootstrapped <salt.states.lxd_container.bootstrapped>`
+        to run them.
+
+    batch : None
+        Set by :mod:`mod_aggregate
+        <salt.states.lxd_container.mod_aggregate>`, the states
+        folded into this one, True when this one got folded.
     '''
+    if batch:
+        return __salt__['lxd.state_batch'](present, dict(locals()))
+
     if profiles is None:
         profiles = ['default']
 
@@ -179,14 +209,16 @@ def present(name,
         'cert': cert,
         'key': key,
         'verify_cert': verify_cert,
+        'pool': pool,
 
         'changes': {}
     }
 
     container = None
     try:
-        container = __salt__['lxd.container_get'](
-            name, remote_addr, cert, key, verify_cert, _raw=True
+        container = __salt__['lxd.inventory_object'](
+            'containers', name, remote_addr, cert, key, verify_cert,
+            _raw=True
         )
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
@@ -210,6 +242,40 @@ def present(name,
             ret['changes'] = {'created': msg}
             return _unchanged(ret, msg)
 
+        if pool is not None:
+            try:
+                __salt__['lxd.container_claim'](
+                    pool,
+                    name,
+                    profiles,
+                    config,
+                    devices,
+                    running is True,
+                    remote_addr,
+                    cert,
+                    key,
+                    verify_cert,
+                    _pool_spec(source, profiles, config, devices,
+                               architecture, bootstrap_scripts)
+                )
+            except CommandExecutionError as e:
+                return _error(ret, six.text_type(e))
+            except SaltInvocationError:
+                # No member with our spec, create it.
+                pass
+            else:
+                msg = 'Claimed the container "{0}" from the pool "{1}"'.format(
+                    name, pool
+                )
+                ret['changes'] = {'created': msg}
+                if running is True:
+                    ret['changes']['started'] = (
+                        'Started the container "{0}"'.format(name)
+                    )
+                # The member got renamed
+                _inventory_refresh(ret)
+                return _success(ret, msg)
+
         # create the container
         try:
             __salt__['lxd.container_create'](
@@ -244,6 +310,7 @@ def present(name,
                     verify_cert
                 )
             except CommandExecutionError as e:
+                _inventory_refresh(ret, name=name)
                 return _error(ret, six.text_type(e))
 
             msg = msg + ' and started it.'
@@ -251,9 +318,20 @@ def present(name,
                 'started': 'Started the container "{0}"'.format(name)
             }
 
+        _inventory_refresh(ret, name=name)
         return _success(ret, msg)
 
+    # Nothing to diff when the spec didn't change since we applied it
+    # and nobody touched the container.
+    fingerprint = __salt__['lxd.spec_fingerprint'](profiles, config, devices)
+    if (__salt__['lxd.fingerprint_unchanged'](
+            container, fingerprint, remote_addr) and
+            (running is None or
+             running == (container.status_code == CONTAINER_STATUS_RUNNING))):
+        return _success(ret, 'No changes')
+
     # Container exists, lets check for differences
+    base = __salt__['lxd.pylxd_object_state'](container)
     new_profiles = set(map(six.text_type, profiles))
     old_profiles = set(map(six.text_type, container.profiles))
 
@@ -296,11 +374,14 @@ def present(name,
     is_running = \
         container.status_code == CONTAINER_STATUS_RUNNING
 
+    tagged = False
     if not __opts__['test']:
+        tagged = __salt__['lxd.fingerprint_set'](container, fingerprint)
         try:
-            __salt__['lxd.pylxd_save_object'](container)
+            __salt__['lxd.pylxd_save_object'](container, base)
         except CommandExecutionError as e:
             return _error(ret, six.text_type(e))
+        __salt__['lxd.fingerprint_save'](container, remote_addr)
 
     if running != is_running:
         if running is True:
@@ -327,6 +408,12 @@ def present(name,
                 container.stop(wait=True)
                 changes['stopped'] = 'Stopped the container'
 
+    _inventory_refresh(
+        ret, name=name,
+        changed=(container_changed or tagged or
+                 (running is not None and running != is_running))
+    )
+
     if ((running is True or running is None) and
             is_running and
             restart_on_change and
@@ -414,8 +501,9 @@ def absent(name,
     }
 
     try:
-        container = __salt__['lxd.container_get'](
-            name, remote_addr, cert, key, verify_cert, _raw=True
+        container = __salt__['lxd.inventory_object'](
+            'containers', name, remote_addr, cert, key, verify_cert,
+            _raw=True
         )
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
@@ -445,7 +533,8 @@ def running(name,
             remote_addr=None,
             cert=None,
             key=None,
-            verify_cert=True):
+            verify_cert=True,
+            batch=None):
     '''
     Ensure a LXD container is running and restart it if restart is True
 
@@ -479,7 +568,15 @@ def running(name,
         Wherever to verify the cert, this is by default True
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
+
+    batch : None
+        Set by :mod:`mod_aggregate
+        <salt.states.lxd_container.mod_aggregate>`, the states
+        folded into this one, True when this one got folded.
     '''
+    if batch:
+        return __salt__['lxd.state_batch'](running, dict(locals()))
+
     ret = {
         'name': name,
         'restart': restart,
@@ -493,8 +590,9 @@ def running(name,
     }
 
     try:
-        container = __salt__['lxd.container_get'](
-            name, remote_addr, cert, key, verify_cert, _raw=True
+        container = __salt__['lxd.inventory_object'](
+            'containers', name, remote_addr, cert, key, verify_cert,
+            _raw=True
         )
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
@@ -589,8 +687,9 @@ def frozen(name,
     }
 
     try:
-        container = __salt__['lxd.container_get'](
-            name, remote_addr, cert, key, verify_cert, _raw=True
+        container = __salt__['lxd.inventory_object'](
+            'containers', name, remote_addr, cert, key, verify_cert,
+            _raw=True
         )
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
@@ -642,7 +741,8 @@ def stopped(name,
             remote_addr=None,
             cert=None,
             key=None,
-            verify_cert=True):
+            verify_cert=True,
+            batch=None):
     '''
     Ensure a LXD container is stopped, kill it if kill is true else stop it
 
@@ -676,7 +776,15 @@ def stopped(name,
         Wherever to verify the cert, this is by default True
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
+
+    batch : None
+        Set by :mod:`mod_aggregate
+        <salt.states.lxd_container.mod_aggregate>`, the states
+        folded into this one, True when this one got folded.
     '''
+    if batch:
+        return __salt__['lxd.state_batch'](stopped, dict(locals()))
+
     ret = {
         'name': name,
         'kill': kill,
@@ -690,8 +798,9 @@ def stopped(name,
     }
 
     try:
-        container = __salt__['lxd.container_get'](
-            name, remote_addr, cert, key, verify_cert, _raw=True
+        container = __salt__['lxd.inventory_object'](
+            'containers', name, remote_addr, cert, key, verify_cert,
+            _raw=True
         )
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
@@ -713,6 +822,117 @@ def stopped(name,
     return _success(ret, ret['changes']['stopped'])
 
 
+def bootstrapped(name,
+                 scripts,
+                 restart=True,
+                 remote_addr=None,
+                 cert=None,
+                 key=None,
+                 verify_cert=True):
+    '''
+    Ensure the bootstrap scripts ran once in the running container.
+
+    The marker file "/etc/salt_lxd_bootstraped" inside the container
+    tells if they already ran.
+
+    name :
+        The name of the container
+
+    scripts :
+        A list of scripts to run:
+
+        .. code-block:: yaml
+
+            - cmd: [ '/bin/sleep', '2' ]
+            - src: salt://lxd/scripts/bootstrap.sh
+              dst: /root/bootstrap.sh
+              cmd: [ '/root/bootstrap.sh' ]
+
+    restart : True
+        Restart the container once after the scripts ran
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if you
+        provide remote_addr!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Zertifikate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+    '''
+    ret = {
+        'name': name,
+        'scripts': scripts,
+        'restart': restart,
+
+        'remote_addr': remote_addr,
+        'cert': cert,
+        'key': key,
+        'verify_cert': verify_cert,
+
+        'changes': {}
+    }
+
+    if __opts__['test']:
+        try:
+            result = __salt__['lxd.container_execute'](
+                name, ['cat', '/etc/salt_lxd_bootstraped'],
+                remote_addr, cert, key, verify_cert
+            )
+        except (CommandExecutionError, SaltInvocationError) as e:
+            return _error(ret, six.text_type(e))
+
+        if 'True' in result['stdout']:
+            return _success(
+                ret, 'Container "{0}" is already bootstrapped'.format(name)
+            )
+
+        ret['changes']['bootstrapped'] = (
+            'Would run {0} bootstrap scripts in "{1}"'.format(
+                len(scripts), name
+            )
+        )
+        return _unchanged(ret, ret['changes']['bootstrapped'])
+
+    try:
+        result = __salt__['lxd.container_bootstrap'](
+            name, scripts, restart, remote_addr=remote_addr, cert=cert,
+            key=key, verify_cert=verify_cert
+        )
+    except (CommandExecutionError, SaltInvocationError) as e:
+        return _error(ret, six.text_type(e))
+
+    if not result['bootstrapped']:
+        return _success(
+            ret, 'Container "{0}" is already bootstrapped'.format(name)
+        )
+
+    ret['changes']['bootstrapped'] = (
+        'Ran {0} bootstrap scripts in "{1}"'.format(len(scripts), name)
+    )
+    if restart:
+        ret['changes']['restarted'] = (
+            'Restarted the container "{0}"'.format(name)
+        )
+    return _success(ret, ret['changes']['bootstrapped'])
+
+
 def migrated(name,
              remote_addr,
              cert,
@@ -722,7 +942,8 @@ def migrated(name,
              stop_and_start=False,
              src_cert=None,
              src_key=None,
-             src_verify_cert=None):
+             src_verify_cert=None,
+             incremental=False):
     ''' Ensure a container is migrated to another host
 
     If the container is running, it either must be shut down
@@ -784,6 +1005,11 @@ def migrated(name,
 
     src_verify_cert :
         Wherever to verify the cert, if None we copy "verify_cert"
+
+    incremental : False
+        Pre-copy the running container before it gets stopped,
+        this cuts the downtime to the transfer of the difference.
+        Requires stop_and_start=True.
     '''
     ret = {
         'name': name,
@@ -797,40 +1023,32 @@ def migrated(name,
         'src_and_start': stop_and_start,
         'src_cert': src_cert,
         'src_key': src_key,
+        'incremental': incremental,
 
         'changes': {}
     }
 
-    dest_container = None
+    if src_verify_cert is None:
+        src_verify_cert = verify_cert
+
     try:
-        dest_container = __salt__['lxd.container_get'](
-            name, remote_addr, cert, key,
-            verify_cert, _raw=True
-        )
+        report = __salt__['lxd.container_migrate_preflight'](
+            name, remote_addr, cert, key, verify_cert,
+            src_remote_addr, src_cert, src_key, src_verify_cert
+        )['containers'][name]
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
-    except SaltInvocationError as e:
-        # Destination container not found
-        pass
 
-    if dest_container is not None:
+    if report['exists']:
         return _success(
             ret,
             'Container "{0}" exists on the destination'.format(name)
         )
 
-    if src_verify_cert is None:
-        src_verify_cert = verify_cert
-
-    try:
-        __salt__['lxd.container_get'](
-            name, src_remote_addr, src_cert, src_key, src_verify_cert, _raw=True
-        )
-    except CommandExecutionError as e:
-        return _error(ret, six.text_type(e))
-    except SaltInvocationError as e:
-        # Container not found
-        return _error(ret, 'Source Container "{0}" not found'.format(name))
+    if not report['ready']:
+        return _error(ret, (
+            'Container "{0}" is not ready for migration: {1}'
+        ).format(name, '; '.join(report['errors'])))
 
     if __opts__['test']:
         ret['changes']['migrated'] = (
@@ -839,24 +1057,666 @@ def migrated(name,
         return _unchanged(ret, ret['changes']['migrated'])
 
     try:
-        __salt__['lxd.container_migrate'](
+        result = __salt__['lxd.container_migrate'](
             name, stop_and_start, remote_addr, cert, key,
-            verify_cert, src_remote_addr, src_cert, src_key, src_verify_cert
+            verify_cert, src_remote_addr, src_cert, src_key, src_verify_cert,
+            incremental,
+            False  # Preflight, done above
         )
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
+    except SaltInvocationError as e:
+        return _error(ret, six.text_type(e))
 
     ret['changes']['migrated'] = (
         'Migrated the container "{0}" from "{1}" to "{2}"'
     ).format(name, src_remote_addr, remote_addr)
+    ret['changes']['downtime'] = result['migration']['downtime']
+    ret['changes']['transfer'] = result['migration']['transfer']
+
+    # Gone on the source
+    __salt__['lxd.inventory_update'](
+        'containers', None, src_remote_addr, src_cert, src_key,
+        src_verify_cert
+    )
     return _success(ret, ret['changes']['migrated'])
 
 
+def file_managed(name,
+                 source,
+                 dst,
+                 delete=False,
+                 mode=None,
+                 uid=None,
+                 gid=None,
+                 remote_addr=None,
+                 cert=None,
+                 key=None,
+                 verify_cert=True):
+    '''
+    Ensure a file or directory in the running container matches source,
+    only changed files get transferred.
+
+    name :
+        The name of the container
+
+    source :
+        The source file or directory, local or salt://
+
+    dst :
+        The destination file or directory in the container
+
+    delete : False
+        Delete files in dst which are not in source
+
+    mode :
+        Set file mode to octal number, default is the mode of the source
+
+    uid :
+        Set file uid (owner)
+
+    gid :
+        Set file gid (group)
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if you
+        provide remote_addr!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Zertifikate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+    '''
+    ret = {
+        'name': name,
+        'source': source,
+        'dst': dst,
+        'delete': delete,
+        'mode': mode,
+        'uid': uid,
+        'gid': gid,
+
+        'remote_addr': remote_addr,
+        'cert': cert,
+        'key': key,
+        'verify_cert': verify_cert,
+
+        'changes': {}
+    }
+
+    try:
+        result = __salt__['lxd.container_file_sync'](
+            name, source, dst,
+            delete=delete, mode=mode, uid=uid, gid=gid, saltenv=__env__,
+            test=__opts__['test'], remote_addr=remote_addr, cert=cert,
+            key=key, verify_cert=verify_cert
+        )
+    except (CommandExecutionError, SaltInvocationError) as e:
+        return _error(ret, six.text_type(e))
+
+    for change in ('uploaded', 'chmod', 'deleted'):
+        if result[change]:
+            ret['changes'][change] = result[change]
+
+    if not ret['changes']:
+        return _success(
+            ret, '"{0}" in "{1}" is in sync'.format(dst, name)
+        )
+
+    if __opts__['test']:
+        return _unchanged(
+            ret, '"{0}" in "{1}" would get synced'.format(dst, name)
+        )
+
+    ret['changes']['transfer'] = result['transfer']
+    return _success(ret, 'Synced "{0}" in "{1}"'.format(dst, name))
+
+
+def pool(name,
+         source,
+         size=1,
+         profiles=None,
+         config=None,
+         devices=None,
+         architecture='x86_64',
+         bootstrap_scripts=None,
+         remote_addr=None,
+         cert=None,
+         key=None,
+         verify_cert=True):
+    '''
+    Keep a warm pool of stopped, bootstrapped containers which
+    :mod:`present <salt.states.lxd_container.present>` (with pool=name)
+    or :mod:`lxd.container_claim <salt.modules.lxd.container_claim>`
+    take instead of creating new ones.
+
+    The pool members are named "<name>-<random>" and carry the
+    "user.salt.pool" config key, members created from an older
+    source/profiles/config/devices get replaced.
+
+    name :
+        The name of the pool
+
+    source :
+        The source of the members, see :mod:`present
+        <salt.states.lxd_container.present>`
+
+    size : 1
+        Number of stopped containers to keep
+
+    profiles : ['default']
+        List of profiles to apply on the members
+
+    config :
+        A config dict or None (None = unset).
+
+    devices :
+        A device dict or None (None = unset).
+
+    architecture : 'x86_64'
+        The architecture of the members
+
+    bootstrap_scripts :
+        A list of scripts to run on each new member, the same
+        format as in the lxd.containers sls:
+
+        .. code-block:: yaml
+
+            - cmd: [ '/bin/sleep', '2' ]
+            - src: salt://lxd/scripts/bootstrap.sh
+              dst: /root/bootstrap.sh
+              cmd: [ '/root/bootstrap.sh' ]
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if you
+        provide remote_addr!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Zertifikate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+    '''
+    if profiles is None:
+        profiles = ['default']
+
+    ret = {
+        'name': name,
+        'source': source,
+        'size': size,
+        'profiles': profiles,
+        'config': config,
+        'devices': devices,
+        'architecture': architecture,
+        'bootstrap_scripts': bootstrap_scripts,
+
+        'remote_addr': remote_addr,
+        'cert': cert,
+        'key': key,
+        'verify_cert': verify_cert,
+
+        'changes': {}
+    }
+
+    config, devices = __salt__['lxd.normalize_input_values'](
+        config,
+        devices
+    )
+    config = dict(config or {})
+
+    # Members with another spec are outdated.
+    spec = _pool_spec(source, profiles, config, devices,
+                      architecture, bootstrap_scripts)
+    config['user.salt.pool'] = name
+    config['user.salt.pool_spec'] = spec
+
+    try:
+        members = __salt__['lxd.pool_members'](
+            name, remote_addr, cert, key, verify_cert, _raw=True
+        )
+    except CommandExecutionError as e:
+        return _error(ret, six.text_type(e))
+
+    outdated = [m for m in members
+                if m.config.get('user.salt.pool_spec') != spec]
+    current = [m for m in members if m not in outdated]
+    surplus = current[size:]
+    missing = max(size - len(current), 0)
+
+    if not outdated and not surplus and not missing:
+        return _success(
+            ret, 'Pool "{0}" has {1} containers'.format(name, len(current))
+        )
+
+    if __opts__['test']:
+        if outdated or surplus:
+            ret['changes']['deleted'] = (
+                'Would delete {0} containers'.format(
+                    len(outdated) + len(surplus))
+            )
+        if missing:
+            ret['changes']['created'] = (
+                'Would create {0} containers'.format(missing)
+            )
+        return _unchanged(
+            ret, 'Pool "{0}" would get changed.'.format(name)
+        )
+
+    deleted = []
+    for container in outdated + surplus:
+        try:
+            container.delete(wait=True)
+        except Exception as e:
+            _inventory_refresh(ret)
+            return _error(ret, six.text_type(e))
+        deleted.append(container.name)
+    if deleted:
+        ret['changes']['deleted'] = deleted
+
+    created = []
+    for _ in range(missing):
+        member = '{0}-{1}'.format(name, uuid.uuid4().hex[:8])
+        try:
+            __salt__['lxd.container_create'](
+                member,
+                source,
+                profiles,
+                config,
+                devices,
+                architecture,
+                False,  # Ephemeral
+                True,  # Wait
+                remote_addr,
+                cert,
+                key,
+                verify_cert
+            )
+            if bootstrap_scripts:
+                _bootstrap(
+                    member, bootstrap_scripts,
+                    remote_addr, cert, key, verify_cert
+                )
+        except (CommandExecutionError, SaltInvocationError) as e:
+            # A half bootstrapped member would count as current.
+            err = _discard(member, remote_addr, cert, key, verify_cert)
+            if created:
+                ret['changes']['created'] = created
+            _inventory_refresh(ret)
+            return _error(ret, ' '.join(
+                [six.text_type(e)] + ([err] if err else [])
+            ))
+        created.append(member)
+
+    if created:
+        ret['changes']['created'] = created
+    _inventory_refresh(ret)
+
+    return _success(
+        ret, 'Pool "{0}" has {1} containers'.format(
+            name, len(current) - len(surplus) + len(created)
+        )
+    )
+
+
+def golden(name,
+           source,
+           profiles=None,
+           config=None,
+           devices=None,
+           architecture='x86_64',
+           bootstrap_scripts=None,
+           snapshot='golden',
+           aliases=None,
+           public=False,
+           remote_addr=None,
+           cert=None,
+           key=None,
+           verify_cert=True):
+    '''
+    Bootstrap a template container once, stop it and snapshot it,
+    optional publish that snapshot as an image.
+
+    Other containers get created as a clone of it with the source:
+
+    .. code-block:: yaml
+
+        source:
+          type: copy
+          source: <name>/golden
+
+    On ZFS and btrfs these clones are copy-on-write.
+
+    The template gets rebuilt when the source, profiles, config, devices
+    or bootstrap scripts change, existing clones are not touched.
+
+    name :
+        The name of the template container
+
+    source :
+        The source of the template, see :mod:`present
+        <salt.states.lxd_container.present>`
+
+    profiles : ['default']
+        List of profiles to apply on the template
+
+    config :
+        A config dict or None (None = unset).
+
+    devices :
+        A device dict or None (None = unset).
+
+    architecture : 'x86_64'
+        The architecture of the template
+
+    bootstrap_scripts :
+        A list of scripts to run in the template, see :mod:`pool
+        <salt.states.lxd_container.pool>`
+
+    snapshot : 'golden'
+        The name of the snapshot to take
+
+    aliases : None
+        Publish the snapshot as image with these aliases
+
+    public : False
+        Make the published image public available
+
+    remote_addr :
+        An URL to a remote Server, you also have to give cert and key if you
+        provide remote_addr!
+
+        Examples:
+            https://myserver.lan:8443
+            /var/lib/mysocket.sock
+
+    cert :
+        PEM Formatted SSL Zertifikate.
+
+        Examples:
+            ~/.config/lxc/client.crt
+
+    key :
+        PEM Formatted SSL Key.
+
+        Examples:
+            ~/.config/lxc/client.key
+
+    verify_cert : True
+        Wherever to verify the cert, this is by default True
+        but in the most cases you want to set it off as LXD
+        normaly uses self-signed certificates.
+    '''
+    if profiles is None:
+        profiles = ['default']
+
+    if aliases is None:
+        aliases = []
+
+    ret = {
+        'name': name,
+        'source': source,
+        'profiles': profiles,
+        'config': config,
+        'devices': devices,
+        'architecture': architecture,
+        'bootstrap_scripts': bootstrap_scripts,
+        'snapshot': snapshot,
+        'aliases': aliases,
+        'public': public,
+
+        'remote_addr': remote_addr,
+        'cert': cert,
+        'key': key,
+        'verify_cert': verify_cert,
+
+        'changes': {}
+    }
+
+    config, devices = __salt__['lxd.normalize_input_values'](
+        config,
+        devices
+    )
+    config = dict(config or {})
+
+    spec = _spec_hash(source, sorted(profiles), config, devices,
+                      architecture, bootstrap_scripts)
+    config['user.salt.golden_spec'] = spec
+
+    container = None
+    try:
+        container = __salt__['lxd.inventory_object'](
+            'containers', name, remote_addr, cert, key, verify_cert,
+            _raw=True
+        )
+    except CommandExecutionError as e:
+        return _error(ret, six.text_type(e))
+    except SaltInvocationError:
+        # Template not found
+        pass
+
+    if container is not None:
+        uptodate = container.config.get('user.salt.golden_spec') == spec
+        if uptodate:
+            snapshots = __salt__['lxd.snapshots_all'](
+                name, remote_addr, cert, key, verify_cert
+            ).get(name, [])
+            uptodate = snapshot in [s['name'] for s in snapshots]
+
+        for alias in aliases if uptodate else []:
+            try:
+                __salt__['lxd.inventory_object'](
+                    'images', alias, remote_addr, cert, key, verify_cert,
+                    _raw=True
+                )
+            except SaltInvocationError:
+                uptodate = False
+                break
+
+        if uptodate:
+            return _success(
+                ret, 'Golden snapshot "{0}/{1}" is up to date'.format(
+                    name, snapshot
+                )
+            )
+
+    if __opts__['test']:
+        ret['changes']['built'] = (
+            'Would build the golden snapshot "{0}/{1}"'.format(name, snapshot)
+        )
+        return _unchanged(ret, ret['changes']['built'])
+
+    try:
+        if container is not None:
+            if container.status_code == CONTAINER_STATUS_RUNNING:
+                container.stop(wait=True)
+            container.delete(wait=True)
+            ret['changes']['deleted'] = (
+                'Deleted the outdated template "{0}"'.format(name)
+            )
+
+        __salt__['lxd.container_create'](
+            name,
+            source,
+            profiles,
+            config,
+            devices,
+            architecture,
+            False,  # Ephemeral
+            True,  # Wait
+            remote_addr,
+            cert,
+            key,
+            verify_cert
+        )
+
+        if bootstrap_scripts:
+            _bootstrap(
+                name, bootstrap_scripts,
+                remote_addr, cert, key, verify_cert
+            )
+
+        __salt__['lxd.snapshots_create'](
+            name, snapshot, remote_addr, cert, key, verify_cert
+        )
+        ret['changes']['built'] = (
+            'Built the golden snapshot "{0}/{1}"'.format(name, snapshot)
+        )
+
+        if aliases:
+            image = __salt__['lxd.container_publish'](
+                name, snapshot, aliases, public,
+                remote_addr, cert, key, verify_cert
+            )
+            ret['changes']['published'] = (
+                'Published as image "{0}" with the aliases {1}'.format(
+                    image['fingerprint'], aliases
+                )
+            )
+    except (CommandExecutionError, SaltInvocationError) as e:
+        _inventory_refresh(ret, 'images')
+        return _error(ret, six.text_type(e))
+
+    _inventory_refresh(ret, 'images')
+    return _success(ret, ret['changes']['built'])
+
+
+def mod_aggregate(low, chunks, running):
+    '''
+    Folds the other present, running and stopped states of the same
+    remote into this one, which applies them all concurrently.
+
+    Salt calls it with "state_aggregate: True" in the minion config or
+    "aggregate: True" on a state. States with requisites the aggregating
+    state doesn't have, or with onchanges, watch, onfail, prereq or
+    listen requisites are not folded. The folded states return the ret
+    recorded when this one applied them, so requisites on them work.
+    '''
+    return __salt__['lxd.state_aggregate'](
+        low, chunks, running,
+        dict((fun, globals()[fun]) for fun in _aggregate_funs)
+    )
+
+
+def _spec_hash(*args):
+    ''' Returns a hash over the given state arguments, used to detect
+        outdated pool members and templates.
+    '''
+    return hashlib.sha256(
+        json.dumps(args, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def _pool_spec(source, profiles, config, devices, architecture,
+               bootstrap_scripts):
+    ''' The spec of pool members, present claims only members of the
+        same spec.
+    '''
+    config, devices = __salt__['lxd.normalize_input_values'](
+        copy.deepcopy(config), copy.deepcopy(devices)
+    )
+    return _spec_hash(source, sorted(profiles), dict(config or {}),
+                      devices, architecture, bootstrap_scripts)
+
+
+def _bootstrap(name, scripts, remote_addr, cert, key, verify_cert):
+    ''' Starts the container, runs the bootstrap scripts in it
+        and stops it again.
+    '''
+    conn = (remote_addr, cert, key, verify_cert)
+
+    __salt__['lxd.container_start'](name, *conn)
+    __salt__['lxd.container_bootstrap'](
+        name, scripts, False, remote_addr=remote_addr, cert=cert, key=key,
+        verify_cert=verify_cert
+    )
+    __salt__['lxd.container_stop'](name, remote_addr=remote_addr, cert=cert,
+                                   key=key, verify_cert=verify_cert)
+
+
+def _discard(name, remote_addr, cert, key, verify_cert):
+    ''' Force stops and deletes the container if it exists,
+        returns an error message when that failed.
+    '''
+    try:
+        container = __salt__['lxd.container_get'](
+            name, remote_addr, cert, key, verify_cert, _raw=True
+        )
+        if container.status_code == CONTAINER_STATUS_RUNNING:
+            container.stop(force=True, wait=True)
+        container.delete(wait=True)
+    except SaltInvocationError:
+        # It never got created.
+        pass
+    except Exception as e:
+        return 'Failed to delete "{0}": {1}'.format(name, six.text_type(e))
+    return None
+
+
+def _inventory_refresh(ret, kind='containers', name=None, changed=None):
+    ''' Refreshes the changed container in the inventory of the remote,
+        the states read their containers from it.
+
+        changed defaults to whether ret has changes.
+    '''
+    if changed is None:
+        changed = bool(ret.get('changes'))
+    if not changed or __opts__['test']:
+        return
+
+    try:
+        __salt__['lxd.inventory_update'](
+            kind,
+            name,
+            ret['remote_addr'],
+            ret['cert'],
+            ret['key'],
+            ret['verify_cert']
+        )
+    except (CommandExecutionError, SaltInvocationError):
+        # Reload it on the next use
+        __salt__['lxd.inventory_update'](
+            kind, None, ret['remote_addr'], ret['cert'], ret['key'],
+            ret['verify_cert']
+        )
+
+
 def _success(ret, success_msg):
     ret['result'] = True
     ret['comment'] = success_msg
     if 'changes' not in ret:
         ret['changes'] = {}
+    _inventory_refresh(ret, name=ret['name'])
     return ret
 
 
@@ -873,4 +1733,5 @@ def _error(ret, err_msg):
     ret['comment'] = err_msg
     if 'changes' not in ret:
         ret['changes'] = {}
+    _inventory_refresh(ret, name=ret['name'])
     return ret
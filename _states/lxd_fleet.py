@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+'''
+Manage remotes, images, profiles, golden snapshots and containers of LXD
+in one state.
+
+.. versionadded:: Fluorine
+
+``lxd_fleet.managed`` applies the lxd_container, lxd_image, lxd_profile
+and lxd states for everything in the "lxd" pillar (or given as
+arguments). They run concurrently in dependency order, so a remote is
+authenticated before anything is done on it and an image or a profile
+exists before the containers using it.
+
+.. code-block:: yaml
+
+    lxd-fleet:
+      lxd_fleet.managed:
+        - concurrency: 20
+
+:maintainer: René Jochum <rene@jochums.at>
+:maturity: new
+:depends: python-pylxd
+:platform: Linux
+'''
+
+# Import python libs
+from __future__ import absolute_import, print_function, unicode_literals
+from multiprocessing.pool import ThreadPool
+
+# Import salt libs
+import salt.ext.six as six
+from salt.ext.six.moves import queue
+
+__docformat__ = 'restructuredtext en'
+
+__virtualname__ = 'lxd_fleet'
+
+
+def __virtual__():
+    '''
+    Only load if the lxd module is available in __salt__
+    '''
+    return __virtualname__ if 'lxd.version' in __salt__ else False
+
+
+def managed(name,
+            remotes=None,
+            images=None,
+            profiles=None,
+            golden=None,
+            containers=None,
+            concurrency=10):
+    '''
+    Manage everything given in the format of the "lxd" pillar, which is
+    the default for each of them.
+
+    The states the lxd.remotes, lxd.images, lxd.profiles, lxd.golden and
+    lxd.containers sls files render get applied in the order of their
+    dependencies, everything else concurrently:
+
+    - the authentication to a remote before everything on it,
+    - images before the golden snapshots and containers created
+      from their aliases,
+    - profiles before the golden snapshots and containers using them,
+    - golden snapshots before the containers cloned from them,
+    - absent images and profiles after the containers of their remote.
+
+    The "opts" of the pillar entries get ignored.
+
+    name :
+        The name of the fleet, only used in the ret.
+
+    remotes :
+        The remotes by their name, see lxd.remotes.
+
+    images :
+        The images by remote and name, see lxd.images.
+
+    profiles :
+        The profiles by remote and name, see lxd.profiles.
+
+    golden :
+        The golden snapshots by remote and name, see lxd.golden.
+
+    containers :
+        The containers by remote and name, see lxd.containers.
+
+    concurrency : 10
+        How many states to apply at once.
+    '''
+    ret = {
+        'name': name,
+        'changes': {}
+    }
+
+    def _pillar(value, kind):
+        if value is None:
+            return __salt__['pillar.get']('lxd:{0}'.format(kind), {})
+        return value
+
+    fleet = {
+        'remotes': _pillar(remotes, 'remotes'),
+        'images': _pillar(images, 'images'),
+        'profiles': _pillar(profiles, 'profiles'),
+        'golden': _pillar(golden, 'golden'),
+        'containers': _pillar(containers, 'containers'),
+    }
+
+    nodes, deps = _fleet_graph(fleet)
+    if not nodes:
+        return _success(ret, 'Nothing to manage')
+
+    rets = _run_graph(nodes, deps, concurrency)
+
+    comments = []
+    result = True
+    for node in sorted(rets):
+        node_ret = rets[node]
+        if node_ret['changes']:
+            ret['changes'][node] = node_ret['changes']
+        if node_ret['result'] is False:
+            result = False
+        elif node_ret['result'] is None and result is True:
+            result = None
+        if node_ret['result'] is not True or node_ret['changes']:
+            comments.append('{0}: {1}'.format(node, node_ret['comment']))
+
+    comments.insert(0, 'Applied {0} states, {1} with changes'.format(
+        len(rets), len(ret['changes'])
+    ))
+    ret['result'] = result
+    ret['comment'] = '\n'.join(comments)
+    return ret
+
+
+def _fleet_graph(fleet):
+    ''' Returns the nodes (id: (state function, kwargs)) and the
+        dependencies (id: set of ids) of the fleet.
+    '''
+    nodes = {}
+    deps = {}
+    remotes = fleet['remotes']
+
+    def _remote_args(remotename):
+        remote = remotes.get(remotename) or {}
+        return {
+            'remote_addr': remote.get('remote_addr'),
+            'cert': remote.get('cert'),
+            'key': remote.get('key'),
+            'verify_cert': remote.get('verify_cert', True),
+        }
+
+    def _add(node, fun, kwargs, remotename, *requires):
+        nodes[node] = (fun, kwargs)
+        deps[node] = set(r for r in requires if r)
+        auth = 'lxd_remote_{0}'.format(remotename)
+        if auth in nodes:
+            deps[node].add(auth)
+
+    # Authentication
+    for remotename, remote in six.iteritems(remotes):
+        if not remote.get('password'):
+            continue
+        kwargs = _remote_args(remotename)
+        kwargs['password'] = remote['password']
+        kwargs['name'] = remotename
+        _add('lxd_remote_{0}'.format(remotename), 'lxd.authenticate',
+             kwargs, None)
+
+    # Images, by the aliases they provide
+    provides = {}
+    absent = []
+    for remotename, images in six.iteritems(fleet['images']):
+        for name, image in six.iteritems(images):
+            node = 'lxd_image_{0}_{1}'.format(remotename, name)
+            kwargs = _remote_args(remotename)
+            kwargs['name'] = image.get('name', name)
+            if image.get('absent', False):
+                _add(node, 'lxd_image.absent', kwargs, remotename)
+                absent.append((node, remotename))
+                continue
+
+            for k in ('source', 'aliases', 'public', 'auto_update'):
+                if k in image:
+                    kwargs[k] = image[k]
+
+            requires = []
+            source = kwargs.get('source')
+            if isinstance(source, dict) and 'remote' in source:
+                kwargs['source'] = dict(source)
+                kwargs['source'].update(remotes.get(source['remote'], {}))
+                requires.append('lxd_remote_{0}'.format(source['remote']))
+
+            _add(node, 'lxd_image.present', kwargs, remotename, *requires)
+            for alias in [kwargs['name']] + list(image.get('aliases', [])):
+                provides[('image', remotename, alias)] = node
+
+    # Image copies from images we manage too
+    for node, (fun, kwargs) in six.iteritems(nodes):
+        source = kwargs.get('source')
+        if fun == 'lxd_image.present' and isinstance(source, dict) and \
+                'remote' in source:
+            src = provides.get(('image', source['remote'], source.get('name')))
+            if src is not None:
+                deps[node].add(src)
+
+    # Profiles
+    for remotename, profiles in six.iteritems(fleet['profiles']):
+        for name, profile in six.iteritems(profiles):
+            node = 'lxd_profile_{0}_{1}'.format(remotename, name)
+            kwargs = _remote_args(remotename)
+            kwargs['name'] = profile.get('name', name)
+            if profile.get('absent', False):
+                _add(node, 'lxd_profile.absent', kwargs, remotename)
+                absent.append((node, remotename))
+                continue
+
+            for k in ('description', 'config', 'devices'):
+                if profile.get(k, False):
+                    kwargs[k] = profile[k]
+            _add(node, 'lxd_profile.present', kwargs, remotename)
+            provides[('profile', remotename, kwargs['name'])] = node
+
+    def _uses(remotename, spec):
+        ''' The image and profile nodes spec uses. '''
+        source = spec.get('source')
+        if isinstance(source, dict):
+            source = source.get('alias')
+        used = [provides.get(('image', remotename, source))]
+        for profile in spec.get('profiles', ['default']):
+            used.append(provides.get(('profile', remotename, profile)))
+        return used
+
+    # Golden snapshots
+    for remotename, templates in six.iteritems(fleet['golden']):
+        for name, template in six.iteritems(templates):
+            node = 'lxd_golden_{0}_{1}'.format(remotename, name)
+            kwargs = _remote_args(remotename)
+            kwargs['name'] = template.get('name', name)
+            for k in ('source', 'profiles', 'config', 'devices',
+                      'architecture', 'bootstrap_scripts', 'snapshot',
+                      'aliases', 'public'):
+                if k in template:
+                    kwargs[k] = template[k]
+            _add(node, 'lxd_container.golden', kwargs, remotename,
+                 *_uses(remotename, template))
+            for alias in template.get('aliases', []):
+                provides[('image', remotename, alias)] = node
+
+    # Containers
+    container_nodes = {}
+    for remotename, containers in six.iteritems(fleet['containers']):
+        for name, container in six.iteritems(containers):
+            node = 'lxd_container_{0}_{1}'.format(remotename, name)
+            kwargs = _remote_args(remotename)
+            container_nodes.setdefault(remotename, []).append(node)
+
+            if 'absent' in container:
+                kwargs['name'] = name
+                if 'stop' in container:
+                    kwargs['stop'] = container['stop']
+                _add(node, 'lxd_container.absent', kwargs, remotename)
+                continue
+
+            if 'migrated' in container:
+                kwargs['name'] = name
+                kwargs['stop_and_start'] = container.get(
+                    'stop_and_start', False
+                )
+                kwargs['incremental'] = container.get('incremental', False)
+                for k, v in six.iteritems(_remote_args(container['source'])):
+                    kwargs['src_' + k] = v
+                _add(node, 'lxd_container.migrated', kwargs, remotename,
+                     'lxd_remote_{0}'.format(container['source']))
+                continue
+
+            kwargs['name'] = container.get('name', name)
+            for k in ('running', 'source', 'profiles', 'config', 'devices',
+                      'architecture', 'ephemeral', 'restart_on_change',
+                      'pool'):
+                if k in container:
+                    kwargs[k] = container[k]
+
+            requires = _uses(remotename, container)
+            if 'clone_from' in container:
+                template = fleet['golden'].get(remotename, {}).get(
+                    container['clone_from'], {}
+                )
+                kwargs['source'] = {
+                    'type': 'copy',
+                    'source': '{0}/{1}'.format(
+                        template.get('name', container['clone_from']),
+                        template.get('snapshot', 'golden')
+                    ),
+                }
+                requires.append('lxd_golden_{0}_{1}'.format(
+                    remotename, container['clone_from']
+                ))
+            elif container.get('bootstrap_scripts'):
+                # Clones of a golden snapshot are already bootstrapped.
+                kwargs['bootstrap_scripts'] = container['bootstrap_scripts']
+            if container.get('files'):
+                kwargs['files'] = container['files']
+            if 'pool' in container and container.get('bootstrap_scripts'):
+                # The pool members must have run the same scripts.
+                kwargs['pool_bootstrap_scripts'] = \
+                    container['bootstrap_scripts']
+
+            _add(node, 'container', kwargs, remotename, *requires)
+
+    # Absent images and profiles after the containers which may use them
+    for node, remotename in absent:
+        deps[node].update(container_nodes.get(remotename, []))
+
+    # Requisites on nodes we don't have (like the template of a clone
+    # which isn't in golden) are not ours to order.
+    for node in deps:
+        deps[node] &= set(nodes)
+
+    return nodes, deps
+
+
+def _run_graph(nodes, deps, concurrency):
+    ''' Applies the nodes concurrently, each once its dependencies are
+        done. Nodes whose dependencies failed don't get applied.
+    '''
+    pending = dict((node, set(requires))
+                   for node, requires in six.iteritems(deps))
+    dependents = dict((node, set()) for node in nodes)
+    for node, requires in six.iteritems(deps):
+        for required in requires:
+            dependents[required].add(node)
+
+    rets = {}
+    failed = set()
+    done = queue.Queue()
+
+    def _apply(node):
+        fun, kwargs = nodes[node]
+        try:
+            if fun == 'container':
+                node_ret = _container(kwargs)
+            else:
+                node_ret = __states__[fun](**kwargs)
+        except Exception as e:
+            node_ret = {
+                'name': kwargs.get('name'),
+                'changes': {},
+                'result': False,
+                'comment': six.text_type(e),
+            }
+        done.put((node, node_ret))
+
+    def _finish(node, node_ret):
+        rets[node] = node_ret
+        if node_ret['result'] is False:
+            failed.add(node)
+        for dependent in dependents[node]:
+            pending[dependent].discard(node)
+
+    pool = ThreadPool(max(1, int(concurrency)))
+    try:
+        active = 0
+        while pending or active:
+            ready = [node for node, requires in six.iteritems(pending)
+                     if not requires]
+            for node in sorted(ready):
+                del pending[node]
+                if deps[node] & failed:
+                    _finish(node, {
+                        'name': nodes[node][1].get('name'),
+                        'changes': {},
+                        'result': False,
+                        'comment': 'One or more requisite failed: {0}'.format(
+                            ', '.join(sorted(deps[node] & failed))
+                        ),
+                    })
+                    continue
+                pool.apply_async(_apply, (node,))
+                active += 1
+
+            if not active:
+                if pending and not ready:
+                    # A cycle, can't happen with the rules above
+                    for node in pending:
+                        rets[node] = {
+                            'name': nodes[node][1].get('name'),
+                            'changes': {},
+                            'result': False,
+                            'comment': 'Circular dependency',
+                        }
+                    break
+                continue
+
+            node, node_ret = done.get()
+            active -= 1
+            _finish(node, node_ret)
+    finally:
+        pool.terminate()
+
+    return rets
+
+
+def _container(kwargs):
+    ''' Applies lxd_container.present, bootstrapped when the container
+        changed and file_managed, like lxd.containers does.
+    '''
+    kwargs = dict(kwargs)
+    scripts = kwargs.pop('bootstrap_scripts', None)
+    if 'pool_bootstrap_scripts' in kwargs:
+        kwargs['bootstrap_scripts'] = kwargs.pop('pool_bootstrap_scripts')
+    files = kwargs.pop('files', [])
+    remote = dict((k, kwargs[k])
+                  for k in ('remote_addr', 'cert', 'key', 'verify_cert'))
+
+    ret = __states__['lxd_container.present'](**kwargs)
+    if ret['result'] is False:
+        return ret
+
+    if scripts and ret['changes']:
+        bootstrapped = __states__['lxd_container.bootstrapped'](
+            kwargs['name'], scripts, **remote
+        )
+        ret['changes'].update(bootstrapped['changes'])
+        ret['comment'] = '{0} {1}'.format(
+            ret['comment'], bootstrapped['comment']
+        )
+        if bootstrapped['result'] is not True:
+            ret['result'] = bootstrapped['result']
+            return ret
+
+    for file in files:
+        file_kwargs = dict(remote)
+        for k in ('delete', 'mode', 'uid', 'gid'):
+            if k in file:
+                file_kwargs[k] = file[k]
+        managed_file = __states__['lxd_container.file_managed'](
+            kwargs['name'], file['source'], file['dst'], **file_kwargs
+        )
+        if managed_file['changes']:
+            ret['changes'][file['dst']] = managed_file['changes']
+        if managed_file['result'] is not True:
+            ret['result'] = managed_file['result']
+            ret['comment'] = '{0} {1}'.format(
+                ret['comment'], managed_file['comment']
+            )
+            if managed_file['result'] is False:
+                return ret
+
+    return ret
+
+
+def _success(ret, success_msg):
+    ret['result'] = True
+    ret['comment'] = success_msg
+    if 'changes' not in ret:
+        ret['changes'] = {}
+    return ret
@@ -173,8 +173,8 @@ def present(name,
 
     image = None
     try:
-        image = __salt__['lxd.image_get_by_alias'](
-            name, remote_addr, cert, key, verify_cert, _raw=True
+        image = __salt__['lxd.inventory_object'](
+            'images', name, remote_addr, cert, key, verify_cert, _raw=True
         )
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
@@ -191,7 +191,7 @@ def present(name,
 
         try:
             if source['type'] == 'lxd':
-                image = __salt__['lxd.image_copy_lxd'](
+                copied = __salt__['lxd.image_copy_lxd'](
                     source['name'],
                     src_remote_addr=source['remote_addr'],
                     src_cert=source['cert'],
@@ -203,14 +203,18 @@ def present(name,
                     verify_cert=verify_cert,
                     aliases=aliases,
                     public=public,
-                    auto_update=auto_update,
-                    _raw=True
+                    auto_update=auto_update
+                )
+                ret['changes']['transfer'] = copied['transfer']
+                image = __salt__['lxd.image_get'](
+                    copied['fingerprint'],
+                    remote_addr, cert, key, verify_cert, _raw=True
                 )
 
             if source['type'] == 'file':
                 if 'saltenv' not in source:
                     source['saltenv'] = __env__
-                image = __salt__['lxd.image_from_file'](
+                uploaded = __salt__['lxd.image_from_file'](
                     source['filename'],
                     remote_addr=remote_addr,
                     cert=cert,
@@ -218,8 +222,12 @@ def present(name,
                     verify_cert=verify_cert,
                     aliases=aliases,
                     public=False if public is None else public,
-                    saltenv=source['saltenv'],
-                    _raw=True
+                    saltenv=source['saltenv']
+                )
+                ret['changes']['transfer'] = uploaded['transfer']
+                image = __salt__['lxd.image_get'](
+                    uploaded['fingerprint'],
+                    remote_addr, cert, key, verify_cert, _raw=True
                 )
 
             if source['type'] == 'simplestreams':
@@ -283,8 +291,9 @@ def present(name,
         if not __opts__['test']:
             ret['changes']['public'] = \
                 'Setting the image public to {0!s}'.format(public)
+            base = __salt__['lxd.pylxd_object_state'](image)
             image.public = public
-            __salt__['lxd.pylxd_save_object'](image)
+            __salt__['lxd.pylxd_save_object'](image, base)
         else:
             ret['changes']['public'] = \
                 'Would set public to {0!s}'.format(public)
@@ -344,12 +353,13 @@ def absent(name,
     }
     image = None
     try:
-        image = __salt__['lxd.image_get_by_alias'](
-            name, remote_addr, cert, key, verify_cert, _raw=True
+        image = __salt__['lxd.inventory_object'](
+            'images', name, remote_addr, cert, key, verify_cert, _raw=True
         )
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
     except SaltInvocationError as e:
+        # A partial fingerprint isn't in the inventory.
         try:
             image = __salt__['lxd.image_get'](
                 name, remote_addr, cert, key, verify_cert, _raw=True
@@ -377,11 +387,36 @@ def absent(name,
     return _success(ret, ret['changes']['removed'])
 
 
+def _inventory_refresh(ret):
+    ''' Refreshes the changed image in the inventory of the remote,
+        the states read their images from it.
+    '''
+    if not ret.get('changes') or __opts__['test']:
+        return
+
+    try:
+        __salt__['lxd.inventory_update'](
+            'images',
+            ret['name'],
+            ret['remote_addr'],
+            ret['cert'],
+            ret['key'],
+            ret['verify_cert']
+        )
+    except (CommandExecutionError, SaltInvocationError):
+        # Reload them on the next use
+        __salt__['lxd.inventory_update'](
+            'images', None, ret['remote_addr'], ret['cert'], ret['key'],
+            ret['verify_cert']
+        )
+
+
 def _success(ret, success_msg):
     ret['result'] = True
     ret['comment'] = success_msg
     if 'changes' not in ret:
         ret['changes'] = {}
+    _inventory_refresh(ret)
     return ret
 
 
@@ -398,4 +433,5 @@ def _error(ret, err_msg):
     ret['comment'] = err_msg
     if 'changes' not in ret:
         ret['changes'] = {}
+    _inventory_refresh(ret)
     return ret
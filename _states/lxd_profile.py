@@ -40,6 +40,9 @@ __docformat__ = 'restructuredtext en'
 
 __virtualname__ = 'lxd_profile'
 
+# The state functions mod_aggregate folds
+_aggregate_funs = ('present',)
+
 
 def __virtual__():
     '''
@@ -49,7 +52,8 @@ def __virtual__():
 
 
 def present(name, description=None, config=None, devices=None,
-            remote_addr=None, cert=None, key=None, verify_cert=True):
+            remote_addr=None, cert=None, key=None, verify_cert=True,
+            batch=None):
     '''
     Creates or updates LXD profiles
 
@@ -94,12 +98,20 @@ def present(name, description=None, config=None, devices=None,
         but in the most cases you want to set it off as LXD
         normaly uses self-signed certificates.
 
+    batch : None
+        Set by :mod:`mod_aggregate
+        <salt.states.lxd_profile.mod_aggregate>`, the states
+        folded into this one, True when this one got folded.
+
     See the `lxd-docs`_ for the details about the config and devices dicts.
     See the `requests-docs` for the SSL stuff.
 
     .. _lxd-docs: https://github.com/lxc/lxd/blob/master/doc/rest-api.md#post-10
     .. _requests-docs: http://docs.python-requests.org/en/master/user/advanced/#ssl-cert-verification  # noqa
     '''
+    if batch:
+        return __salt__['lxd.state_batch'](present, dict(locals()))
+
     ret = {
         'name': name,
         'description': description,
@@ -116,8 +128,9 @@ def present(name, description=None, config=None, devices=None,
 
     profile = None
     try:
-        profile = __salt__['lxd.profile_get'](
-            name, remote_addr, cert, key, verify_cert, _raw=True
+        profile = __salt__['lxd.inventory_object'](
+            'profiles', name, remote_addr, cert, key, verify_cert,
+            _raw=True
         )
     except CommandExecutionError as e:
         return _error(ret, six.text_type(e))
@@ -155,10 +168,20 @@ def present(name, description=None, config=None, devices=None,
         ret['changes'] = {'created': msg}
         return _success(ret, msg)
 
+    # Nothing to diff when the spec didn't change since we applied it
+    # and nobody touched the profile.
+    fingerprint = __salt__['lxd.spec_fingerprint'](
+        None, config, devices, description
+    )
+    if __salt__['lxd.fingerprint_unchanged'](
+            profile, fingerprint, remote_addr):
+        return _success(ret, 'No changes')
+
     config, devices = __salt__['lxd.normalize_input_values'](
         config,
         devices
     )
+    base = __salt__['lxd.pylxd_object_state'](profile)
 
     #
     # Description change
@@ -175,19 +198,24 @@ def present(name, description=None, config=None, devices=None,
     )
     ret['changes'].update(changes)
 
-    if not ret['changes']:
-        return _success(ret, 'No changes')
-
     if __opts__['test']:
+        if not ret['changes']:
+            return _success(ret, 'No changes')
         return _unchanged(
             ret,
             'Profile "{0}" would get changed.'.format(name)
         )
 
-    try:
-        __salt__['lxd.pylxd_save_object'](profile)
-    except CommandExecutionError as e:
-        return _error(ret, six.text_type(e))
+    tagged = __salt__['lxd.fingerprint_set'](profile, fingerprint)
+    if ret['changes'] or tagged:
+        try:
+            __salt__['lxd.pylxd_save_object'](profile, base)
+        except CommandExecutionError as e:
+            return _error(ret, six.text_type(e))
+    __salt__['lxd.fingerprint_save'](profile, remote_addr)
+
+    if not ret['changes']:
+        return _success(ret, 'No changes')
 
     return _success(ret, '{0} changes'.format(len(ret['changes'].keys())))
 
@@ -241,8 +269,8 @@ def absent(name, remote_addr=None, cert=None,
     }
     if __opts__['test']:
         try:
-            __salt__['lxd.profile_get'](
-                name, remote_addr, cert, key, verify_cert
+            __salt__['lxd.inventory_object'](
+                'profiles', name, remote_addr, cert, key, verify_cert
             )
         except CommandExecutionError as e:
             return _error(ret, six.text_type(e))
@@ -273,11 +301,53 @@ def absent(name, remote_addr=None, cert=None,
     return _success(ret, ret['changes']['removed'])
 
 
+def mod_aggregate(low, chunks, running):
+    '''
+    Folds the other present states of the same remote into this one,
+    which applies them all concurrently.
+
+    Salt calls it with "state_aggregate: True" in the minion config or
+    "aggregate: True" on a state. States with requisites the aggregating
+    state doesn't have, or with onchanges, watch, onfail, prereq or
+    listen requisites are not folded. The folded states return the ret
+    recorded when this one applied them, so requisites on them work.
+    '''
+    return __salt__['lxd.state_aggregate'](
+        low, chunks, running,
+        dict((fun, globals()[fun]) for fun in _aggregate_funs)
+    )
+
+
+def _inventory_refresh(ret):
+    ''' Refreshes the changed profile in the inventory of the remote,
+        the states read their profiles from it.
+    '''
+    if not ret.get('changes') or __opts__['test']:
+        return
+
+    try:
+        __salt__['lxd.inventory_update'](
+            'profiles',
+            ret['name'],
+            ret['remote_addr'],
+            ret['cert'],
+            ret['key'],
+            ret['verify_cert']
+        )
+    except (CommandExecutionError, SaltInvocationError):
+        # Reload them on the next use
+        __salt__['lxd.inventory_update'](
+            'profiles', None, ret['remote_addr'], ret['cert'], ret['key'],
+            ret['verify_cert']
+        )
+
+
 def _success(ret, success_msg):
     ret['result'] = True
     ret['comment'] = success_msg
     if 'changes' not in ret:
         ret['changes'] = {}
+    _inventory_refresh(ret)
     return ret
 
 
@@ -294,4 +364,5 @@ def _error(ret, err_msg):
     ret['comment'] = err_msg
     if 'changes' not in ret:
         ret['changes'] = {}
+    _inventory_refresh(ret)
     return ret